@@ -12,3 +12,4 @@ require('bootstrap');
 // Your own code
 require('./plugins.js');
 require('./script.js');
+require('./tileviewer.js');
@@ -0,0 +1,143 @@
+/*
+ * Deep-zoom viewer for the tile pyramids served by /users/tiles/.
+ *
+ * Markup: <div class="tile-viewer" data-tiles="/users/tiles/<hash>/"><img src="/users/previews/preview/<hash>.jpg"></div>
+ *
+ * The image, the preview rendered at import, is shown as the overview. Scrolling
+ * zooms around the cursor and dragging pans. Whenever the overview has fewer pixels
+ * than the screen shows, at any zoom, the tiles of the level matching the on-screen
+ * size are fetched on top of it, and only those in view. Double-click resets the view.
+ */
+
+function TileViewer(el) {
+  var viewer = this;
+  this.el = el;
+  this.base = el.dataset.tiles;
+  this.overview = el.querySelector('img');
+  this.layer = document.createElement('div');
+  this.layer.className = 'tile-layer';
+  el.appendChild(this.layer);
+  this.tiles = {};
+  this.zoom = 1;
+  this.x = 0;
+  this.y = 0;
+  this.overview.addEventListener('load', function () { if (viewer.info) { viewer.render(); } });
+
+  fetch(this.base + 'info.json', { credentials: 'same-origin' })
+    .then(function (response) { return response.json(); })
+    .then(function (info) {
+      viewer.info = info;
+      viewer.bind();
+      viewer.reset();
+    });
+}
+
+TileViewer.prototype.bind = function () {
+  var viewer = this;
+  var drag = null;
+
+  this.el.addEventListener('wheel', function (event) {
+    event.preventDefault();
+    var rect = viewer.el.getBoundingClientRect();
+    viewer.zoomAt(event.deltaY < 0 ? 1.25 : 0.8, event.clientX - rect.left, event.clientY - rect.top);
+  });
+  this.el.addEventListener('mousedown', function (event) {
+    event.preventDefault();
+    drag = { x: event.clientX - viewer.x, y: event.clientY - viewer.y };
+  });
+  window.addEventListener('mousemove', function (event) {
+    if (drag) {
+      viewer.x = event.clientX - drag.x;
+      viewer.y = event.clientY - drag.y;
+      viewer.render();
+    }
+  });
+  window.addEventListener('mouseup', function () { drag = null; });
+  this.el.addEventListener('dblclick', function () { viewer.reset(); });
+};
+
+TileViewer.prototype.reset = function () {
+  this.fit = this.el.clientWidth / this.info.width;
+  this.el.style.height = Math.round(this.info.height * this.fit) + 'px';
+  this.zoom = 1;
+  this.x = 0;
+  this.y = 0;
+  this.render();
+};
+
+TileViewer.prototype.zoomAt = function (factor, cx, cy) {
+  var zoom = Math.max(1, Math.min(this.zoom * factor, 1 / this.fit * 4));
+  factor = zoom / this.zoom;
+  this.x = cx - (cx - this.x) * factor;
+  this.y = cy - (cy - this.y) * factor;
+  this.zoom = zoom;
+  this.render();
+};
+
+TileViewer.prototype.level = function (scale) {
+  // The coarsest level with at least one level pixel per screen pixel
+  var info = this.info;
+  for (var level = 0; level < info.levels - 1; level++) {
+    if (info.width / Math.pow(2, info.levels - 1 - level) >= info.width * scale * (window.devicePixelRatio || 1)) {
+      return level;
+    }
+  }
+  return info.levels - 1;
+};
+
+TileViewer.prototype.render = function () {
+  var info = this.info;
+  var scale = this.fit * this.zoom;
+  var width = info.width * scale;
+  var height = info.height * scale;
+  this.x = Math.min(0, Math.max(this.el.clientWidth - width, this.x));
+  this.y = Math.min(0, Math.max(this.el.clientHeight - height, this.y));
+
+  var placement = 'translate(' + this.x + 'px,' + this.y + 'px)';
+  this.overview.style.transform = placement;
+  this.overview.style.width = width + 'px';
+  this.layer.style.transform = placement;
+
+  var wanted = {};
+  var level = this.level(scale);
+  var factor = Math.pow(2, info.levels - 1 - level);
+  // Tiles only add detail where the overview, once loaded, is coarser than the level
+  if (this.overview.complete && this.overview.naturalWidth < Math.ceil(info.width / factor)) {
+    var size = info.tile * factor * scale; // On-screen size of a tile
+    var first = { col: Math.floor(-this.x / size), row: Math.floor(-this.y / size) };
+    var last = {
+      col: Math.min(Math.ceil(info.width / factor / info.tile), Math.ceil((this.el.clientWidth - this.x) / size)),
+      row: Math.min(Math.ceil(info.height / factor / info.tile), Math.ceil((this.el.clientHeight - this.y) / size)),
+    };
+    for (var row = first.row; row < last.row; row++) {
+      for (var col = first.col; col < last.col; col++) {
+        var key = level + '/' + col + '_' + row;
+        wanted[key] = true;
+        var img = this.tiles[key];
+        if (!img) {
+          img = this.tiles[key] = document.createElement('img');
+          img.src = this.base + key + '.jpg';
+          this.layer.appendChild(img);
+        }
+        img.style.left = col * size + 'px';
+        img.style.top = row * size + 'px';
+        img.style.width = img.naturalWidth ? img.naturalWidth * factor * scale + 'px' : '';
+        img.onload = this.render.bind(this);
+      }
+    }
+  }
+  for (var existing in this.tiles) {
+    if (!wanted[existing]) {
+      this.layer.removeChild(this.tiles[existing]);
+      delete this.tiles[existing];
+    }
+  }
+};
+
+document.addEventListener('DOMContentLoaded', function () {
+  Array.prototype.forEach.call(document.querySelectorAll('.tile-viewer'), function (el) {
+    new TileViewer(el); // eslint-disable-line no-new
+  });
+});
+
+module.exports = TileViewer;
@@ -0,0 +1,69 @@
+"""Add the import manifest, import jobs and tagging work queue
+
+The queue is filled with the data files that still need tags.
+
+Revision ID: 2d6b9e4f1a35
+Revises: a1c0f5e2b7d4
+Create Date: 2026-10-18 09:25:53.904716
+
+"""
+import random
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '2d6b9e4f1a35'
+down_revision = 'a1c0f5e2b7d4'
+branch_labels = None
+depends_on = None
+
+tags_per_file = 2
+
+
+def upgrade():
+    op.create_table('importmanifest',
+                    sa.Column('kind', sa.String(length=10), nullable=False),
+                    sa.Column('path', sa.String(length=1000), nullable=False),
+                    sa.Column('size', sa.BigInteger(), nullable=False),
+                    sa.Column('mtime_ns', sa.BigInteger(), nullable=False),
+                    sa.Column('inode', sa.BigInteger(), nullable=False),
+                    sa.Column('hash', sa.String(length=40), nullable=False),
+                    sa.PrimaryKeyConstraint('kind', 'path'))
+    op.create_table('importjobs',
+                    sa.Column('id', sa.Integer(), nullable=False),
+                    sa.Column('kind', sa.String(length=10), nullable=False),
+                    sa.Column('path', sa.String(length=1000), nullable=False),
+                    sa.Column('username', sa.Integer(), nullable=False),
+                    sa.Column('status', sa.String(length=20), nullable=False),
+                    sa.Column('cancel_requested', sa.Boolean(), nullable=False),
+                    sa.Column('error', sa.Text(), nullable=True),
+                    sa.Column('created_at', sa.DateTime(), nullable=False),
+                    sa.Column('updated_at', sa.DateTime(), nullable=False),
+                    *[sa.Column(counter, sa.Integer(), nullable=False)
+                      for counter in ('scanned', 'decoded', 'duplicates', 'unchanged', 'deleted', 'inserted')],
+                    sa.Column('files_per_second', sa.Float(), nullable=False),
+                    sa.PrimaryKeyConstraint('id'))
+    op.create_table('workqueue',
+                    sa.Column('hash', sa.String(length=40), nullable=False),
+                    sa.Column('position', sa.Integer(), nullable=False),
+                    sa.Column('lease_user', sa.Integer(), nullable=True),
+                    sa.Column('lease_expires', sa.DateTime(), nullable=True),
+                    sa.PrimaryKeyConstraint('hash'))
+    op.create_index('ix_workqueue_position', 'workqueue', ['position'])
+    op.create_index('ix_workqueue_lease_user', 'workqueue', ['lease_user'])
+
+    untagged = op.get_bind().execute(sa.text('SELECT hash FROM datafiles WHERE tagged < :wanted'),
+                                     {'wanted': tags_per_file})
+    workqueue = sa.table('workqueue', sa.column('hash', sa.String), sa.column('position', sa.Integer))
+    items = [dict(hash=datahash, position=random.randrange(2 ** 31)) for datahash, in untagged]
+    if items:
+        op.bulk_insert(workqueue, items)
+
+
+def downgrade():
+    op.drop_index('ix_workqueue_lease_user', table_name='workqueue')
+    op.drop_index('ix_workqueue_position', table_name='workqueue')
+    for table in ('workqueue', 'importjobs', 'importmanifest'):
+        op.drop_table(table)
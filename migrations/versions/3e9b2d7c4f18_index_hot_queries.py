@@ -0,0 +1,39 @@
+"""Index the columns the tagging hot queries filter and join on
+
+Revision ID: 3e9b2d7c4f18
+Revises: 2d6b9e4f1a35
+Create Date: 2026-10-18 09:40:07.552918
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3e9b2d7c4f18'
+down_revision = '2d6b9e4f1a35'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    untagged = sa.text('tagged < 2')
+    op.create_index('ix_tags_hash', 'tags', ['hash'])
+    op.create_index('ix_tags_username_hash', 'tags', ['username', 'hash'])
+    op.create_index('ix_tomotags_hash', 'tomotags', ['hash'])
+    op.create_index('ix_tomotags_username_hash', 'tomotags', ['username', 'hash'])
+    op.create_index('ix_datafiles_untagged', 'datafiles', ['tagged'],
+                    postgresql_where=untagged, sqlite_where=untagged)
+    op.create_index('ix_tomodatafiles_groupid', 'tomodatafiles', ['groupid'])
+    op.create_index('ix_tomodatafiles_untagged', 'tomodatafiles', ['tagged', 'groupid'],
+                    postgresql_where=untagged, sqlite_where=untagged)
+
+
+def downgrade():
+    op.drop_index('ix_tomodatafiles_untagged', table_name='tomodatafiles')
+    op.drop_index('ix_tomodatafiles_groupid', table_name='tomodatafiles')
+    op.drop_index('ix_datafiles_untagged', table_name='datafiles')
+    op.drop_index('ix_tomotags_username_hash', table_name='tomotags')
+    op.drop_index('ix_tomotags_hash', table_name='tomotags')
+    op.drop_index('ix_tags_username_hash', table_name='tags')
+    op.drop_index('ix_tags_hash', table_name='tags')
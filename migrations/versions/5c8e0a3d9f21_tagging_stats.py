@@ -0,0 +1,47 @@
+"""Tagging statistics counter tables
+
+Creates the counter tables maintained by the tag and import writes. Run
+``flask reconcile-stats`` once after upgrading to fill them in.
+
+Revision ID: 5c8e0a3d9f21
+Revises: 7f4a1c9e2b63
+Create Date: 2026-10-18 11:02:37.418265
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5c8e0a3d9f21'
+down_revision = '7f4a1c9e2b63'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('counters',
+                    sa.Column('name', sa.String(length=40), nullable=False),
+                    sa.Column('value', sa.BigInteger(), nullable=False),
+                    sa.PrimaryKeyConstraint('name'))
+    op.create_table('userstats',
+                    sa.Column('username', sa.Integer(), nullable=False),
+                    sa.Column('value', sa.BigInteger(), nullable=False),
+                    sa.PrimaryKeyConstraint('username'))
+    op.create_index(op.f('ix_userstats_value'), 'userstats', ['value'], unique=False)
+    op.create_table('labelstats',
+                    sa.Column('label', sa.String(length=40), nullable=False),
+                    sa.Column('value', sa.BigInteger(), nullable=False),
+                    sa.PrimaryKeyConstraint('label'))
+    op.create_table('daystats',
+                    sa.Column('day', sa.Date(), nullable=False),
+                    sa.Column('value', sa.BigInteger(), nullable=False),
+                    sa.PrimaryKeyConstraint('day'))
+
+
+def downgrade():
+    op.drop_table('daystats')
+    op.drop_table('labelstats')
+    op.drop_index(op.f('ix_userstats_value'), table_name='userstats')
+    op.drop_table('userstats')
+    op.drop_table('counters')
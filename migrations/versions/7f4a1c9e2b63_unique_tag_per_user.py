@@ -0,0 +1,34 @@
+"""One tag per user and data file
+
+Removes repeated tags of the same file by the same user, keeping the first,
+recounts the datafiles tag counters and adds the unique constraint.
+
+Revision ID: 7f4a1c9e2b63
+Revises: 3e9b2d7c4f18
+Create Date: 2026-10-18 10:21:53.904117
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = '7f4a1c9e2b63'
+down_revision = '3e9b2d7c4f18'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.execute('DELETE FROM tags WHERE id NOT IN '
+               '(SELECT first_id FROM (SELECT MIN(id) AS first_id FROM tags GROUP BY username, hash) AS firsts)')
+    op.execute('UPDATE datafiles SET tagged = (SELECT COUNT(*) FROM tags WHERE tags.hash = datafiles.hash)')
+    op.execute('DELETE FROM workqueue WHERE hash IN (SELECT hash FROM datafiles WHERE tagged >= 2)')
+    op.drop_index('ix_tags_username_hash', table_name='tags')
+    with op.batch_alter_table('tags') as batch_op:
+        batch_op.create_unique_constraint('uq_tags_username_hash', ['username', 'hash'])
+
+
+def downgrade():
+    with op.batch_alter_table('tags') as batch_op:
+        batch_op.drop_constraint('uq_tags_username_hash', type_='unique')
+    op.create_index('ix_tags_username_hash', 'tags', ['username', 'hash'])
@@ -0,0 +1,34 @@
+"""Consensus labels table
+
+Fill it in with ``flask update-consensus`` after upgrading.
+
+Revision ID: 9d2f6b8a1e47
+Revises: 5c8e0a3d9f21
+Create Date: 2026-10-18 11:46:09.270531
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '9d2f6b8a1e47'
+down_revision = '5c8e0a3d9f21'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('consensus',
+                    sa.Column('hash', sa.String(length=40), nullable=False),
+                    sa.Column('taggers', sa.Integer(), nullable=False),
+                    sa.Column('majority', sa.Integer(), nullable=False),
+                    sa.Column('union', sa.Integer(), nullable=False),
+                    sa.Column('unanimous', sa.Integer(), nullable=False),
+                    sa.Column('agreement', sa.Float(), nullable=False),
+                    sa.Column('updated_at', sa.DateTime(), nullable=False),
+                    sa.PrimaryKeyConstraint('hash'))
+
+
+def downgrade():
+    op.drop_table('consensus')
@@ -0,0 +1,90 @@
+"""Baseline schema
+
+The tables of the original application. Databases created before
+migrations were tracked in the repository already have them; mark them with ``flask db stamp a1c0f5e2b7d4`` before
+running ``flask db upgrade``.
+
+Revision ID: a1c0f5e2b7d4
+Revises:
+Create Date: 2026-10-18 09:12:41.318204
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a1c0f5e2b7d4'
+down_revision = None
+branch_labels = None
+depends_on = None
+
+tag_labels = ['GISAXS', 'GIWAXS', 'SAXS', 'WAXS', 'AgB', 'Arc', 'Isotropic', 'Peaks', 'Ring', 'Rod',
+              'Crystalline', 'Featureless']
+
+
+def upgrade():
+    op.create_table('users',
+                    sa.Column('id', sa.Integer(), nullable=False),
+                    sa.Column('username', sa.String(length=80), nullable=False),
+                    sa.Column('email', sa.String(length=80), nullable=False),
+                    sa.Column('password', sa.LargeBinary(length=128), nullable=True),
+                    sa.Column('created_at', sa.DateTime(), nullable=False),
+                    sa.Column('first_name', sa.String(length=30), nullable=True),
+                    sa.Column('last_name', sa.String(length=30), nullable=True),
+                    sa.Column('active', sa.Boolean(), nullable=True),
+                    sa.Column('is_admin', sa.Boolean(), nullable=True),
+                    sa.PrimaryKeyConstraint('id'),
+                    sa.UniqueConstraint('email'),
+                    sa.UniqueConstraint('username'))
+    op.create_table('roles',
+                    sa.Column('id', sa.Integer(), nullable=False),
+                    sa.Column('name', sa.String(length=80), nullable=False),
+                    sa.Column('user_id', sa.Integer(), nullable=True),
+                    sa.ForeignKeyConstraint(['user_id'], ['users.id']),
+                    sa.PrimaryKeyConstraint('id'),
+                    sa.UniqueConstraint('name'))
+    op.create_table('tags',
+                    sa.Column('username', sa.Integer(), nullable=False),
+                    sa.Column('created_at', sa.DateTime(), nullable=False),
+                    sa.Column('path', sa.String(length=1000), nullable=False),
+                    sa.Column('hash', sa.String(length=40), nullable=False),
+                    sa.Column('id', sa.Integer(), nullable=False),
+                    *[sa.Column(label, sa.Boolean(), nullable=False) for label in tag_labels],
+                    sa.PrimaryKeyConstraint('id'),
+                    sa.UniqueConstraint('id'))
+    op.create_table('tomotags',
+                    sa.Column('username', sa.Integer(), nullable=False),
+                    sa.Column('created_at', sa.DateTime(), nullable=False),
+                    sa.Column('path', sa.String(length=1000), nullable=False),
+                    sa.Column('hash', sa.String(length=40), nullable=False),
+                    sa.Column('id', sa.Integer(), nullable=False),
+                    sa.Column('rating', sa.Integer(), nullable=False),
+                    sa.PrimaryKeyConstraint('id'),
+                    sa.UniqueConstraint('id'))
+    op.create_table('datafiles',
+                    sa.Column('hash', sa.String(length=40), nullable=False),
+                    sa.Column('path', sa.String(length=1000), nullable=False),
+                    sa.Column('tagged', sa.Integer(), nullable=False),
+                    sa.Column('username', sa.Integer(), nullable=False),
+                    sa.PrimaryKeyConstraint('hash'),
+                    sa.UniqueConstraint('hash'),
+                    sa.UniqueConstraint('path'))
+    op.create_table('tomodatafiles',
+                    sa.Column('hash', sa.String(length=40), nullable=False),
+                    sa.Column('path', sa.String(length=1000), nullable=False),
+                    sa.Column('tagged', sa.Integer(), nullable=False),
+                    sa.Column('username', sa.Integer(), nullable=False),
+                    sa.Column('groupid', sa.String(length=40), nullable=False),
+                    sa.Column('operation', sa.String(length=100), nullable=False),
+                    sa.Column('operationtype', sa.String(length=100), nullable=False),
+                    sa.Column('parameter', sa.String(length=100), nullable=False),
+                    sa.Column('value', sa.Float(), nullable=False),
+                    sa.PrimaryKeyConstraint('hash'),
+                    sa.UniqueConstraint('hash'),
+                    sa.UniqueConstraint('path'))
+
+
+def downgrade():
+    for table in ('tomodatafiles', 'datafiles', 'tomotags', 'tags', 'roles', 'users'):
+        op.drop_table(table)
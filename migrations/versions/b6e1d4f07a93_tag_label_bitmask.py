@@ -0,0 +1,34 @@
+"""Tag labels as one bitmask column
+
+Adds ``tags.labels`` and backfills it from the boolean label columns, with
+bit ``i`` for the ``i``-th label.
+
+Revision ID: b6e1d4f07a93
+Revises: 9d2f6b8a1e47
+Create Date: 2026-10-18 12:20:44.615830
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b6e1d4f07a93'
+down_revision = '9d2f6b8a1e47'
+branch_labels = None
+depends_on = None
+
+tag_labels = ['GISAXS', 'GIWAXS', 'SAXS', 'WAXS', 'AgB', 'Arc', 'Isotropic', 'Peaks', 'Ring', 'Rod',
+              'Crystalline', 'Featureless']
+
+
+def upgrade():
+    op.add_column('tags', sa.Column('labels', sa.Integer(), server_default='0', nullable=False))
+    tags = sa.table('tags', sa.column('labels', sa.Integer), *[sa.column(label, sa.Boolean) for label in tag_labels])
+    mask = sum(sa.case([(tags.c[label], 1 << bit)], else_=0) for bit, label in enumerate(tag_labels))
+    op.execute(tags.update().values(labels=mask))
+
+
+def downgrade():
+    with op.batch_alter_table('tags') as batch_op:
+        batch_op.drop_column('labels')
@@ -0,0 +1,42 @@
+"""Frame-addressed data files
+
+Adds ``datafiles.frame``, the index of a frame in an HDF5 container, and
+makes ``(path, frame)`` unique instead of ``path``.
+
+Revision ID: c4a7e2d91f58
+Revises: b6e1d4f07a93
+Create Date: 2026-10-18 14:02:17.381904
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c4a7e2d91f58'
+down_revision = 'b6e1d4f07a93'
+branch_labels = None
+depends_on = None
+
+# Names the unnamed unique constraint on path gets in batch mode, where SQLite tables are copied
+naming_convention = {'uq': 'uq_%(table_name)s_%(column_0_name)s'}
+
+
+def _path_constraint():
+    return 'datafiles_path_key' if op.get_bind().dialect.name == 'postgresql' else 'uq_datafiles_path'
+
+
+def upgrade():
+    with op.batch_alter_table('datafiles', naming_convention=naming_convention) as batch_op:
+        batch_op.add_column(sa.Column('frame', sa.Integer(), server_default='0', nullable=False))
+        batch_op.drop_constraint(_path_constraint(), type_='unique')
+        batch_op.create_unique_constraint('uq_datafiles_path_frame', ['path', 'frame'])
+
+
+def downgrade():
+    op.execute('DELETE FROM workqueue WHERE hash IN (SELECT hash FROM datafiles WHERE frame > 0)')
+    op.execute('DELETE FROM datafiles WHERE frame > 0')
+    with op.batch_alter_table('datafiles', naming_convention=naming_convention) as batch_op:
+        batch_op.drop_constraint('uq_datafiles_path_frame', type_='unique')
+        batch_op.create_unique_constraint(_path_constraint(), ['path'])
+        batch_op.drop_column('frame')
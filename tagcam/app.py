@@ -5,6 +5,7 @@ from flask import Flask, render_template
 from tagcam import commands, public, user
 from tagcam.extensions import bcrypt, cache, csrf_protect, db, debug_toolbar, login_manager, migrate, webpack
 from tagcam.settings import ProdConfig
+from tagcam.user.jobs import import_jobs
 
 
 def create_app(config_object=ProdConfig):
@@ -32,6 +33,7 @@ def register_extensions(app):
     debug_toolbar.init_app(app)
     migrate.init_app(app, db)
     webpack.init_app(app)
+    import_jobs.init_app(app)
     return None
 
 
@@ -71,3 +73,13 @@ def register_commands(app):
     app.cli.add_command(commands.lint)
     app.cli.add_command(commands.clean)
     app.cli.add_command(commands.urls)
+    app.cli.add_command(commands.render)
+    app.cli.add_command(commands.evict)
+    app.cli.add_command(commands.startup_profile)
+    app.cli.add_command(commands.rebuild_queue)
+    app.cli.add_command(commands.explain_hot_queries)
+    app.cli.add_command(commands.reconcile_stats)
+    app.cli.add_command(commands.export_dataset)
+    app.cli.add_command(commands.update_consensus)
+    app.cli.add_command(commands.bench)
+    app.cli.add_command(commands.loadtest)
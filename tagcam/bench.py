@@ -0,0 +1,256 @@
+# -*- coding: utf-8 -*-
+"""Benchmarks of import throughput, frame rendering and tag page latency.
+
+Run with ``flask bench``. Each run uses a scratch app with its own SQLite
+database and derivative directories in a temporary directory, and synthetic
+frames the size and dtype of real detectors, so results from different
+releases on the same machine can be compared. Three things are measured per
+detector:
+
+``import``
+    Throughput of :func:`tagcam.user.importer.import_datafiles` over a
+    directory of frames (decode, hash and insert; derivatives are not
+    pre-rendered), and of re-scanning it unchanged.
+``render``
+    Time and peak traced memory to decode a frame and write its derivatives
+    with :func:`tagcam.user.render.render_file`, the path the tag page takes
+    when a frame was not pre-rendered.
+``tag_page``
+    Latency of ``GET /users/tag/`` and of posting its form through WebTest:
+    first ``cold``, for a tagger shown frames nobody has rendered yet, then
+    ``warm``, for a second tagger once every frame has been rendered, as
+    after ``flask render``.
+
+NumPy, fabio and the app itself are imported by the functions that need
+them, so registering the command does not slow down app start-up.
+"""
+import datetime as dt
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+from subprocess import PIPE, run
+
+#: Benchmark cases: detector frame shape (rows, columns) and pixel dtype
+cases = {
+    'pilatus1m': ((1043, 981), 'int32'),
+    'pilatus1m-float32': ((1043, 981), 'float32'),
+    'eiger4m': ((2167, 2070), 'uint32'),
+    'eiger4m-uint16': ((2167, 2070), 'uint16'),
+}
+#: Module size (rows, columns) and gap (rows, columns) of the synthetic detectors
+module_shape = (195, 487)
+module_gap = (17, 7)
+
+
+def synthetic_frame(shape, dtype, seed=0):
+    """A scattering-like frame: rings on a decaying background with Poisson noise, and module gaps.
+
+    Gaps are -1 on signed and float detectors and saturate unsigned ones, as
+    Pilatus and Eiger write them.
+    """
+    import numpy as np
+
+    rng = np.random.RandomState(seed)
+    y, x = np.ogrid[:shape[0], :shape[1]]
+    r = np.hypot(y - shape[0] * .45, x - shape[1] * .55)
+    intensity = 2000 / (1 + r / 20)
+    for ring in (100, 200, 330):
+        intensity = intensity + 500 * np.exp(-(r - ring) ** 2 / 20)
+    data = rng.poisson(intensity).astype(dtype)
+
+    gap = np.iinfo(data.dtype).max if data.dtype.kind == 'u' else -1
+    for axis in (0, 1):
+        period = module_shape[axis] + module_gap[axis]
+        for start in range(module_shape[axis], shape[axis], period):
+            index = [slice(None), slice(None)]
+            index[axis] = slice(start, start + module_gap[axis])
+            data[tuple(index)] = gap
+    return data
+
+
+def write_frames(directory, data, count):
+    """Write count distinct EDF copies of a frame into directory.
+
+    :return: Their paths.
+    """
+    import fabio
+
+    os.makedirs(directory, exist_ok=True)
+    paths = []
+    for i in range(count):
+        frame = data.copy()
+        frame[0, 0] = i  # Distinct hashes
+        path = os.path.join(directory, f'frame_{i:05d}.edf')
+        fabio.edfimage.EdfImage(data=frame).write(path)
+        paths.append(path)
+    return paths
+
+
+def summarize(seconds):
+    """Summary statistics of some timings, in seconds."""
+    import numpy as np
+
+    seconds = np.asarray(seconds, dtype=np.float64)
+    if not len(seconds):
+        return dict(n=0)
+    p50, p95, p99 = np.percentile(seconds, [50, 95, 99]).tolist()
+    return dict(n=len(seconds), mean=float(seconds.mean()), p50=p50, p95=p95, p99=p99, max=float(seconds.max()))
+
+
+def bench_import(root, username, workers):
+    """Import a directory of frames, then re-scan it unchanged."""
+    from tagcam.user.importer import import_datafiles
+
+    size = sum(os.path.getsize(os.path.join(root, name)) for name in os.listdir(root))
+    stats = import_datafiles(root, username, workers=workers)
+    rescan = import_datafiles(root, username, workers=workers)
+    return dict(frames=stats.decoded, bytes=size, seconds=stats.elapsed,
+                frames_per_second=stats.decoded / stats.elapsed,
+                megabytes_per_second=size / 2 ** 20 / stats.elapsed,
+                rescan_seconds=rescan.elapsed, rescan_files_per_second=rescan.files_per_second)
+
+
+def bench_render(path, store, repeat):
+    """Render one frame file repeat times under fresh hashes, then once more tracing memory."""
+    from tagcam.user.render import render_file
+
+    seconds = []
+    for i in range(repeat):
+        started = time.perf_counter()
+        render_file((f'{i:040x}', path, 0), store)
+        seconds.append(time.perf_counter() - started)
+
+    tracemalloc.start()
+    try:
+        render_file((f'{repeat:040x}', path, 0), store)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return dict(seconds=summarize(seconds), peak_megabytes=peak / 2 ** 20)
+
+
+def bench_tagger(testapp, user, requests):
+    """Time GET and POST of the tag page for a user, tagging one frame per round trip."""
+    from flask import url_for
+
+    form = testapp.get('/').forms['loginForm']
+    form['username'] = user.username
+    form['password'] = 'bench'
+    form.submit().follow()
+
+    get, post = [], []
+    for _ in range(requests):
+        started = time.perf_counter()
+        res = testapp.get(url_for('user.tag'))
+        get.append(time.perf_counter() - started)
+        form = res.forms['tagForm']
+        if not form['hash'].value:
+            break  # Nothing left to tag
+        form['Ring'] = True
+        started = time.perf_counter()
+        form.submit()
+        post.append(time.perf_counter() - started)
+    testapp.get(url_for('public.logout'))
+    return dict(get=summarize(get), post=summarize(post))
+
+
+def bench_config(workdir, workers):
+    """A configuration for a scratch app in workdir."""
+    from tagcam.settings import TestConfig
+
+    class BenchConfig(TestConfig):
+        DEBUG = False
+        SQLALCHEMY_DATABASE_URI = 'sqlite:///{}'.format(os.path.join(workdir, 'bench.db'))
+        PREVIEW_DIR = os.path.join(workdir, 'static')
+        TRAINING_DIR = os.path.join(workdir, 'training')
+        IMPORT_WORKERS = workers
+        WTF_CSRF_ENABLED = True
+
+    return BenchConfig
+
+
+def run_case(name, frames, repeat, requests, workers, workdir):
+    """Run every benchmark of one case in a scratch app.
+
+    :return: The results of the case.
+    """
+    from webtest import TestApp
+
+    from tagcam.app import create_app
+    from tagcam.database import db
+    from tagcam.user.derivatives import DerivativeStore
+    from tagcam.user.models import DataFile
+    from tagcam.user.render import render_file
+    from tests.factories import UserFactory
+
+    shape, dtype = cases[name]
+    app = create_app(bench_config(workdir, workers))
+    with app.test_request_context():
+        db.create_all()
+        taggers = [UserFactory(password='bench') for _ in range(2)]
+        db.session.commit()
+
+        data = synthetic_frame(shape, dtype)
+        paths = write_frames(os.path.join(workdir, 'frames'), data, max(frames, requests))
+        results = dict(shape=list(shape), dtype=dtype, frame_bytes=data.nbytes)
+        scratch = os.path.join(workdir, 'render')
+        results['render'] = bench_render(paths[0], DerivativeStore(scratch, scratch), repeat)
+        results['import'] = bench_import(os.path.dirname(paths[0]), taggers[0].id, workers)
+
+        testapp = TestApp(app)
+        cold = bench_tagger(testapp, taggers[0], requests)
+        store = DerivativeStore.from_config(app.config)
+        for datafile in DataFile.query:
+            render_file(datafile.item, store)
+        warm = bench_tagger(testapp, taggers[1], requests)
+        results['tag_page'] = dict(cold=cold, warm=warm)
+        db.session.remove()
+        db.drop_all()
+    return results
+
+
+def git_revision():
+    """The checked out commit, or None outside a git checkout."""
+    try:
+        result = run(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(__file__), stdout=PIPE, stderr=PIPE,
+                     universal_newlines=True)
+    except OSError:
+        return None
+    return result.stdout.strip() or None
+
+
+def run_suite(names, frames=10, repeat=5, requests=10, workers=0, progress=None):
+    """Run the benchmarks of some cases, each in a fresh scratch directory.
+
+    :param names: Keys of :data:`cases`.
+    :param frames: Frames imported per case.
+    :param repeat: Renders timed per case.
+    :param requests: Tag page round trips timed per tagger.
+    :param workers: Import processes.
+    :param progress: Optional callable taking the name of each case as it starts.
+    :return: The results, as a JSON-serializable dict.
+    """
+    import numpy as np
+
+    unknown = set(names) - set(cases)
+    if unknown:
+        raise ValueError('Unknown benchmark cases: {}'.format(', '.join(sorted(unknown))))
+
+    results = dict(created_at=dt.datetime.utcnow().isoformat(), revision=git_revision(),
+                   python=sys.version.split()[0], numpy=np.__version__, platform=platform.platform(),
+                   cpus=os.cpu_count(), settings=dict(frames=frames, repeat=repeat, requests=requests,
+                                                      workers=workers),
+                   cases={})
+    for name in names:
+        if progress:
+            progress(name)
+        workdir = tempfile.mkdtemp(prefix=f'tagcam-bench-{name}-')
+        try:
+            results['cases'][name] = run_case(name, frames, repeat, requests, workers, workdir)
+        finally:
+            shutil.rmtree(workdir, ignore_errors=True)
+    return results
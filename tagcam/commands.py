@@ -124,3 +124,300 @@ def urls(url, order):
 
     for row in rows:
         click.echo(str_template.format(*row[:column_length]))
+
+
+@click.command()
+@click.option('-w', '--workers', default=None, type=int,
+              help='Render processes (default: IMPORT_WORKERS)')
+@click.option('--all', 'render_all', default=False, is_flag=True,
+              help='Also render files that are already fully tagged')
+@with_appcontext
+def render(workers, render_all):
+    """Pre-render missing previews and training derivatives of imported data files."""
+    from functools import partial
+
+    from tagcam.user.derivatives import DerivativeStore
+    from tagcam.user.importer import bounded_map
+    from tagcam.user.models import DataFile, db
+    from tagcam.user.render import render_file
+
+    query = db.session.query(DataFile.hash, DataFile.path, DataFile.frame)
+    if not render_all:
+        query = query.filter(DataFile.tagged < 2)
+    workers = current_app.config['IMPORT_WORKERS'] if workers is None else workers
+    renderer = partial(render_file, store=DerivativeStore.from_config(current_app.config))
+
+    rendered = failed = 0
+    for datahash, written in bounded_map(renderer, (tuple(row) for row in query.yield_per(1000)), workers):
+        if written is None:
+            failed += 1
+            click.echo('Could not render {}'.format(datahash), err=True)
+        elif written:
+            rendered += 1
+    click.echo('Rendered {} data files; {} failed.'.format(rendered, failed))
+
+
+@click.command()
+@click.option('-b', '--budget', default=None, type=int,
+              help='Preview and tile budget in bytes (default: PREVIEW_BUDGET_BYTES)')
+@with_appcontext
+def evict(budget):
+    """Evict least recently used previews and zoom tiles down to the budget."""
+    from tagcam.user.derivatives import DerivativeStore
+
+    budget = current_app.config['PREVIEW_BUDGET_BYTES'] if budget is None else budget
+    if not budget:
+        click.echo('No preview budget configured.')
+        return
+    evicted, freed = DerivativeStore.from_config(current_app.config).evict(budget)
+    click.echo('Evicted the previews or tiles of {} frames, freeing {} bytes.'.format(evicted, freed))
+
+
+@click.command('startup-profile')
+@click.option('-n', '--top', default=25, help='Number of packages to show')
+@click.option('-c', '--config', default='tagcam.settings.ProdConfig',
+              help='Config object to create the app with')
+def startup_profile(top, config):
+    """Break down the import cost of creating the app, per top-level package.
+
+    Runs ``create_app`` in a fresh interpreter with ``-X importtime``, as a
+    newly forked server worker would.
+    """
+    import sys
+    from collections import defaultdict
+    from subprocess import PIPE, run
+    from time import monotonic
+
+    module, name = config.rsplit('.', 1)
+    script = ('import time; t = time.monotonic(); '
+              'from {} import {}; from tagcam.app import create_app; create_app({}); '
+              'print(time.monotonic() - t)').format(module, name, name)
+    started = monotonic()
+    result = run([sys.executable, '-X', 'importtime', '-c', script],
+                 cwd=PROJECT_ROOT, stdout=PIPE, stderr=PIPE, universal_newlines=True)
+    wall = monotonic() - started
+    if result.returncode:
+        click.echo(result.stderr, err=True)
+        sys.exit(result.returncode)
+
+    # Lines look like "import time:   self [us] | cumulative | imported package"
+    self_us = defaultdict(int)
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        fields = line[len('import time:'):].split('|')
+        self_us[fields[2].strip().split('.')[0]] += int(fields[0])
+
+    total = sum(self_us.values())
+    click.echo('{:30}  {:>10}  {:>6}'.format('Package', 'Import ms', '%'))
+    click.echo('-' * 50)
+    for package, us in sorted(self_us.items(), key=lambda item: -item[1])[:top]:
+        click.echo('{:30}  {:>10.1f}  {:>6.1f}'.format(package, us / 1000, 100 * us / total))
+    click.echo('-' * 50)
+    click.echo('Imports: {:.1f} ms; create_app: {:.1f} ms; interpreter total: {:.1f} ms'.format(
+        total / 1000, float(result.stdout.split()[-1]) * 1000, wall * 1000))
+
+
+@click.command('rebuild-queue')
+@with_appcontext
+def rebuild_queue():
+    """Refill the tagging work queue from the data files that need more tags."""
+    from tagcam.user import workqueue
+
+    click.echo('Queued {} data files.'.format(workqueue.rebuild()))
+
+
+@click.command('reconcile-stats')
+@with_appcontext
+def reconcile_stats():
+    """Correct the tagging statistics from the tags and datafiles tables.
+
+    Server processes also do this every ``STATS_RECONCILE_SECONDS``.
+    """
+    from tagcam.user import stats, workqueue
+
+    corrected = stats.reconcile(workqueue.tags_per_file)
+    snapshot = stats.snapshot()
+    click.echo('Corrected {} counters: {tags} tags, {datafiles} data files, {remaining} needing tags.'
+               .format(corrected, **snapshot))
+
+
+@click.command('export-dataset')
+@click.argument('output', type=click.Path(file_okay=False))
+@click.option('-s', '--size', default=256, type=click.Choice(['256', '128']),
+              help='Training derivative size to export')
+@click.option('--shard-size', default=1024, help='Images per shard')
+@click.option('--min-tags', default=None, type=int,
+              help='Only export images with this many tags (default: fully tagged)')
+@with_appcontext
+def export_dataset(output, size, shard_size, min_tags):
+    """Export tagged images and label votes as sharded arrays, resuming a partial export."""
+    from tagcam.user import workqueue
+    from tagcam.user.derivatives import DerivativeStore
+    from tagcam.user.export import export_dataset as export
+
+    def progress(stats):
+        click.echo('Wrote shard {}; {} images exported.'.format(stats.shards - 1, stats.exported))
+
+    stats = export(output, DerivativeStore.from_config(current_app.config), size=int(size), shard_size=shard_size,
+                   min_tags=workqueue.tags_per_file if min_tags is None else min_tags, progress=progress)
+    if stats.resumed_shards:
+        click.echo('Resumed after {} existing shards.'.format(stats.resumed_shards))
+    click.echo('Exported {} images in {} shards; {} had no training derivative.'.format(
+        stats.exported, stats.shards, stats.missing))
+
+
+@click.command('update-consensus')
+@with_appcontext
+def update_consensus():
+    """Recompute the consensus labels of data files with new tags."""
+    from tagcam.user import consensus
+
+    click.echo('Updated the consensus of {} data files.'.format(consensus.update()))
+    click.echo('Agreement between taggers, by label:')
+    for label, agreement in consensus.label_agreement().items():
+        click.echo('  {:15} {}'.format(label, '-' if agreement is None else '{:.1%}'.format(agreement)))
+
+
+@click.command()
+@click.option('-o', '--output', default='bench.json', type=click.Path(dir_okay=False),
+              help='JSON file to write the results to')
+@click.option('-c', '--case', 'names', multiple=True,
+              help='Detector to benchmark, repeatable (default: all of pilatus1m, pilatus1m-float32, '
+                   'eiger4m, eiger4m-uint16)')
+@click.option('-n', '--frames', default=10, type=click.IntRange(1), help='Frames imported per detector')
+@click.option('-r', '--repeat', default=5, type=click.IntRange(1), help='Renders timed per detector')
+@click.option('--requests', default=10, type=click.IntRange(1), help='Tag page round trips timed per tagger')
+@click.option('-w', '--workers', default=None, type=int,
+              help='Import processes (default: IMPORT_WORKERS)')
+@with_appcontext
+def bench(output, names, frames, repeat, requests, workers):
+    """Benchmark import throughput, frame rendering and tag page latency on synthetic detector frames.
+
+    Every detector is benchmarked in a scratch app with its own SQLite
+    database in a temporary directory; the configured database is not used.
+    """
+    import json
+
+    from tagcam.bench import cases, run_suite
+
+    workers = current_app.config['IMPORT_WORKERS'] if workers is None else workers
+    try:
+        results = run_suite(names or list(cases), frames=frames, repeat=repeat, requests=requests, workers=workers,
+                            progress=lambda name: click.echo('Benchmarking {}...'.format(name)))
+    except ValueError as e:
+        raise click.BadParameter(str(e), param_hint='--case')
+
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=2)
+    for name, case in results['cases'].items():
+        click.echo('{}: import {:.1f} frames/s, render p50 {:.0f} ms ({:.0f} MB peak), '
+                   'tag page GET p50 {:.0f} ms cold / {:.0f} ms warm'.format(
+                       name, case['import']['frames_per_second'], case['render']['seconds']['p50'] * 1000,
+                       case['render']['peak_megabytes'], case['tag_page']['cold']['get']['p50'] * 1000,
+                       case['tag_page']['warm']['get']['p50'] * 1000))
+    click.echo('Wrote {}.'.format(output))
+
+
+@click.command()
+@click.option('-g', '--gunicorn', 'configs', multiple=True, default=['1x1', '2x4', '4x4'], show_default=True,
+              help='Gunicorn WORKERSxTHREADS to run the scenario against, repeatable')
+@click.option('-u', '--users', default=30, type=click.IntRange(1), help='Simulated taggers')
+@click.option('-d', '--duration', default=60., help='Seconds each scenario runs')
+@click.option('--think', default=0., help='Mean seconds a tagger waits between images')
+@click.option('--frames', default=500, type=click.IntRange(1), help='Frames seeded per scenario')
+@click.option('--database', default=None,
+              help='SQLAlchemy URI of an empty scratch database, e.g. a local PostgreSQL; '
+                   'its tables are dropped afterwards (default: SQLite in a temporary directory)')
+@click.option('-o', '--output', default=None, type=click.Path(dir_okay=False),
+              help='JSON file to write the results to')
+def loadtest(configs, users, duration, think, frames, database, output):
+    """Simulate many taggers on the tag page against gunicorn, and check the counters afterwards."""
+    import json
+
+    from tagcam.loadtest import parse_config, run_scenario
+
+    for config in configs:
+        try:
+            parse_config(config)
+        except ValueError as e:
+            raise click.BadParameter(str(e), param_hint='--gunicorn')
+
+    results = []
+    for config in configs:
+        result = run_scenario(config, users=users, duration=duration, frames=frames, think=think,
+                              database_uri=database, progress=click.echo)
+        results.append(result)
+        consistency = result['consistency']
+        click.echo('{config}: {requests_per_second:.1f} req/s, {tags_per_second:.1f} tags/s, '
+                   'errors {error_rate:.2%}'.format(**result))
+        for kind, latency in result['latency'].items():
+            if latency['n']:
+                click.echo('  {:10} p50 {:7.1f} ms  p95 {:7.1f} ms  p99 {:7.1f} ms  ({} errors)'.format(
+                    kind, latency['p50'] * 1000, latency['p95'] * 1000, latency['p99'] * 1000, latency['errors']))
+        click.echo('  {} tags posted, {} recorded; counters {}'.format(
+            consistency['tags_posted'], consistency['tags_recorded'],
+            'consistent' if consistency['consistent'] else 'INCONSISTENT: {}'.format(
+                json.dumps({key: consistency[key] for key in ('tagged_mismatches', 'queue_stale', 'counter_drift')}))))
+
+    if output:
+        with open(output, 'w') as f:
+            json.dump(results, f, indent=2)
+        click.echo('Wrote {}.'.format(output))
+
+
+def hot_queries():
+    """The queries on the tagging and import hot paths, by name."""
+    import datetime as dt
+
+    from sqlalchemy import and_, func, or_
+    from sqlalchemy.sql import exists
+
+    from tagcam.user.models import DataFile, ImportManifest, Tag, TomoDataFile, WorkItem, db
+
+    now = dt.datetime.utcnow()
+    username = 1
+    datahash = '0' * 40
+    available = or_(WorkItem.lease_expires.is_(None), WorkItem.lease_expires < now)
+    tagged_by_user = exists().where(and_(Tag.hash == WorkItem.hash, Tag.username == username))
+    return [
+        ('work queue dequeue',
+         db.session.query(WorkItem.hash).filter(available, ~tagged_by_user).order_by(WorkItem.position).limit(10)),
+        ('held leases',
+         db.session.query(WorkItem.hash).filter(WorkItem.lease_user == username, WorkItem.lease_expires >= now)),
+        ('import duplicate check',
+         db.session.query(DataFile.hash).filter(DataFile.hash.in_([datahash, '1' * 40]))),
+        ('import manifest lookup',
+         db.session.query(ImportManifest.path).join(DataFile, DataFile.hash == ImportManifest.hash)
+         .filter(ImportManifest.kind == 'data', ImportManifest.path.in_(['/a', '/b']))),
+        ('tags of a file',
+         db.session.query(Tag.id).filter(Tag.hash == datahash)),
+        ('tags by user',
+         db.session.query(func.count(Tag.id)).filter(Tag.username == username)),
+        ('under-tagged files',
+         db.session.query(DataFile.hash).filter(DataFile.tagged < 2)),
+        ('under-tagged tomo group',
+         db.session.query(TomoDataFile.groupid).filter(TomoDataFile.tagged < 2).limit(1)),
+        ('tomo group members',
+         db.session.query(TomoDataFile.hash).filter(TomoDataFile.groupid == datahash)),
+    ]
+
+
+@click.command('explain-hot-queries')
+@with_appcontext
+def explain_hot_queries():
+    """Print the database's query plan for each hot query, to check indexes are used."""
+    from tagcam.user.models import db
+
+    dialect = db.engine.dialect
+    prefix = {'sqlite': 'EXPLAIN QUERY PLAN ', 'postgresql': 'EXPLAIN '}.get(dialect.name, 'EXPLAIN ')
+    for name, query in hot_queries():
+        compiled = query.statement.compile(dialect=dialect)
+        if compiled.positional:
+            params = tuple(compiled.params[key] for key in compiled.positiontup)
+        else:
+            params = compiled.params
+        click.echo('== {} ==\n{}'.format(name, compiled))
+        for row in db.engine.execute(prefix + str(compiled), params):
+            click.echo('  ' + ' | '.join(str(column) for column in row))
+        click.echo('')
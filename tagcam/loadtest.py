@@ -0,0 +1,356 @@
+# -*- coding: utf-8 -*-
+"""Load simulation of a labelling sprint: many taggers on the tag page at once.
+
+Run with ``flask loadtest``. For every gunicorn configuration a fresh
+scratch database (SQLite in a temporary directory, or an empty local
+PostgreSQL) is seeded with users and imported synthetic frames, the app is
+started under gunicorn with that many workers and threads, and each
+simulated tagger logs in through the home page and then loops: load
+``/users/tag/``, fetch the preview it shows, post tags for it. Once the
+server has stopped, the database is checked for consistency:
+
+``tags_posted`` and ``tags_recorded``
+    Tag form posts that were accepted, and tags in the database.
+``tagged_mismatches``
+    Data files whose tag counter differs from their number of tags.
+``queue_stale``
+    Work queue items for data files that already have all their tags.
+``counter_drift``
+    Statistics counters that disagree with the tags and datafiles tables,
+    as reported by :func:`tagcam.user.stats.drift`.
+
+The clients are threads speaking plain HTTP through :mod:`urllib`, so the
+harness needs nothing beyond gunicorn.
+"""
+import html
+import os
+import random
+import re
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import time
+from collections import deque
+from http.cookiejar import CookieJar
+from subprocess import STDOUT, Popen, TimeoutExpired
+from urllib.error import HTTPError, URLError
+from urllib.parse import urlencode
+from urllib.request import HTTPCookieProcessor, HTTPRedirectHandler, build_opener
+
+password = 'loadtest'
+input_pattern = re.compile(r'<input\b([^>]*)>')
+attribute_pattern = re.compile(r'([\w-]+)="([^"]*)"')
+image_pattern = re.compile(r'<img src="([^"]+\.jpg)"')
+config_pattern = re.compile(r'^(\d+)x(\d+)$')
+#: Environment variables telling :mod:`tagcam.loadtest_app` where the scenario's database and files are
+directory_variable = 'TAGCAM_LOADTEST_DIR'
+database_variable = 'TAGCAM_LOADTEST_DATABASE_URI'
+
+
+def server_config(workdir, database_uri):
+    """The configuration of the app under load, with its files in workdir."""
+    from tagcam.settings import ProdConfig
+
+    class LoadTestConfig(ProdConfig):
+        SQLALCHEMY_DATABASE_URI = database_uri
+        PREVIEW_DIR = os.path.join(workdir, 'static')
+        TRAINING_DIR = os.path.join(workdir, 'training')
+        BCRYPT_LOG_ROUNDS = 4  # Logins are not what is being measured
+        IMPORT_WORKERS = 0
+        IMPORT_JOB_WORKERS = 0
+        IMPORT_JOB_RESUME = False
+        STATS_RECONCILE_SECONDS = None  # Drift is what the consistency check looks for
+
+    return LoadTestConfig
+
+
+def parse_config(config):
+    """Parse a ``WORKERSxTHREADS`` gunicorn configuration.
+
+    :raises ValueError: If it is malformed.
+    """
+    match = config_pattern.match(config)
+    if not match or not all(int(group) for group in match.groups()):
+        raise ValueError(f'Expected WORKERSxTHREADS, like 4x2, not {config!r}')
+    return int(match.group(1)), int(match.group(2))
+
+
+def hidden_fields(page, form_id):
+    """The hidden inputs of a form in a page, by name."""
+    start = page.find(f'id="{form_id}"')
+    if start < 0:
+        return {}
+    form = page[start:page.find('</form>', start)]
+    fields = {}
+    for attributes in input_pattern.findall(form):
+        attributes = dict(attribute_pattern.findall(attributes))
+        if attributes.get('type') == 'hidden' and 'name' in attributes:
+            fields[attributes['name']] = html.unescape(attributes.get('value', ''))
+    return fields
+
+
+class _NoRedirect(HTTPRedirectHandler):
+    """Report redirects instead of following them, so each request is timed on its own."""
+
+    def redirect_request(self, *args, **kwargs):
+        return None
+
+
+class Recorder(object):
+    """Latencies and failures of the requests of all taggers."""
+
+    def __init__(self):
+        """Create instance."""
+        self.lock = threading.Lock()
+        self.seconds = {}
+        self.errors = {}
+        self.tags_posted = 0
+        self.exhausted = 0
+
+    def record(self, kind, seconds, ok):
+        """Record one request."""
+        with self.lock:
+            self.seconds.setdefault(kind, []).append(seconds)
+            if not ok:
+                self.errors[kind] = self.errors.get(kind, 0) + 1
+
+    def as_dict(self, elapsed):
+        """Summarize the requests of a run that took elapsed seconds."""
+        from tagcam.bench import summarize
+
+        requests = sum(len(seconds) for seconds in self.seconds.values())
+        errors = sum(self.errors.values())
+        return dict(elapsed=elapsed, requests=requests, errors=errors,
+                    error_rate=errors / requests if requests else 0.,
+                    requests_per_second=requests / elapsed, tags_per_second=self.tags_posted / elapsed,
+                    tags_posted=self.tags_posted, exhausted_taggers=self.exhausted,
+                    latency={kind: dict(summarize(seconds), errors=self.errors.get(kind, 0))
+                             for kind, seconds in sorted(self.seconds.items())})
+
+
+class Tagger(object):
+    """A simulated tagger with its own cookie jar."""
+
+    def __init__(self, base_url, username, recorder, timeout=30):
+        """Create instance."""
+        self.base_url = base_url
+        self.username = username
+        self.recorder = recorder
+        self.timeout = timeout
+        self.opener = build_opener(HTTPCookieProcessor(CookieJar()), _NoRedirect())
+
+    def request(self, kind, path, data=None, expect=200):
+        """Send a request and record its latency.
+
+        :return: ``(status, body)``; status is None if the request failed to complete.
+        """
+        body = None if data is None else urlencode(data).encode()
+        started = time.perf_counter()
+        try:
+            with self.opener.open(self.base_url + path, body, self.timeout) as response:
+                status, page = response.status, response.read()
+        except HTTPError as e:
+            status, page = e.code, e.read()
+        except (URLError, OSError):
+            status, page = None, b''
+        self.recorder.record(kind, time.perf_counter() - started, status == expect)
+        return status, page.decode('utf-8', 'replace')
+
+    def login(self):
+        """Log in through the navbar form of the home page; return whether it worked."""
+        _, page = self.request('home', '/')
+        fields = dict(hidden_fields(page, 'loginForm'), username=self.username, password=password)
+        status, _ = self.request('login', '/', fields, expect=302)
+        return status == 302
+
+    def run(self, deadline, think=0.):
+        """Tag images until deadline, a :func:`time.monotonic` time."""
+        from tagcam.user.models import Tag
+
+        if not self.login():
+            return
+        labels = list(Tag.tags)
+        while time.monotonic() < deadline:
+            status, page = self.request('tag_get', '/users/tag/')
+            fields = hidden_fields(page, 'tagForm')
+            if status == 200 and not fields.get('hash'):
+                with self.recorder.lock:
+                    self.recorder.exhausted += 1
+                return
+            image = image_pattern.search(page)
+            if image:
+                self.request('preview', html.unescape(image.group(1)))
+            if 'hash' in fields:
+                fields.update({label: 'y' for label in random.sample(labels, random.randint(1, 2))})
+                status, _ = self.request('tag_post', '/users/tag/', fields, expect=302)
+                if status == 302:
+                    with self.recorder.lock:
+                        self.recorder.tags_posted += 1
+            if think:
+                time.sleep(random.uniform(0, 2 * think))
+
+
+def run_taggers(base_url, usernames, duration, think=0.):
+    """Run one thread per tagger for duration seconds.
+
+    :return: The :class:`Recorder` and the elapsed seconds.
+    """
+    recorder = Recorder()
+    deadline = time.monotonic() + duration
+    threads = [threading.Thread(target=Tagger(base_url, username, recorder).run, args=(deadline, think))
+               for username in usernames]
+    started = time.monotonic()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return recorder, time.monotonic() - started
+
+
+def seed(workdir, users, frames, frame_size):
+    """Create the taggers and import synthetic frames, pre-rendered as an import job would.
+
+    :return: The taggers' usernames.
+    :raises RuntimeError: If the database already has users.
+    """
+    from tagcam.bench import synthetic_frame, write_frames
+    from tagcam.database import db
+    from tagcam.user.derivatives import DerivativeStore
+    from tagcam.user.importer import import_datafiles
+    from tagcam.user.models import User
+
+    db.create_all()
+    if User.query.count():
+        raise RuntimeError('The load test database must be empty')
+    usernames = [f'loadtest{i}' for i in range(users)]
+    db.session.bulk_save_objects([User(username, f'{username}@example.com', password, active=True)
+                                  for username in usernames])
+    db.session.commit()
+
+    root = os.path.join(workdir, 'frames')
+    write_frames(root, synthetic_frame((frame_size, frame_size), 'int32'), frames)
+    import_datafiles(root, User.query.first().id, workers=0,
+                     store=DerivativeStore(os.path.join(workdir, 'static'), os.path.join(workdir, 'training')))
+    return usernames
+
+
+def check_consistency(tags_posted):
+    """Check the database after a run; see the module docstring."""
+    from sqlalchemy import func
+
+    from tagcam.database import db
+    from tagcam.user import stats, workqueue
+    from tagcam.user.models import DataFile, Tag, WorkItem
+
+    counts = (db.session.query(Tag.hash, func.count(Tag.id).label('tags')).group_by(Tag.hash).subquery())
+    mismatches = (db.session.query(func.count(DataFile.hash))
+                  .outerjoin(counts, counts.c.hash == DataFile.hash)
+                  .filter(DataFile.tagged != func.coalesce(counts.c.tags, 0)).scalar())
+    stale = (db.session.query(func.count(WorkItem.hash))
+             .join(DataFile, DataFile.hash == WorkItem.hash)
+             .filter(DataFile.tagged >= workqueue.tags_per_file).scalar())
+    drift = stats.drift(workqueue.tags_per_file)
+    recorded = db.session.query(func.count(Tag.id)).scalar()
+    return dict(tags_posted=tags_posted, tags_recorded=recorded, tagged_mismatches=mismatches, queue_stale=stale,
+                counter_drift={name: list(values) for name, values in drift.items()},
+                consistent=not (mismatches or stale or drift))
+
+
+def free_port():
+    """A TCP port nothing is listening on."""
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def start_server(workers, threads, port, env, log):
+    """Start gunicorn serving :mod:`tagcam.loadtest_app` and wait until it answers.
+
+    :raises RuntimeError: If it does not come up within a minute, with the end of its log.
+    """
+    from tagcam.commands import PROJECT_ROOT
+
+    process = Popen([sys.executable, '-m', 'gunicorn', '--workers', str(workers), '--threads', str(threads),
+                     '--bind', f'127.0.0.1:{port}', '--chdir', PROJECT_ROOT, 'tagcam.loadtest_app:app'],
+                    env=env, stdout=log, stderr=STDOUT)
+    deadline = time.monotonic() + 60
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            break
+        try:
+            with socket.create_connection(('127.0.0.1', port), timeout=1):
+                return process
+        except OSError:
+            time.sleep(.2)
+    stop_server(process)
+    log.flush()
+    raise RuntimeError('gunicorn did not start:\n' + log_tail(log.name))
+
+
+def log_tail(path, lines=20):
+    """Return the last lines of a log file; the work directory holding it is deleted afterwards."""
+    with open(path, errors='replace') as f:
+        return ''.join(deque(f, lines))
+
+
+def stop_server(process):
+    """Stop gunicorn, gracefully if it lets us."""
+    process.terminate()
+    try:
+        process.wait(30)
+    except TimeoutExpired:
+        process.kill()
+        process.wait()
+
+
+def run_scenario(config, users=30, duration=60., frames=500, frame_size=256, think=0., database_uri=None,
+                 progress=None):
+    """Run the tagging scenario against gunicorn with one ``WORKERSxTHREADS`` configuration.
+
+    :param database_uri: An empty scratch database; its tables are dropped
+        afterwards. A SQLite database in a temporary directory by default.
+    :param progress: Optional callable taking a status message.
+    :return: The results of the run, as a JSON-serializable dict.
+    """
+    from tagcam.app import create_app
+    from tagcam.database import db
+
+    workers, threads = parse_config(config)
+    workdir = tempfile.mkdtemp(prefix=f'tagcam-loadtest-{config}-')
+    database_uri = database_uri or 'sqlite:///{}'.format(os.path.join(workdir, 'loadtest.db'))
+    app = create_app(server_config(workdir, database_uri))
+    env = dict(os.environ, **{directory_variable: workdir, database_variable: database_uri})
+    seeded = False
+    try:
+        with app.app_context():
+            if progress:
+                progress(f'{config}: seeding {users} taggers and {frames} frames')
+            usernames = seed(workdir, users, frames, frame_size)
+            seeded = True
+            db.session.remove()
+            db.engine.dispose()  # Leave the database to the server
+
+        port = free_port()
+        with open(os.path.join(workdir, 'gunicorn.log'), 'w') as log:
+            process = start_server(workers, threads, port, env, log)
+            try:
+                if progress:
+                    progress(f'{config}: {users} taggers for {duration:g} s')
+                recorder, elapsed = run_taggers(f'http://127.0.0.1:{port}', usernames, duration, think)
+            finally:
+                stop_server(process)
+
+        with app.app_context():
+            results = dict(config=config, workers=workers, threads=threads, users=users,
+                           database=db.engine.dialect.name, **recorder.as_dict(elapsed))
+            results['consistency'] = check_consistency(recorder.tags_posted)
+        return results
+    finally:
+        if seeded:
+            with app.app_context():
+                db.session.remove()
+                db.drop_all()
+                db.engine.dispose()
+        shutil.rmtree(workdir, ignore_errors=True)
@@ -0,0 +1,8 @@
+# -*- coding: utf-8 -*-
+"""The app gunicorn serves during ``flask loadtest``, configured from the environment the harness sets."""
+import os
+
+from tagcam.app import create_app
+from tagcam.loadtest import database_variable, directory_variable, server_config
+
+app = create_app(server_config(os.environ[directory_variable], os.environ[database_variable]))
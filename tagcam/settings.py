@@ -15,6 +15,28 @@ class Config(object):
     CACHE_TYPE = 'simple'  # Can be "memcached", "redis", etc.
     SQLALCHEMY_TRACK_MODIFICATIONS = False
     WEBPACK_MANIFEST_PATH = 'webpack/manifest.json'
+    PREVIEW_DIR = os.path.join(APP_DIR, 'static')  # Colormapped JPEG previews, served as static files
+    TRAINING_DIR = os.path.join(PROJECT_ROOT, 'training')  # Resized TIFFs for ML training
+    PREVIEW_BUDGET_BYTES = 10 * 2 ** 30  # Evict previews and tiles beyond this, fully tagged first; None keeps all
+    PREVIEW_CACHE_SECONDS = 365 * 24 * 3600  # Previews are named by content hash, so browsers may keep them
+    PREVIEW_OFFLOAD = None  # 'x-sendfile' (Apache, lighttpd) or 'x-accel-redirect' (nginx) to let the proxy send bytes
+    PREVIEW_ACCEL_PREFIX = '/_previews/'  # Internal nginx location aliased to PREVIEW_DIR, for x-accel-redirect
+    TAG_LEASE_SECONDS = 600  # How long a tagger holds an image before it is offered to someone else
+    TAG_API_MAX_BATCH = 50  # Most images leased by one work API call
+    TAG_PREFETCH = 3  # Upcoming previews the tag page preloads
+    STATS_CACHE_SECONDS = 30  # How long the statistics page serves a cached snapshot
+    STATS_RECONCILE_SECONDS = 3600  # How often each server process corrects drifted statistics; None never does
+    IMPORT_WORKERS = int(os.environ.get('TAGCAM_IMPORT_WORKERS', os.cpu_count() or 1))  # Decode/hash processes
+    IMPORT_MAX_INFLIGHT = None  # Frames queued in the pool at once; None is 4 per worker
+    IMPORT_BATCH_SIZE = 500  # Frames per dedupe query and insert transaction; keep below SQLite's 999 bind limit
+    IMPORT_FRAMES_PER_TASK = 64  # Frames of an HDF5 container decoded per task, from one open of the file
+    IMPORT_HASH_PRELOAD_LIMIT = 100000  # Dedupe against an in-memory hash set below this many rows
+    IMPORT_RENDER = True  # Pre-render derivatives while frames are decoded for import
+    TOMO_NAME_PATTERN = None  # Regex parsing tomography frame names; None uses importer.tomo_name_pattern
+    IMPORT_JOB_WORKERS = 1  # Background import threads per server process; 0 runs imports in the request
+    IMPORT_JOB_HEARTBEAT_SECONDS = 1  # How often a running job saves its progress
+    IMPORT_JOB_STALE_SECONDS = 300  # A running job without a heartbeat this long is resumed
+    IMPORT_JOB_RESUME = True  # Sweep for stale jobs to resume every IMPORT_JOB_STALE_SECONDS
 
 
 class ProdConfig(Config):
@@ -51,3 +73,9 @@ class TestConfig(Config):
     SQLALCHEMY_DATABASE_URI = 'sqlite://'
     BCRYPT_LOG_ROUNDS = 4  # For faster tests; needs at least 4 to avoid "ValueError: Invalid rounds"
     WTF_CSRF_ENABLED = False  # Allows form testing
+    IMPORT_WORKERS = 0  # Import serially in the test process
+    IMPORT_RENDER = False
+    PREVIEW_BUDGET_BYTES = None
+    IMPORT_JOB_WORKERS = 0
+    IMPORT_JOB_RESUME = False
+    STATS_RECONCILE_SECONDS = None
@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+"""Consensus labels across the taggers of each data file.
+
+The label bitmasks of the tags are loaded in bulk and unpacked into a NumPy
+boolean matrix sorted by hash, votes are summed per file with
+``np.add.reduceat`` and every consensus is derived from the votes without
+touching ORM objects:
+
+``majority``
+    Labels applied by more than half of the taggers; ties are not labels.
+``union``
+    Labels applied by any tagger.
+``unanimous``
+    Labels applied by every tagger.
+
+Tags are only ever added, so a file's consensus is stale exactly when its
+tag counter differs from the number of tags the consensus was computed
+from, and :func:`update` recomputes only those files.
+"""
+import datetime as dt
+
+import numpy as np
+from sqlalchemy import or_
+
+from tagcam.user.models import Consensus, DataFile, Tag, db
+
+labels = list(Tag.label_bits)
+label_bits = np.array(list(Tag.label_bits.values()), dtype=np.int64)
+
+
+def encode(matrix):
+    """Pack an ``(n, labels)`` boolean matrix into n label bitmasks."""
+    return matrix.astype(np.int64) @ label_bits
+
+
+def decode(mask):
+    """The label names set in a bitmask."""
+    return Tag.label_names(mask)
+
+
+def unpack(masks):
+    """Unpack n label bitmasks into an ``(n, labels)`` boolean matrix."""
+    return (np.asarray(masks, dtype=np.int64)[:, None] & label_bits) != 0
+
+
+def tag_matrix(hashes):
+    """Load the tags of some data files.
+
+    :return: ``(hashes, matrix)``: the hash of each tag, sorted, and an
+        ``(n, labels)`` boolean matrix of its labels.
+    """
+    rows = db.session.query(Tag.hash, Tag.labels).filter(Tag.hash.in_(list(hashes))).order_by(Tag.hash).all()
+    tag_hashes = np.array([datahash for datahash, _ in rows], dtype='U40')
+    return tag_hashes, unpack([mask for _, mask in rows])
+
+
+def combine(tag_hashes, matrix):
+    """Compute the consensus of each file from its tags.
+
+    :param tag_hashes: Hash of each tag, sorted so each file's tags are adjacent.
+    :param matrix: ``(n, labels)`` boolean label matrix of the tags.
+    :return: A dict of arrays with one entry per file: ``hash``, ``taggers``,
+        ``votes`` and the ``majority``, ``union`` and ``unanimous`` boolean
+        label matrices, plus ``agreement``, the fraction of labels every tagger
+        agreed on.
+    """
+    hashes, starts, taggers = np.unique(tag_hashes, return_index=True, return_counts=True)
+    if not len(hashes):
+        empty = np.zeros((0, len(labels)), dtype=bool)
+        return dict(hash=hashes, taggers=taggers, votes=empty.astype(np.int64),
+                    majority=empty, union=empty, unanimous=empty, agreement=np.zeros(0))
+    votes = np.add.reduceat(matrix.astype(np.int64), starts, axis=0)
+    counts = taggers[:, None]
+    union = votes > 0
+    unanimous = votes == counts
+    return dict(hash=hashes, taggers=taggers, votes=votes,
+                majority=2 * votes > counts, union=union, unanimous=unanimous,
+                agreement=(unanimous | ~union).mean(axis=1))
+
+
+def stale_hashes():
+    """Query the hashes of tagged files whose consensus is missing or out of date."""
+    return (db.session.query(DataFile.hash)
+            .outerjoin(Consensus, Consensus.hash == DataFile.hash)
+            .filter(DataFile.tagged > 0)
+            .filter(or_(Consensus.hash.is_(None), Consensus.taggers != DataFile.tagged)))
+
+
+def update(chunk_size=500):
+    """Recompute the consensus of every file with new tags, committing per chunk.
+
+    :return: The number of files recomputed.
+    """
+    stale = [datahash for datahash, in stale_hashes()]
+    for start in range(0, len(stale), chunk_size):
+        chunk = stale[start:start + chunk_size]
+        result = combine(*tag_matrix(chunk))
+        now = dt.datetime.utcnow()
+        rows = [dict(hash=datahash, taggers=int(taggers), majority=int(majority), union=int(union),
+                     unanimous=int(unanimous), agreement=float(agreement), updated_at=now)
+                for datahash, taggers, majority, union, unanimous, agreement
+                in zip(result['hash'].tolist(), result['taggers'], encode(result['majority']),
+                       encode(result['union']), encode(result['unanimous']), result['agreement'])]
+        db.session.query(Consensus).filter(Consensus.hash.in_(chunk)).delete(synchronize_session=False)
+        db.session.bulk_insert_mappings(Consensus, rows)
+        db.session.commit()
+    return len(stale)
+
+
+def label_agreement(min_taggers=2):
+    """Per label, the fraction of files with at least min_taggers tags whose taggers all agreed on it."""
+    rows = (db.session.query(Consensus.union, Consensus.unanimous)
+            .filter(Consensus.taggers >= min_taggers).all())
+    if not rows:
+        return {label: None for label in labels}
+    union = unpack([mask for mask, _ in rows])
+    unanimous = unpack([mask for _, mask in rows])
+    return dict(zip(labels, (unanimous | ~union).mean(axis=0).tolist()))
@@ -0,0 +1,204 @@
+# -*- coding: utf-8 -*-
+"""Content-addressed store for rendered derivatives of data files.
+
+Derivatives are keyed by the content hash of their frame and by kind:
+``preview`` JPEGs live in the static folder so they can be served directly,
+and the ``256``/``128`` training TIFFs live under the training directory.
+Montages of tomography groups, keyed by the hash of their frames' hashes,
+live in the ``montages`` folder of the static folder, and the zoom tile
+pyramids of frames in its ``tiles`` folder.
+"""
+import os
+import re
+import shutil
+import tempfile
+
+from tagcam.user.models import DataFile, db
+
+hash_pattern = re.compile(r'^[0-9a-f]{40}$')
+
+
+def _read_umask():
+    umask = os.umask(0)
+    os.umask(umask)
+    return umask
+
+
+_umask = _read_umask()
+#: Modes of written derivatives and their directories: what ``open`` and
+#: ``os.makedirs`` would have created, rather than the 0600 and 0700 of
+#: :mod:`tempfile`, so a proxy serving previews as another user can read them
+file_mode = 0o666 & ~_umask
+directory_mode = 0o777 & ~_umask
+
+
+class DerivativeStore(object):
+    """Finds, atomically writes and evicts derivatives by hash and kind."""
+
+    kinds = ('preview', '256', '128')
+    #: Derivatives of a group of frames, with their file extensions
+    group_kinds = {'montage': 'jpg', 'tilemap': 'json'}
+
+    def __init__(self, preview_dir, training_dir):
+        """Create instance."""
+        self.preview_dir = preview_dir
+        self.training_dir = training_dir
+
+    @classmethod
+    def from_config(cls, config):
+        """Create the store configured for an app."""
+        return cls(config['PREVIEW_DIR'], config['TRAINING_DIR'])
+
+    def path(self, datahash, kind):
+        """Return where a derivative lives."""
+        if kind == 'preview':
+            return os.path.join(self.preview_dir, f'{datahash}.jpg')
+        if kind in self.kinds:
+            return os.path.join(self.training_dir, kind, f'{datahash}.tif')
+        if kind in self.group_kinds:
+            return os.path.join(self.preview_dir, 'montages', f'{datahash}.{self.group_kinds[kind]}')
+        if kind == 'pyramid':
+            return os.path.join(self.preview_dir, 'tiles', datahash, 'info.json')
+        raise ValueError(f'Unknown derivative kind {kind!r}')
+
+    def tile_path(self, datahash, level, col, row):
+        """Return where a tile of a frame's zoom pyramid lives."""
+        return os.path.join(self.preview_dir, 'tiles', datahash, str(level), f'{col}_{row}.jpg')
+
+    def exists(self, datahash, kind):
+        """Whether a derivative has been rendered."""
+        return os.path.isfile(self.path(datahash, kind))
+
+    def missing(self, datahash, kinds=None):
+        """Return the kinds of derivative of a frame that have not been rendered."""
+        return [kind for kind in (kinds or self.kinds) if not self.exists(datahash, kind)]
+
+    def write(self, datahash, kind, writer):
+        """Write a derivative atomically.
+
+        :param writer: Callable taking a temporary path with the derivative's
+            extension; the file is renamed into place once it returns, so
+            readers never see a partial file.
+        :return: The final path.
+        """
+        return self.write_file(self.path(datahash, kind), writer)
+
+    @staticmethod
+    def write_file(path, writer):
+        """Write a file atomically with writer, as :meth:`write` does."""
+        directory, filename = os.path.split(path)
+        os.makedirs(directory, exist_ok=True)
+        fd, tmppath = tempfile.mkstemp(dir=directory, prefix=f'.{filename}.', suffix=os.path.splitext(path)[1])
+        os.close(fd)
+        try:
+            writer(tmppath)
+            os.chmod(tmppath, file_mode)
+            os.replace(tmppath, path)
+        except BaseException:
+            os.unlink(tmppath)
+            raise
+        return path
+
+    @staticmethod
+    def write_directory(path, writer):
+        """Write a directory of files atomically, unless it already exists.
+
+        :param writer: Callable taking a temporary directory to write into; it
+            is renamed into place once it returns, so readers never see a
+            directory with some of its files missing.
+        :return: The final path.
+        """
+        parent, name = os.path.split(path)
+        os.makedirs(parent, exist_ok=True)
+        tmppath = tempfile.mkdtemp(dir=parent, prefix=f'.{name}.')
+        try:
+            writer(tmppath)
+            os.chmod(tmppath, directory_mode)
+            os.rename(tmppath, path)
+        except BaseException:
+            shutil.rmtree(tmppath, ignore_errors=True)
+            if not os.path.isdir(path):
+                raise
+        return path
+
+    def previews(self):
+        """Yield ``(hash, stat)`` for every stored preview."""
+        try:
+            entries = os.scandir(self.preview_dir)
+        except OSError:
+            return
+        with entries:
+            for entry in entries:
+                datahash, ext = os.path.splitext(entry.name)
+                if ext == '.jpg' and hash_pattern.match(datahash) and entry.is_file():
+                    yield datahash, entry.stat()
+
+    def pyramids(self):
+        """Yield ``(hash, size, last_used)`` for every stored tile pyramid, its size summed over its files."""
+        try:
+            entries = os.scandir(os.path.join(self.preview_dir, 'tiles'))
+        except OSError:
+            return
+        with entries:
+            for entry in entries:
+                if not hash_pattern.match(entry.name) or not entry.is_dir():
+                    continue
+                size = last_used = 0
+                for directory, _, filenames in os.walk(entry.path):
+                    for filename in filenames:
+                        try:
+                            stat = os.stat(os.path.join(directory, filename))
+                        except OSError:
+                            continue
+                        size += stat.st_size
+                        last_used = max(last_used, stat.st_atime, stat.st_mtime)
+                yield entry.name, size, last_used
+
+    def evict(self, budget, chunk_size=500):
+        """Delete least recently used previews and tile pyramids until they fit the budget.
+
+        The previews and tiles of fully tagged files go first. Then the tiles
+        of files that still need tags are evicted, since they are rendered
+        again on demand; their previews are never evicted.
+
+        :param budget: Maximum total size of the previews and tiles, in bytes.
+        :return: ``(evicted, freed_bytes)``, evicted counting the frames whose previews or tiles were deleted.
+        """
+        used = {}
+        sizes = {}
+        for datahash, stat in self.previews():
+            used[datahash] = max(stat.st_atime, stat.st_mtime)
+            sizes[datahash] = [stat.st_size, 0]
+        for datahash, size, last_used in self.pyramids():
+            used[datahash] = max(used.get(datahash, 0), last_used)
+            sizes.setdefault(datahash, [0, 0])[1] = size
+        total = sum(preview + tiles for preview, tiles in sizes.values())
+        if total <= budget:
+            return 0, 0
+
+        tagged = set()
+        hashes = list(sizes)
+        for start in range(0, len(hashes), chunk_size):
+            tagged.update(datahash for datahash, in
+                          db.session.query(DataFile.hash)
+                          .filter(DataFile.tagged >= 2, DataFile.hash.in_(hashes[start:start + chunk_size])))
+
+        by_use = sorted(sizes, key=lambda datahash: (used[datahash], datahash))
+        evictable = ([(datahash, True) for datahash in by_use if datahash in tagged] +
+                     [(datahash, False) for datahash in by_use if datahash not in tagged and sizes[datahash][1]])
+        evicted = freed = 0
+        for datahash, with_preview in evictable:
+            if total - freed <= budget:
+                break
+            preview, tiles = sizes[datahash]
+            if with_preview and preview:
+                try:
+                    os.remove(self.path(datahash, 'preview'))
+                    freed += preview
+                except OSError:
+                    pass
+            if tiles:
+                shutil.rmtree(os.path.dirname(self.path(datahash, 'pyramid')), ignore_errors=True)
+                freed += tiles
+            evicted += 1
+        return evicted, freed
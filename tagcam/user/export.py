@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+"""Export of the tagged images and their labels as sharded arrays for training.
+
+Tags are streamed from the database in hash order and grouped per image;
+each image's resized training derivative is read from the derivative store
+and copied into a preallocated shard buffer, so memory stays bounded by one
+shard however large the dataset is. Each shard is an uncompressed ``.npz``
+holding:
+
+``images``
+    ``(n, size, size)`` uint8 pixels.
+``votes``
+    ``(n, labels)`` uint16 count of taggers who applied each label.
+``taggers``
+    ``(n,)`` uint16 number of taggers of each image.
+``hashes``
+    ``(n,)`` content hashes, in increasing order.
+
+Shards are renamed into place once complete. Because images are exported in
+hash order, an interrupted export resumes after the last hash of the last
+complete shard. ``dataset.json`` is written when the export finishes.
+"""
+import json
+import os
+import re
+import tempfile
+from itertools import groupby
+
+import numpy as np
+
+from tagcam.user.models import DataFile, Tag, db
+
+shard_pattern = re.compile(r'^shard-(\d{5})\.npz$')
+
+
+class ExportStats(object):
+    """Counters of an export."""
+
+    def __init__(self):
+        """Create instance."""
+        self.exported = self.missing = self.shards = self.resumed_shards = 0
+
+    def as_dict(self):
+        """Return the counters as a dict."""
+        return dict(exported=self.exported, missing=self.missing, shards=self.shards,
+                    resumed_shards=self.resumed_shards)
+
+
+def shard_path(output, index):
+    """Where a shard lives."""
+    return os.path.join(output, f'shard-{index:05d}.npz')
+
+
+def complete_shards(output):
+    """Return the paths of the complete shards already in output, in order.
+
+    Only an unbroken run from shard 0 counts; anything after a gap is
+    rewritten.
+    """
+    try:
+        indices = {int(match.group(1)) for match in map(shard_pattern.match, os.listdir(output)) if match}
+    except OSError:
+        return []
+    shards = []
+    while len(shards) in indices:
+        shards.append(shard_path(output, len(shards)))
+    return shards
+
+
+def read_training_image(path):
+    """Read a training TIFF (floats in [0, 1]) as uint8."""
+    import imageio
+
+    image = np.asarray(imageio.imread(path), dtype=np.float32)
+    return np.clip(image * 255 + .5, 0, 255).astype(np.uint8)
+
+
+def labeled_images(min_tags, after=None, chunk_size=1000):
+    """Stream ``(hash, votes, taggers)`` for every image with at least min_tags tags, in hash order.
+
+    The tags are read with a server-side cursor where the database supports one.
+    """
+    bits = np.array(list(Tag.label_bits.values()), dtype=np.int64)
+    query = (db.session.query(Tag.hash, Tag.labels)
+             .join(DataFile, DataFile.hash == Tag.hash)
+             .filter(DataFile.tagged >= min_tags))
+    if after is not None:
+        query = query.filter(Tag.hash > after)
+    query = query.order_by(Tag.hash).execution_options(stream_results=True).yield_per(chunk_size)
+
+    for datahash, rows in groupby(query, key=lambda row: row[0]):
+        masks = np.array([mask for _, mask in rows], dtype=np.int64)
+        yield datahash, ((masks[:, None] & bits) != 0).sum(axis=0, dtype=np.uint16), len(masks)
+
+
+def _write_shard(output, index, arrays):
+    path = shard_path(output, index)
+    fd, tmppath = tempfile.mkstemp(dir=output, prefix=f'.shard-{index:05d}.', suffix='.npz')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            np.savez(f, **arrays)
+        os.replace(tmppath, path)
+    except BaseException:
+        os.unlink(tmppath)
+        raise
+    return path
+
+
+def export_dataset(output, store, size=256, shard_size=1024, min_tags=2, progress=None):
+    """Export tagged images with their label votes into shards under output.
+
+    :param store: The :class:`tagcam.user.derivatives.DerivativeStore` holding
+        the training derivatives.
+    :param size: Which training derivative to export.
+    :param shard_size: Images per shard.
+    :param min_tags: Only export images with at least this many tags.
+    :param progress: Optional callable taking the :class:`ExportStats` after each shard.
+    :return: The :class:`ExportStats`.
+    """
+    kind = str(size)
+    if kind not in store.kinds or kind == 'preview':
+        raise ValueError(f'No {size}px training derivatives are rendered')
+    os.makedirs(output, exist_ok=True)
+    labels = list(Tag.label_bits)
+    stats = ExportStats()
+
+    shards = complete_shards(output)
+    after = None
+    if shards:
+        with np.load(shards[-1]) as shard:
+            after = str(shard['hashes'][-1])
+        stats.shards = stats.resumed_shards = len(shards)
+
+    images = np.empty((shard_size, size, size), dtype=np.uint8)
+    votes = np.empty((shard_size, len(labels)), dtype=np.uint16)
+    taggers = np.empty(shard_size, dtype=np.uint16)
+    hashes = []
+
+    def flush():
+        n = len(hashes)
+        _write_shard(output, stats.shards, dict(images=images[:n], votes=votes[:n], taggers=taggers[:n],
+                                                hashes=np.array(hashes, dtype='U40')))
+        stats.shards += 1
+        stats.exported += n
+        del hashes[:]
+        if progress:
+            progress(stats)
+
+    for datahash, image_votes, image_taggers in labeled_images(min_tags, after):
+        path = store.path(datahash, kind)
+        try:
+            image = read_training_image(path)
+        except (OSError, ValueError):
+            stats.missing += 1
+            continue
+        if image.shape != (size, size):
+            stats.missing += 1
+            continue
+
+        n = len(hashes)
+        images[n] = image
+        votes[n] = image_votes
+        taggers[n] = image_taggers
+        hashes.append(datahash)
+        if len(hashes) == shard_size:
+            flush()
+    if hashes:
+        flush()
+
+    with open(os.path.join(output, 'dataset.json'), 'w') as f:
+        json.dump(dict(labels=labels, size=size, min_tags=min_tags, shard_size=shard_size,
+                       shards=[os.path.basename(shard_path(output, index)) for index in range(stats.shards)]),
+                  f, indent=2)
+    return stats
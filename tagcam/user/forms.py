@@ -1,21 +1,53 @@
 # -*- coding: utf-8 -*-
 """User forms."""
 from flask_wtf import FlaskForm
-from wtforms import PasswordField, StringField, BooleanField, RadioField, HiddenField, Field
+from wtforms import PasswordField, StringField, BooleanField, RadioField, HiddenField
 from wtforms.form import FormMeta
-from wtforms.validators import DataRequired, Email, EqualTo, Length
-from flask import url_for
+from wtforms.validators import DataRequired, Email, EqualTo, InputRequired, Length
+from flask import url_for, current_app, request
+from flask_login import current_user
 import os
+from functools import lru_cache
 
 from .models import User, DataFile, TomoDataFile, db, Tag
-import imageio
-import fabio
-import numpy as np
-import hashlib
-from sqlalchemy.sql.expression import func, select
-from matplotlib import pyplot as plt
+from . import tomotagging, workqueue
+from .derivatives import DerivativeStore
 
-from skimage.transform import resize
+
+def preview_url(datahash, kind='preview'):
+    """URL of the preview JPEG of a data file, or of the montage of a group with kind ``montage``.
+
+    :return: None without a hash, as when there is nothing left to tag.
+    """
+    if not datahash:
+        return None
+    return url_for('user.preview', kind=kind, key=datahash)
+
+
+def ensure_derivatives(datafile):
+    """Render the derivatives of a data file on demand if the import did not pre-render them."""
+    store = DerivativeStore.from_config(current_app.config)
+    if store.missing(datafile.hash):
+        from .render import render_file  # Keeps numpy/fabio/skimage out of worker start-up
+        render_file(datafile.item, store)
+
+
+def ensure_montage(members):
+    """Render the montage of a group of frames if the import did not pre-render it.
+
+    The frames are decoded serially in the request; starting a process pool
+    from a server worker for every uncached group would fork it per request.
+
+    :return: Its tile map, with the ``url`` of the sprite sheet, or None if a frame could not be rendered.
+    """
+    from .render import render_montage
+
+    store = DerivativeStore.from_config(current_app.config)
+    try:
+        tilemap = render_montage([(member.hash, member.path) for member in members], store)
+    except (OSError, ValueError, IndexError):
+        return None
+    return dict(tilemap, url=preview_url(tilemap['key'], 'montage'))
 
 
 class RegisterForm(FlaskForm):
@@ -64,130 +96,82 @@ class TagForm(FlaskForm):
         """Create instance."""
         super(TagForm, self).__init__(*args, **kwargs)
 
-        session = db.session  # type: db.Session
-        datafile = session.query(DataFile).filter(DataFile.tagged < 2).order_by(func.random()).limit(1).first()
+        if self.is_submitted():
+            return
+
+        leased = workqueue.lease(current_user.id, seconds=current_app.config['TAG_LEASE_SECONDS'])
+        datafile = DataFile.query.get(leased[0]) if leased else None
 
         if not datafile:
             return
 
-        framepath = datafile.path
-        self.path.data = framepath
-        data = fabio.open(framepath).data
+        self.path.data = datafile.path
         self.hash.data = datafile.hash
-        data = np.nan_to_num(np.log(data))
-
-        clip = np.percentile(data, 99.9)
-        data[data > clip] = clip
-
-        floor = np.percentile(data[data > 0], 1)
-        data[data < 0] = 0
-        data = ((data - floor) / (data.max() - floor) * 255)
-        data[data < 0] = 0
-        data = data.astype(np.uint8)
-        colordata = plt.cm.viridis(data)[:, :, :3]
-
-        if not os.path.isfile(f'{self.hash.data}.jpg'):
-            imageio.imwrite(os.path.join('tagcam/', 'static/', f'{self.hash.data}.jpg'), colordata)
-
-        if not os.path.isfile(f'{self.hash.data}_256.tif'):
-            rescaled = resize(data, (256, 256))
-            imageio.imwrite(os.path.join('training/', '256/', f'{self.hash.data}.tif'), rescaled)
-
-        if not os.path.isfile(f'{self.hash.data}_128.tif'):
-            rescaled = resize(data, (128, 128))
-            imageio.imwrite(os.path.join('training/', '128/', f'{self.hash.data}.tif'), rescaled)
+        ensure_derivatives(datafile)
 
     def validate(self):
         """Validate the form."""
         return True
 
     def get_jpg_data(self):
-        return url_for('static', filename=f'{self.hash.data}.jpg')
-
+        return preview_url(self.hash.data)
 
 
 class TomoTagForm(FlaskForm):
-    """Tag form."""
-    # saxs = BooleanField(label='SAXS')
-    # gisaxs = BooleanField(label='GISAXS')
-    # tag = RadioField(label='Tags', choices=[(name, name) for name in Tag.tags])
-    tags = {}
-    hash = HiddenField(label='hash')
-    path = HiddenField(label='path')
-
-    def __new__(cls, *args, **kwargs):
-        session = db.session  # type: db.Session
-
-
-        # get a random file
-        tomodatafile = session.query(TomoDataFile).filter(TomoDataFile.tagged < 2).order_by(
-            func.random()).limit(1).first()
-
-        # get the group of files
-        tomodatafiles = session.query(TomoDataFile).filter(
-            DataFile.tagged < 2).filter(TomoDataFile.groupid==tomodatafile.groupid)
-        attrs = dict(FlaskForm.__dict__)
-        attrs.update(dict(cls.__dict__))
-        attrs['groupcount'] = tomodatafiles.count
-        attrs['qualityradios'] = []
-
-
-        for tomodatafile in tomodatafiles:
-            rf = RadioField(label='Quality', choices=[(1, 1), (2, 2), (3, 3), (4, 4), (5, 5)])
-            attrs[tomodatafile.hash] = rf
-            attrs['qualityradios'].append(rf)
-
-        newtype = type(cls.__name__, (FlaskForm,), attrs)
-        obj = FlaskForm.__new__(newtype, *args, **kwargs)
-        for k,v in attrs.items():
-            if isinstance(v,Field):
-                del attrs[k]
-        obj.__dict__.update(attrs)
-        return obj()
-
-    def __init__(self, *args, **kwargs):
-        """Create instance."""
-        super(TomoTagForm, self).__init__(*args, **kwargs)
-
-        session = db.session  # type: db.Session
-        datafile = session.query(DataFile).filter(TomoDataFile.tagged < 2).order_by(func.random()).limit(1).first()
-
-        if not datafile:
-            return
-
-        framepath = datafile.path
-        self.path.data = framepath
-        data = fabio.open(framepath).data
-        self.hash.data = datafile.hash
-        data = np.nan_to_num(np.log(data))
-
-        clip = np.percentile(data, 99.9)
-        data[data > clip] = clip
-
-        floor = np.percentile(data[data > 0], 1)
-        data[data < 0] = 0
-        data = ((data - floor) / (data.max() - floor) * 255)
-        data[data < 0] = 0
-        data = data.astype(np.uint8)
-        colordata = plt.cm.viridis(data)[:, :, :3]
-
-        if not os.path.isfile(f'{self.hash.data}.jpg'):
-            imageio.imwrite(os.path.join('tagcam/', 'static/', f'{self.hash.data}.jpg'), colordata)
-
-        if not os.path.isfile(f'{self.hash.data}_256.tif'):
-            rescaled = resize(data, (256, 256))
-            imageio.imwrite(os.path.join('training/', '256/', f'{self.hash.data}.tif'), rescaled)
-
-        if not os.path.isfile(f'{self.hash.data}_128.tif'):
-            rescaled = resize(data, (128, 128))
-            imageio.imwrite(os.path.join('training/', '128/', f'{self.hash.data}.tif'), rescaled)
+    """Ratings of every frame of a tomography group.
+
+    A form class with one rating field per frame is built once for each
+    group size by :meth:`for_size`; the frames are bound to the fields in
+    the order of the ``hashes`` field. Submitted forms are sized by the
+    group's frames in the database, never by the client's ``hashes``.
+    """
+
+    groupid = HiddenField(label='groupid', validators=[DataRequired()])
+    hashes = HiddenField(label='hashes', validators=[DataRequired()])
+
+    @staticmethod
+    @lru_cache(maxsize=64)
+    def for_size(size):
+        """The form class for groups of size frames."""
+        fields = {f'rating_{i}': RadioField(label='Quality', coerce=int, validators=[InputRequired()],
+                                            choices=[(rating, rating) for rating in tomotagging.ratings])
+                  for i in range(size)}
+        return type(f'TomoTagForm{size}', (TomoTagForm,), dict(fields, size=size))
+
+    @classmethod
+    def for_group(cls, members, **kwargs):
+        """Create the form for rating a group of :class:`TomoDataFile`."""
+        form = cls.for_size(len(members))(**kwargs)
+        form.groupid.data = members[0].groupid
+        form.hashes.data = ','.join(member.hash for member in members)
+        return form
+
+    @classmethod
+    def for_submission(cls):
+        """Create the form for the submitted ratings of a group, sized by the group's frames."""
+        size = TomoDataFile.query.filter_by(groupid=request.form.get('groupid', '')).count()
+        return cls.for_size(size)()
 
     def validate(self):
-        """Validate the form."""
+        """Validate the form, and that its frames are exactly those of the group."""
+        if not super(TomoTagForm, self).validate():
+            return False
+        members = {datahash for datahash, in
+                   db.session.query(TomoDataFile.hash).filter(TomoDataFile.groupid == self.groupid.data)}
+        hashes = self.hashes.data.split(',')
+        if len(hashes) != len(members) or set(hashes) != members:
+            self.hashes.errors.append('The frames do not match the group')
+            return False
         return True
 
-    def get_jpg_data(self):
-        return url_for('static', filename=f'{self.hash.data}.jpg')
+    @property
+    def rating_fields(self):
+        """The rating field of each frame, in order."""
+        return [getattr(self, f'rating_{i}') for i in range(self.size)]
+
+    def submitted_ratings(self):
+        """Return the submitted ratings as a dict of frame hash to rating."""
+        return dict(zip(self.hashes.data.split(','), (field.data for field in self.rating_fields)))
 
 
 for tag, description in Tag.tags.items():
@@ -0,0 +1,310 @@
+# -*- coding: utf-8 -*-
+"""Reading of detector frames without copying the pixels.
+
+Uncompressed EDF and TIFF frames are memory-mapped at the pixel payload's
+offset, which is read from the header, so hashing and rendering read the
+pixels straight from the page cache instead of from a private copy. Frames
+in any other format, or with a header this module does not understand, are
+read with fabio.
+
+HDF5 containers (NeXus, Eiger master files) hold stacks of frames and are
+addressed by frame index: frames are numbered across the container's frame
+stacks, which are counted from their shapes without reading any pixels, and
+each frame is read on its own so only its chunks are decompressed. Eiger
+data files that their master file links to are only read through the master.
+
+The array returned is the same as ``fabio.open(path).data``, down to its
+dtype, so hashes of frames are unchanged: frames in the machine's byte order
+are hashed straight from the map, and the others are byte-swapped into a
+copy first, as fabio does.
+"""
+import hashlib
+import os
+import re
+import struct
+
+import numpy as np
+
+#: EDF data types whose fabio dtype is unambiguous
+edf_dtypes = {
+    'SignedByte': np.int8, 'Signed8': np.int8, 'UnsignedByte': np.uint8, 'Unsigned8': np.uint8,
+    'SignedShort': np.int16, 'Signed16': np.int16, 'UnsignedShort': np.uint16, 'Unsigned16': np.uint16,
+    'SignedInteger': np.int32, 'Signed32': np.int32, 'UnsignedInteger': np.uint32, 'Unsigned32': np.uint32,
+    'Signed64': np.int64, 'Unsigned64': np.uint64,
+    'FloatValue': np.float32, 'Float': np.float32, 'FloatIEEE32': np.float32,
+    'DoubleValue': np.float64, 'Double': np.float64, 'DoubleIEEE64': np.float64,
+}
+edf_header_limit = 64 * 1024
+
+#: TIFF (SampleFormat, BitsPerSample) to dtype
+tiff_dtypes = {(1, 8): np.uint8, (1, 16): np.uint16, (1, 32): np.uint32, (1, 64): np.uint64,
+               (2, 8): np.int8, (2, 16): np.int16, (2, 32): np.int32, (2, 64): np.int64,
+               (3, 32): np.float32, (3, 64): np.float64}
+tiff_field_types = {1: 'B', 3: 'H', 4: 'I', 16: 'Q'}
+
+#: Extensions of HDF5 containers of frame stacks
+container_extensions = ('.h5', '.hdf5', '.nxs')
+#: Eiger data files; ``<prefix>_master.h5`` next to them links them together
+eiger_data_pattern = re.compile(r'^(?P<prefix>.+)_data_\d{6}\.h5$')
+
+
+class Layout(object):
+    """Where and how the pixels of an uncompressed frame are stored."""
+
+    def __init__(self, offset, shape, dtype):
+        """Create instance."""
+        self.offset = offset
+        self.shape = shape
+        self.dtype = np.dtype(dtype)
+
+    @property
+    def nbytes(self):
+        """Size of the pixel payload in bytes."""
+        return int(np.prod(self.shape)) * self.dtype.itemsize
+
+
+def edf_layout(f):
+    """Return the :class:`Layout` of the first frame of an uncompressed EDF file, or None."""
+    head = f.read(edf_header_limit)
+    if not head.lstrip().startswith(b'{'):
+        return None
+    end = head.find(b'}')
+    if end < 0:
+        return None
+    offset = end + 1
+    while head[offset:offset + 1] in (b'\r', b'\n'):
+        offset += 1
+
+    header = {}
+    for line in head[head.find(b'{') + 1:end].decode('ascii', 'replace').split(';'):
+        key, sep, value = line.partition('=')
+        if sep:
+            header[key.strip()] = value.strip()
+    if header.get('Compression', 'None') not in ('None', 'NoCompression'):
+        return None
+    if int(header.get('Dim_3', 1)) != 1 or header.get('DataType') not in edf_dtypes:
+        return None
+    byteorder = {'LowByteFirst': '<', 'HighByteFirst': '>'}.get(header.get('ByteOrder'))
+    if byteorder is None:
+        return None
+
+    dtype = np.dtype(edf_dtypes[header['DataType']]).newbyteorder(byteorder)
+    layout = Layout(offset, (int(header['Dim_2']), int(header['Dim_1'])), dtype)
+    if int(header.get('Size', layout.nbytes)) != layout.nbytes:
+        return None
+    return layout
+
+
+def tiff_layout(f):
+    """Return the :class:`Layout` of the first page of an uncompressed, single-channel TIFF file, or None."""
+    order = {b'II': '<', b'MM': '>'}.get(f.read(2))
+    if order is None or struct.unpack(order + 'H', f.read(2))[0] != 42:
+        return None
+    f.seek(struct.unpack(order + 'I', f.read(4))[0])
+    count, = struct.unpack(order + 'H', f.read(2))
+
+    tags = {}
+    for _ in range(count):
+        tag, field_type, n, value = struct.unpack(order + 'HHI4s', f.read(12))
+        if field_type not in tiff_field_types:
+            continue
+        fmt = f'{order}{n}{tiff_field_types[field_type]}'
+        size = struct.calcsize(fmt)
+        if size <= 4:
+            values = struct.unpack(fmt, value[:size])
+        else:
+            position = f.tell()
+            f.seek(struct.unpack(order + 'I', value)[0])
+            values = struct.unpack(fmt, f.read(size))
+            f.seek(position)
+        tags[tag] = values
+
+    def tag(number, default=None):
+        return tags.get(number, (default,))
+
+    if tag(259, 1)[0] != 1 or tag(277, 1)[0] != 1 or tag(317, 1)[0] != 1 or 322 in tags:
+        return None  # Compressed, multi-channel, predicted or tiled
+    dtype = tiff_dtypes.get((tag(339, 1)[0], tag(258, 1)[0]))
+    if dtype is None or 273 not in tags or 279 not in tags:
+        return None
+
+    offsets, counts = tags[273], tags[279]
+    if any(offsets[i] + counts[i] != offsets[i + 1] for i in range(len(offsets) - 1)):
+        return None  # Strips are not contiguous
+    layout = Layout(offsets[0], (tag(257)[0], tag(256)[0]), np.dtype(dtype).newbyteorder(order))
+    if sum(counts) != layout.nbytes:
+        return None
+    return layout
+
+
+def frame_layout(path):
+    """Return the :class:`Layout` of a frame's pixels if they can be mapped, or None."""
+    ext = os.path.splitext(path)[1].lower()
+    parser = {'.edf': edf_layout, '.tif': tiff_layout, '.tiff': tiff_layout}.get(ext)
+    if parser is None:
+        return None
+    try:
+        with open(path, 'rb') as f:
+            layout = parser(f)
+            if layout is None or layout.offset + layout.nbytes > os.fstat(f.fileno()).st_size:
+                return None
+            return layout
+    except (struct.error, ValueError, KeyError, IndexError):
+        return None
+
+
+def is_container(path):
+    """Whether a file is an HDF5 container of frame stacks, addressed by frame index."""
+    return path.lower().endswith(container_extensions)
+
+
+def _hdf5():
+    import h5py
+    try:
+        import hdf5plugin  # noqa: F401 Registers the bitshuffle/LZ4 filter Eiger data is compressed with
+    except ImportError:
+        pass
+    return h5py
+
+
+def _is_stack(h5py, obj):
+    return isinstance(obj, h5py.Dataset) and obj.ndim == 3 and obj.dtype.kind in 'iuf'
+
+
+def frame_stacks(h5):
+    """Return the frame stacks of an open HDF5 file in frame order.
+
+    A stack is a numeric ``(frames, rows, columns)`` dataset. The stacks of the
+    NeXus ``/entry/data`` group come first, in name order; Eiger master files
+    link their data files there as ``data_000001``, ``data_000002``..., and
+    numbering stops at the first data file that is missing. Files without such
+    a group use every stack in the file.
+    """
+    h5py = _hdf5()
+    stacks = []
+    group = h5.get('entry/data')
+    if isinstance(group, h5py.Group):
+        for name in sorted(group):
+            obj = group.get(name)
+            if obj is None:
+                break  # Dangling external link
+            if _is_stack(h5py, obj):
+                stacks.append(obj)
+    if not stacks:
+        h5.visititems(lambda name, obj: stacks.append(obj) if _is_stack(h5py, obj) else None)
+    return stacks
+
+
+def linked_master(path):
+    """Return the Eiger master file next to a data file if it links to the data file, or None.
+
+    The frames of such a data file are imported through the master.
+    """
+    match = eiger_data_pattern.match(os.path.basename(path))
+    if not match:
+        return None
+    directory = os.path.dirname(path)
+    master = os.path.join(directory, f"{match.group('prefix')}_master.h5")
+    if not os.path.isfile(master):
+        return None
+    h5py = _hdf5()
+    try:
+        with h5py.File(master, 'r') as h5:
+            group = h5.get('entry/data')
+            if not isinstance(group, h5py.Group):
+                return None
+            links = [group.get(name, getlink=True) for name in group]
+    except OSError:
+        return None
+    targets = {os.path.normpath(os.path.join(directory, link.filename))
+               for link in links if isinstance(link, h5py.ExternalLink)}
+    return master if os.path.normpath(path) in targets else None
+
+
+def count_frames(path):
+    """Return the number of frames in a container, without reading them.
+
+    :raises OSError: If the file cannot be opened.
+    """
+    with _hdf5().File(path, 'r') as h5:
+        return sum(len(stack) for stack in frame_stacks(h5))
+
+
+def read_frames(path, start=0, stop=None):
+    """Yield ``(frame, data)`` for frames start to stop of a container, opening it once.
+
+    :raises OSError: If the file or a frame cannot be read.
+    """
+    with _hdf5().File(path, 'r') as h5:
+        first = 0
+        for stack in frame_stacks(h5):
+            count = len(stack)
+            end = count if stop is None else min(count, stop - first)
+            for index in range(max(0, start - first), end):
+                data = stack[index]
+                yield first + index, data.astype(data.dtype.newbyteorder('='), copy=False)
+            first += count
+            if stop is not None and first >= stop:
+                return
+
+
+def frame_shape(path, frame=0):
+    """Return the ``(rows, columns)`` of a frame from its header, without reading its pixels.
+
+    :return: None if the format's header is not understood or the frame does not exist.
+    """
+    if not is_container(path):
+        layout = frame_layout(path)
+        return layout and layout.shape
+    try:
+        with _hdf5().File(path, 'r') as h5:
+            for stack in frame_stacks(h5):
+                if frame < len(stack):
+                    return tuple(stack.shape[1:])
+                frame -= len(stack)
+    except OSError:
+        pass
+    return None
+
+
+def read_frame(path, frame=0):
+    """Return the pixels of a frame, memory-mapped when the format allows.
+
+    :param frame: Index of the frame in a container; other files hold one frame.
+    :raises OSError: If the file cannot be read.
+    :raises ValueError: If fabio cannot decode it, or the container has no such frame.
+    """
+    if is_container(path):
+        for _, data in read_frames(path, frame, frame + 1):
+            return data
+        raise ValueError(f'{path} has no frame {frame}')
+
+    layout = frame_layout(path)
+    if layout is None:
+        import fabio
+
+        return fabio.open(path).data
+
+    data = np.memmap(path, dtype=layout.dtype, mode='r', offset=layout.offset, shape=layout.shape)
+    if not layout.dtype.isnative:
+        data = data.astype(layout.dtype.newbyteorder('='))
+    return data
+
+
+def frame_hash(data):
+    """Return the SHA-1 hex digest of a frame's pixels, as ``hashlib.sha1(fabio.open(path).data)``."""
+    return hashlib.sha1(np.ascontiguousarray(data)).hexdigest()
+
+
+def drop_cache(path):
+    """Advise the kernel that a file's pages will not be read again, where supported."""
+    if not hasattr(os, 'posix_fadvise'):
+        return
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+    finally:
+        os.close(fd)
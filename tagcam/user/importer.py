@@ -0,0 +1,528 @@
+# -*- coding: utf-8 -*-
+"""Bulk import engine for detector frames.
+
+The directory tree is walked lazily with :func:`os.scandir` and frames are
+decoded and hashed in a process pool, with a bounded number of frames in
+flight so memory stays flat no matter how large the tree is. Files whose
+stat signature matches the :class:`ImportManifest` are not decoded again.
+HDF5 containers are enumerated frame by frame, each frame becoming a
+DataFile addressed by ``(path, frame)``.
+"""
+import fnmatch
+import hashlib
+import os
+import re
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from itertools import islice
+
+from tagcam.user.models import DataFile, ImportManifest, TomoDataFile, db
+from tagcam.user import stats as stats_counters
+from tagcam.user.workqueue import enqueue
+
+import_blacklist = ['autoexpose_test', 'beamstop_test', '_lo_', '_low_']
+
+manifest_kinds = {DataFile: 'data', TomoDataFile: 'tomo'}
+
+#: The last five underscore-separated fields of a tomography frame's name;
+#: frames of a group share all but the last two characters of the name.
+tomo_name_pattern = (r'^(?=(?P<group>.*)..$)(?:.*_)?(?P<operationtype>[^_]*)_(?P<operation>[^_]*)'
+                     r'_(?P<parameter>[^_]*)_(?P<value>[^_]*)_(?P<frame>[^_]*)$')
+
+
+def checkblacklist(path):
+    """Delete a blacklisted file, returning True if it was blacklisted."""
+    for s in import_blacklist:
+        if s in path:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            return True
+    return False
+
+
+def scan_tree(root):
+    """Yield the path of every file below root.
+
+    Directories are visited depth-first in the same order as
+    ``glob.glob(f'{root}/**/*', recursive=True)``, but only one directory
+    listing is held in memory at a time.
+    """
+    try:
+        with os.scandir(root) as it:
+            entries = [entry for entry in it if not entry.name.startswith('.')]
+    except OSError:
+        return
+
+    for entry in entries:
+        try:
+            if entry.is_dir():
+                yield from scan_tree(entry.path)
+            elif entry.is_file():
+                yield entry.path
+        except OSError:
+            continue
+
+
+def _render(data, datahash, store):
+    from tagcam.user.render import render_derivatives
+    try:
+        render_derivatives(data, datahash, store)
+    except (OSError, ValueError, IndexError):
+        pass  # Rendered on demand by the tag page instead
+
+
+def _render_montage(items, store):
+    from tagcam.user.render import render_montage
+    try:
+        render_montage(items, store)
+    except (OSError, ValueError, IndexError):
+        pass  # Rendered serially by the rating page instead
+
+
+def hash_frame(path, store=None):
+    """Decode a frame and return ``(path, sha1)``; the hash is None if the file is unreadable.
+
+    Uncompressed frames are hashed straight from a memory map, and the file's
+    pages are dropped from the page cache afterwards since an import reads
+    each frame once.
+
+    :param store: Optional :class:`tagcam.user.derivatives.DerivativeStore`;
+        the frame's missing derivatives are rendered into it while it is still decoded.
+    """
+    from tagcam.user.frames import drop_cache, frame_hash, read_frame
+
+    try:
+        data = read_frame(path)
+        datahash = frame_hash(data)
+    except (OSError, ValueError):
+        return path, None
+
+    if store is not None:
+        _render(data, datahash, store)
+    del data
+    drop_cache(path)
+    return path, datahash
+
+
+def hash_frames(task, store=None):
+    """Decode a ``(path, start, stop)`` range of frames and return ``(path, [(frame, sha1), ...])``.
+
+    A container is opened once for the whole range; a stop of None means a
+    file holding a single frame, numbered 0. Hashes are None from the first
+    frame that cannot be read.
+
+    :param store: Optional :class:`tagcam.user.derivatives.DerivativeStore`, as for :func:`hash_frame`.
+    """
+    from tagcam.user.frames import frame_hash, read_frames
+
+    path, start, stop = task
+    if stop is None:
+        return path, [(0, hash_frame(path, store)[1])]
+
+    hashes = []
+    try:
+        for frame, data in read_frames(path, start, stop):
+            datahash = frame_hash(data)
+            if store is not None:
+                _render(data, datahash, store)
+            hashes.append((frame, datahash))
+    except (OSError, ValueError):
+        pass
+    hashes.extend((frame, None) for frame in range(start + len(hashes), stop))
+    return path, hashes
+
+
+def bounded_map(fn, iterable, workers=None, max_inflight=None):
+    """Map fn over iterable in a process pool, yielding results in submission order.
+
+    At most max_inflight calls are queued at once. With zero or one worker the
+    map runs serially in this process.
+    """
+    workers = os.cpu_count() if workers is None else workers
+    if workers <= 1:
+        yield from map(fn, iterable)
+        return
+
+    max_inflight = max_inflight or 4 * workers
+    with ProcessPoolExecutor(workers) as pool:
+        inflight = deque()
+        for item in iterable:
+            if len(inflight) >= max_inflight:
+                yield inflight.popleft().result()
+            inflight.append(pool.submit(fn, item))
+        while inflight:
+            yield inflight.popleft().result()
+
+
+class ImportStats(object):
+    """Counters for a running or finished import."""
+
+    def __init__(self):
+        """Create instance."""
+        self.scanned = 0
+        self.decoded = 0
+        self.duplicates = 0
+        self.unchanged = 0
+        self.deleted = 0
+        self.inserted = 0
+        self.started = time.monotonic()
+        self.finished = None
+
+    @property
+    def elapsed(self):
+        """Seconds spent importing so far."""
+        return (self.finished or time.monotonic()) - self.started
+
+    @property
+    def files_per_second(self):
+        """Scanning throughput."""
+        return self.scanned / self.elapsed if self.elapsed else 0.
+
+    def as_dict(self):
+        """Counters as a JSON-serializable dict."""
+        return dict(scanned=self.scanned, decoded=self.decoded, duplicates=self.duplicates,
+                    unchanged=self.unchanged, deleted=self.deleted, inserted=self.inserted, elapsed=self.elapsed,
+                    files_per_second=self.files_per_second)
+
+
+def chunked(iterable, size):
+    """Yield lists of up to size items from iterable."""
+    iterator = iter(iterable)
+    chunk = list(islice(iterator, size))
+    while chunk:
+        yield chunk
+        chunk = list(islice(iterator, size))
+
+
+def preload_hashes(model, limit):
+    """Return the set of all hashes of model, or None if it has more than limit rows."""
+    if not limit or db.session.query(model.hash).count() > limit:
+        return None
+    return {datahash for datahash, in db.session.query(model.hash)}
+
+
+def known_hashes(model, hashes, preloaded=None):
+    """Return the subset of hashes already stored for model.
+
+    Uses one ``IN`` query, or the preloaded hash set if there is one.
+    """
+    if preloaded is not None:
+        return preloaded.intersection(hashes)
+    return {datahash for datahash, in db.session.query(model.hash).filter(model.hash.in_(hashes))}
+
+
+def ingest_batch(model, rows, stats, preloaded=None, commit=True):
+    """Insert the rows whose hash is new, in one bulk insert and one commit.
+
+    Rows that repeat a stored hash, or a hash seen earlier in the same batch,
+    are counted as duplicates.
+
+    :param model: DataFile or TomoDataFile.
+    :param rows: Column dicts, each with at least ``hash`` and ``path``.
+    :param stats: :class:`ImportStats` to update.
+    :param preloaded: Optional set of all stored hashes, kept up to date.
+    :param commit: Commit the insert; pass False to add more to the transaction.
+    :return: The inserted rows.
+    """
+    seen = known_hashes(model, {row['hash'] for row in rows}, preloaded)
+    new = []
+    for row in rows:
+        if row['hash'] in seen:
+            stats.duplicates += 1
+            continue
+        seen.add(row['hash'])
+        new.append(row)
+
+    if new:
+        db.session.bulk_insert_mappings(model, new)
+        if commit:
+            db.session.commit()
+        if preloaded is not None:
+            preloaded.update(row['hash'] for row in new)
+    stats.inserted += len(new)
+    return new
+
+
+def stat_signature(path):
+    """Return the ``(size, mtime_ns, inode)`` signature of a file."""
+    st = os.stat(path)
+    return st.st_size, st.st_mtime_ns, st.st_ino
+
+
+def unchanged_paths(model, signatures):
+    """Return the paths whose manifest signature matches and whose hash is still stored for model.
+
+    :param signatures: Mapping of path to current :func:`stat_signature`.
+    """
+    query = (db.session.query(ImportManifest.path, ImportManifest.size, ImportManifest.mtime_ns, ImportManifest.inode)
+             .join(model, model.hash == ImportManifest.hash)
+             .filter(ImportManifest.kind == manifest_kinds[model])
+             .filter(ImportManifest.path.in_(list(signatures))))
+    return {path for path, size, mtime_ns, inode in query if signatures[path] == (size, mtime_ns, inode)}
+
+
+def record_manifest(model, rows, signatures):
+    """Add the signatures of decoded rows to the manifest in the current transaction.
+
+    :param rows: Column dicts with ``hash`` and ``path``.
+    :param signatures: Mapping of path to the :func:`stat_signature` taken before decoding.
+    """
+    kind = manifest_kinds[model]
+    paths = [row['path'] for row in rows]
+    if not paths:
+        return
+    (db.session.query(ImportManifest)
+     .filter(ImportManifest.kind == kind, ImportManifest.path.in_(paths))
+     .delete(synchronize_session=False))
+    db.session.bulk_insert_mappings(ImportManifest, [
+        dict(kind=kind, path=row['path'], hash=row['hash'],
+             **dict(zip(('size', 'mtime_ns', 'inode'), signatures[row['path']])))
+        for row in rows])
+
+
+def _changed(model, paths, signatures, stats, batch_size, progress=None):
+    """Yield the paths that are new or changed since the last import, recording their signatures."""
+    for chunk in chunked(paths, batch_size):
+        if progress:
+            progress(stats)
+        chunk_signatures = {}
+        for path in chunk:
+            try:
+                chunk_signatures[path] = stat_signature(path)
+            except OSError:
+                continue
+        unchanged = unchanged_paths(model, chunk_signatures)
+        stats.unchanged += len(unchanged)
+        for path, signature in chunk_signatures.items():
+            if path not in unchanged:
+                signatures[path] = signature
+                yield path
+
+
+def _candidates(root, stats):
+    from tagcam.user.frames import linked_master
+
+    for path in scan_tree(root):
+        stats.scanned += 1
+        if checkblacklist(path):
+            stats.deleted += 1
+            continue
+        if linked_master(path):
+            continue  # Its frames are imported through the master file
+        yield os.path.abspath(path)
+
+
+def _frame_tasks(paths, frames, signatures, chunk_size):
+    """Yield a ``(path, start, stop)`` decode task per file, splitting containers into ranges of frames.
+
+    The frames of each container are counted into frames when it is reached.
+    """
+    from tagcam.user.frames import count_frames, is_container
+
+    for path in paths:
+        if not is_container(path):
+            yield path, 0, None
+            continue
+        try:
+            count = count_frames(path)
+        except (OSError, ValueError):
+            count = 0
+        if not count:
+            signatures.pop(path, None)
+            continue
+        frames[path] = count
+        for start in range(0, count, chunk_size):
+            yield path, start, min(count, start + chunk_size)
+
+
+def _decoded_frames(results, stats, signatures, frames):
+    """Yield ``(path, frame, hash, complete)`` for every decoded frame.
+
+    complete is set on the last frame of a file once all its frames have been
+    decoded, which is when its manifest entry can be recorded; a file with an
+    unreadable frame gets no manifest entry, so it is decoded again next time.
+    """
+    failed = set()
+    for path, hashes in results:
+        if any(datahash is None for _, datahash in hashes):
+            failed.add(path)
+        last = hashes[-1][0]
+        final = last == frames.get(path, 1) - 1
+        complete = final and path not in failed
+        if final:
+            frames.pop(path, None)
+            failed.discard(path)
+            if not complete:
+                signatures.pop(path, None)
+        for frame, datahash in hashes:
+            if datahash is not None:
+                stats.decoded += 1
+                yield path, frame, datahash, complete and frame == last
+
+
+def import_datafiles(root, username, workers=None, max_inflight=None, batch_size=500, preload_limit=0,
+                     progress=None, store=None, frames_per_task=64):
+    """Import every readable frame below root as a DataFile.
+
+    Every frame of an HDF5 container becomes a DataFile with the container's
+    path and the frame's index; containers are decoded in ranges of frames so
+    each task opens the file once.
+
+    :param root: Directory to import from.
+    :param username: Id of the importing user.
+    :param workers: Size of the decode pool; defaults to the number of CPUs.
+    :param max_inflight: Maximum number of decode tasks queued in the pool at once.
+    :param batch_size: Frames deduplicated and inserted per transaction.
+    :param preload_limit: Deduplicate against an in-memory hash set when the
+        table holds at most this many rows, instead of querying per batch.
+    :param progress: Optional callable taking the :class:`ImportStats`, called
+        between batches. It may raise to abort the import; committed batches
+        are kept and skipped by the manifest when the import is run again.
+    :param store: Optional :class:`tagcam.user.derivatives.DerivativeStore` to
+        pre-render derivatives into from the decode pool.
+    :param frames_per_task: Frames of a container decoded per task.
+    :return: The :class:`ImportStats` of the finished import.
+    """
+    stats = ImportStats()
+    preloaded = preload_hashes(DataFile, preload_limit)
+    signatures = {}
+    frames = {}
+    changed = _changed(DataFile, _candidates(root, stats), signatures, stats, batch_size, progress)
+    tasks = _frame_tasks(changed, frames, signatures, frames_per_task)
+    results = bounded_map(partial(hash_frames, store=store), tasks, workers, max_inflight)
+    for batch in chunked(_decoded_frames(results, stats, signatures, frames), batch_size):
+        rows = [dict(hash=datahash, path=path, frame=frame, username=username, tagged=0)
+                for path, frame, datahash, _ in batch]
+        new = ingest_batch(DataFile, rows, stats, preloaded, commit=False)
+        enqueue(row['hash'] for row in new)
+        stats_counters.record_import(len(new))
+        complete = [row for row, (*_, done) in zip(rows, batch) if done]
+        record_manifest(DataFile, complete, {row['path']: signatures.pop(row['path']) for row in complete})
+        db.session.commit()
+        if progress:
+            progress(stats)
+
+    stats.finished = time.monotonic()
+    return stats
+
+
+# /home/rp/Downloads/20180531_123413_bp-c-40-sprayRingPRwidth0050______00963.tiff
+# /home/rp/Downloads/20180531_123413_bp-c-40-spray_00963_Ring Removal_width_0050.tiff
+
+def parse_tomo_name(path, pattern):
+    """Parse a tomography frame's file name with a compiled pattern.
+
+    :param pattern: Regular expression matched against the base name without
+        extension, with the named groups ``group`` (the part of the name shared
+        by every frame of a reconstruction sweep), ``operationtype``,
+        ``operation``, ``parameter`` and ``value``.
+    :return: The TomoDataFile columns parsed from the name, or None if it does not match.
+    """
+    match = pattern.match(os.path.splitext(os.path.basename(path))[0])
+    if not match:
+        return None
+    try:
+        value = float(match.group('value'))
+    except ValueError:
+        return None
+    return dict(groupid=hashlib.sha1(match.group('group').encode()).hexdigest(),
+                operationtype=match.group('operationtype'), operation=match.group('operation'),
+                parameter=match.group('parameter'), value=value)
+
+
+def _tomo_groups(root, pattern, stats, batch_size=500, progress=None):
+    """Scan root for tiffs and return their parsed columns keyed by path, grouped by groupid."""
+    groups = {}
+    for i, path in enumerate(scan_tree(root), 1):
+        if progress and i % batch_size == 0:
+            progress(stats)
+        if not fnmatch.fnmatch(os.path.basename(path), '*.tif*'):
+            continue
+        stats.scanned += 1
+        columns = parse_tomo_name(path, pattern)
+        if columns is not None:
+            groups.setdefault(columns['groupid'], {})[os.path.abspath(path)] = columns
+    return groups
+
+
+def _ingest_tomo_rows(rows, stats, signatures, progress=None):
+    """Insert the rows of whole groups and their manifest entries in one transaction."""
+    ingest_batch(TomoDataFile, rows, stats, commit=False)
+    record_manifest(TomoDataFile, rows, {row['path']: signatures.pop(row['path']) for row in rows})
+    db.session.commit()
+    if progress:
+        progress(stats)
+
+
+def import_tomodatafiles(root, username, pattern=tomo_name_pattern, workers=None, max_inflight=None,
+                         batch_size=500, progress=None, store=None):
+    """Import every tiff below root as a TomoDataFile, a whole group at a time.
+
+    Names are parsed once with pattern and frames are decoded and hashed in a
+    process pool, but the frames of a group are only inserted together, in one
+    transaction: a group with an unreadable frame is left out entirely and
+    retried by the next import, so an interrupted import never leaves a
+    partial parameter sweep behind. With a store, the montage of every
+    inserted group is then rendered in a pool of the same size, one group per
+    task, so the rating page only has to serve it.
+
+    :param root: Directory to import from.
+    :param username: Id of the importing user.
+    :param pattern: File name pattern, compiled or as a string; see :func:`parse_tomo_name`.
+    :param workers: Size of the decode pool; defaults to the number of CPUs.
+    :param max_inflight: Maximum number of frames queued in the pool at once.
+    :param batch_size: Frames per transaction; whole groups are added to a
+        transaction until it holds at least this many. Also the number of
+        paths looked up in the manifest at once, across groups.
+    :param progress: Optional callable taking the :class:`ImportStats`, called
+        while scanning, between manifest lookups, between transactions and
+        after each montage. It may raise to abort the import.
+    :param store: Optional :class:`tagcam.user.derivatives.DerivativeStore`
+        to pre-render group montages into.
+    :return: The :class:`ImportStats` of the finished import.
+    """
+    stats = ImportStats()
+    groups = _tomo_groups(root, re.compile(pattern), stats, batch_size, progress)
+
+    signatures = {}
+    paths = (path for members in groups.values() for path in members)
+    changed = set(_changed(TomoDataFile, paths, signatures, stats, batch_size, progress))
+    pending = []
+    for members in groups.values():
+        members = {path: columns for path, columns in members.items() if path in changed}
+        if members:
+            pending.append(members)
+
+    results = bounded_map(hash_frame, (path for members in pending for path in members), workers, max_inflight)
+    rows = []
+    montages = []
+    for members in pending:
+        decoded = [(path, datahash) for path, datahash in islice(results, len(members)) if datahash is not None]
+        stats.decoded += len(decoded)
+        if len(decoded) < len(members):
+            for path in members:
+                signatures.pop(path, None)
+            continue
+        group = [dict(hash=datahash, path=path, username=username, tagged=0, **members[path])
+                 for path, datahash in decoded]
+        rows.extend(group)
+        if store is not None:
+            shown = sorted(group, key=lambda row: (row['value'], row['hash']))  # As the rating page orders it
+            montages.append([(row['hash'], row['path']) for row in shown])
+        if len(rows) >= batch_size:
+            _ingest_tomo_rows(rows, stats, signatures, progress)
+            rows = []
+    if rows:
+        _ingest_tomo_rows(rows, stats, signatures, progress)
+
+    if montages:
+        for _ in bounded_map(partial(_render_montage, store=store), montages, workers, max_inflight):
+            if progress:
+                progress(stats)
+
+    stats.finished = time.monotonic()
+    return stats
@@ -0,0 +1,226 @@
+# -*- coding: utf-8 -*-
+"""Background import jobs.
+
+Imports are persisted as :class:`ImportJob` rows and run on a small thread
+pool inside the serving process, so the import form returns immediately.
+A job is claimed with a compare-and-set on its status; jobs whose heartbeat
+goes stale (the process running them died) are claimed again and resumed
+by a periodic sweep, and the import manifest makes the rerun skip every batch already committed.
+The runner also reconciles the tagging statistics periodically.
+"""
+import datetime as dt
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import current_app
+from sqlalchemy import and_, or_
+
+from tagcam.user import stats, workqueue
+from tagcam.user.derivatives import DerivativeStore
+from tagcam.user.importer import import_datafiles, import_tomodatafiles, tomo_name_pattern
+from tagcam.user.models import ImportJob, db
+
+
+class JobCancelled(Exception):
+    """Raised from the progress callback when a job is cancelled."""
+
+
+def _stale_before(app):
+    return dt.datetime.utcnow() - dt.timedelta(seconds=app.config['IMPORT_JOB_STALE_SECONDS'])
+
+
+def render_store(app):
+    """The derivative store to pre-render into during import, if enabled."""
+    if not app.config['IMPORT_RENDER']:
+        return None
+    return DerivativeStore.from_config(app.config)
+
+
+def claim_job(job_id, stale_before):
+    """Mark a queued or stale job as running; return True if this caller won it."""
+    claimed = (db.session.query(ImportJob)
+               .filter(ImportJob.id == job_id, ImportJob.cancel_requested.is_(False))
+               .filter(or_(ImportJob.status == 'queued',
+                           and_(ImportJob.status == 'running', ImportJob.updated_at < stale_before)))
+               .update({'status': 'running', 'updated_at': dt.datetime.utcnow()}, synchronize_session=False))
+    db.session.commit()
+    return claimed == 1
+
+
+def _job_counters(stats):
+    counters = {counter: getattr(stats, counter) for counter in ImportJob.counters}
+    counters['files_per_second'] = stats.files_per_second
+    return counters
+
+
+def _progress(job_id, heartbeat):
+    last = [0.]
+
+    def progress(stats):
+        now = time.monotonic()
+        if now - last[0] < heartbeat:
+            return
+        last[0] = now
+
+        (db.session.query(ImportJob).filter_by(id=job_id)
+         .update(dict(updated_at=dt.datetime.utcnow(), **_job_counters(stats)), synchronize_session=False))
+        db.session.commit()
+        if db.session.query(ImportJob.cancel_requested).filter_by(id=job_id).scalar():
+            raise JobCancelled()
+
+    return progress
+
+
+def run_job(job_id):
+    """Claim and run an import job in the current app context."""
+    app = current_app._get_current_object()
+    if not claim_job(job_id, _stale_before(app)):
+        return
+
+    job = ImportJob.query.get(job_id)
+    progress = _progress(job_id, app.config['IMPORT_JOB_HEARTBEAT_SECONDS'])
+    try:
+        if job.kind == 'tomo':
+            stats = import_tomodatafiles(job.path, job.username,
+                                         pattern=app.config['TOMO_NAME_PATTERN'] or tomo_name_pattern,
+                                         workers=app.config['IMPORT_WORKERS'],
+                                         max_inflight=app.config['IMPORT_MAX_INFLIGHT'],
+                                         batch_size=app.config['IMPORT_BATCH_SIZE'],
+                                         progress=progress,
+                                         store=render_store(app))
+        else:
+            stats = import_datafiles(job.path, job.username,
+                                     workers=app.config['IMPORT_WORKERS'],
+                                     max_inflight=app.config['IMPORT_MAX_INFLIGHT'],
+                                     batch_size=app.config['IMPORT_BATCH_SIZE'],
+                                     preload_limit=app.config['IMPORT_HASH_PRELOAD_LIMIT'],
+                                     frames_per_task=app.config['IMPORT_FRAMES_PER_TASK'],
+                                     progress=progress,
+                                     store=render_store(app))
+    except JobCancelled:
+        db.session.rollback()
+        job.update(status='cancelled', updated_at=dt.datetime.utcnow())
+    except Exception:  # noqa: B902
+        db.session.rollback()
+        app.logger.exception('Import job %s failed', job_id)
+        job.update(status='failed', error=traceback.format_exc(), updated_at=dt.datetime.utcnow())
+    else:
+        job.update(status='done', updated_at=dt.datetime.utcnow(), **_job_counters(stats))
+        if app.config['PREVIEW_BUDGET_BYTES']:
+            DerivativeStore.from_config(app.config).evict(app.config['PREVIEW_BUDGET_BYTES'])
+
+
+def _run_in_context(app, job_id):
+    with app.app_context():
+        run_job(job_id)
+
+
+def reconcile_stats():
+    """Correct the tagging statistics in the current app context, logging any drift that was found."""
+    app = current_app._get_current_object()
+    try:
+        corrected = stats.reconcile(workqueue.tags_per_file)
+    except Exception:  # noqa: B902
+        db.session.rollback()
+        app.logger.exception('Reconciling the tagging statistics failed')
+    else:
+        if corrected:
+            app.logger.warning('Corrected %s drifted tagging statistics counters', corrected)
+
+
+class JobRunner(object):
+    """Runs import jobs on a per-process thread pool."""
+
+    def __init__(self, app=None):
+        """Create instance."""
+        self._executor = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """Start resuming stale jobs and reconciling statistics when the app serves its first request."""
+        if app.config['IMPORT_JOB_RESUME']:
+            app.before_first_request(self.schedule_resume)
+        if app.config['STATS_RECONCILE_SECONDS']:
+            app.before_first_request(self.schedule_reconcile)
+
+    @property
+    def executor(self):
+        """The thread pool, created lazily so each forked worker gets its own."""
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(current_app.config['IMPORT_JOB_WORKERS'])
+        return self._executor
+
+    def submit(self, kind, path, username):
+        """Persist a new import job and queue it.
+
+        With ``IMPORT_JOB_WORKERS = 0`` the job runs before this returns.
+        """
+        job = ImportJob(kind, path, username).save()
+        self._dispatch(job.id)
+        return job
+
+    def resume_stale(self):
+        """Queue every queued or running job whose heartbeat is stale."""
+        stale_before = _stale_before(current_app)
+        job_ids = [job_id for job_id, in
+                   db.session.query(ImportJob.id)
+                   .filter(ImportJob.status.in_(['queued', 'running']), ImportJob.updated_at < stale_before)]
+        for job_id in job_ids:
+            self._dispatch(job_id)
+        return job_ids
+
+    def schedule_resume(self):
+        """Resume stale jobs now and then every ``IMPORT_JOB_STALE_SECONDS`` on a daemon timer.
+
+        A crashed worker is respawned before its job goes stale, so resuming
+        only at startup would leave that job orphaned.
+        """
+        self.resume_stale()
+        app = current_app._get_current_object()
+        self._schedule(app, app.config['IMPORT_JOB_STALE_SECONDS'], self.resume_stale)
+
+    def schedule_reconcile(self):
+        """Reconcile the tagging statistics every ``STATS_RECONCILE_SECONDS`` on a daemon timer.
+
+        Each server process runs its own timer. Reconciling locks the
+        counters, so concurrent runs take turns and the later ones find
+        nothing to correct.
+        """
+        app = current_app._get_current_object()
+        self._schedule(app, app.config['STATS_RECONCILE_SECONDS'], reconcile_stats)
+
+    def _schedule(self, app, seconds, task):
+        timer = threading.Timer(seconds, self._run_scheduled, args=(app, seconds, task))
+        timer.daemon = True
+        timer.start()
+
+    def _run_scheduled(self, app, seconds, task):
+        with app.app_context():
+            try:
+                task()
+            except Exception:  # noqa: B902
+                db.session.rollback()
+                app.logger.exception('Scheduled %s failed', task.__name__)
+            finally:
+                self._schedule(app, seconds, task)
+
+    @staticmethod
+    def cancel(job):
+        """Ask a job to stop; a job that has not started is cancelled at once."""
+        if job.finished:
+            return job
+        if job.status == 'queued':
+            return job.update(status='cancelled', cancel_requested=True, updated_at=dt.datetime.utcnow())
+        return job.update(cancel_requested=True)
+
+    def _dispatch(self, job_id):
+        if not current_app.config['IMPORT_JOB_WORKERS']:
+            run_job(job_id)
+        else:
+            self.executor.submit(_run_in_context, current_app._get_current_object(), job_id)
+
+
+import_jobs = JobRunner()
@@ -3,11 +3,11 @@
 import datetime as dt
 
 from flask_login import UserMixin
+from sqlalchemy import and_
 
 from tagcam.database import Column, Model, SurrogatePK, db, reference_col, relationship
 from tagcam.extensions import bcrypt
 
-# TODO: select users.username, count(*) as ct from tags inner join users on (tags.username = users.id) group by users.username;
 
 class Role(SurrogatePK, Model):
     """A role for a user."""
@@ -76,6 +76,8 @@ class Tag(UserMixin, Model):
     hash = Column(db.String(40), nullable=False)
     id = Column(db.Integer, unique=True, primary_key=True, autoincrement=True)
     # __table_args__ = {'extend_existing': True}
+    __table_args__ = (db.Index('ix_tags_hash', 'hash'),
+                      db.UniqueConstraint('username', 'hash', name='uq_tags_username_hash'))
 
     tags = {'GISAXS': 'Grazing Incidence Small-Angle geometry. Yoneda line, horizon, or specular are visible. Scattering is typically more diffuse.',
             'GIWAXS':'Grazing Incidence Wide-Angle geometry. Yoneda line, horizon, or specular are visible. Scattering is typically more defined.',
@@ -95,6 +97,12 @@ class Tag(UserMixin, Model):
     for tag in tags:
         locals()[tag] = Column(db.Boolean, default=False, nullable=False)
 
+    #: Bit of each label in :attr:`labels`. Bits are assigned in the order of
+    #: :attr:`tags` and stored in the database, so new labels must be appended.
+    label_bits = {tag: 1 << bit for bit, tag in enumerate(tags)}
+    #: All labels of the tag as one bitmask
+    labels = Column(db.Integer, nullable=False, default=0, server_default='0')
+
     def __init__(self, username, path, hash, **kwargs):
         """Create instance."""
         db.Model.__init__(self, username=username, path=path, hash=hash, **kwargs)
@@ -103,6 +111,33 @@ class Tag(UserMixin, Model):
         """Represent instance as a unique string."""
         return '<Tag({path!r})>'.format(path=self.path)
 
+    @classmethod
+    def labels_mask(cls, labels):
+        """Return the bitmask of some label names."""
+        mask = 0
+        for label in labels:
+            mask |= cls.label_bits[label]
+        return mask
+
+    @classmethod
+    def label_names(cls, mask):
+        """Return the label names set in a bitmask."""
+        return [label for label, bit in cls.label_bits.items() if mask & bit]
+
+    @classmethod
+    def has_labels(cls, include=(), exclude=()):
+        """A filter on :attr:`labels` for tags with every label in include and none in exclude.
+
+        For example, ``Tag.query.filter(Tag.has_labels(['Ring'], exclude=['Featureless']))``.
+        """
+        criteria = []
+        if include:
+            mask = cls.labels_mask(include)
+            criteria.append(cls.labels.op('&')(mask) == mask)
+        if exclude:
+            criteria.append(cls.labels.op('&')(cls.labels_mask(exclude)) == 0)
+        return and_(*criteria)
+
 class TomoTag(UserMixin, Model):
     """A user of the app."""
 
@@ -113,6 +148,8 @@ class TomoTag(UserMixin, Model):
     hash = Column(db.String(40), nullable=False)
     id = Column(db.Integer, unique=True, primary_key=True, autoincrement=True)
     # __table_args__ = {'extend_existing': True}
+    __table_args__ = (db.Index('ix_tomotags_hash', 'hash'),
+                      db.Index('ix_tomotags_username_hash', 'username', 'hash'))
 
     rating = Column(db.Integer, nullable=False)
 
@@ -128,16 +165,28 @@ class TomoTag(UserMixin, Model):
 class DataFile(Model):
     __tablename__ = 'datafiles'
     hash = Column(db.String(40), nullable=False, unique=True, primary_key=True)
-    path = Column(db.String(1000), nullable=False, unique=True)
+    path = Column(db.String(1000), nullable=False)
+    #: Index of the frame in an HDF5 container; 0 for files holding one frame
+    frame = Column(db.Integer, nullable=False, default=0, server_default='0')
     tagged = Column(db.Integer, nullable=False, default=0)
     username = Column(db.Integer, nullable=False)
     # __table_args__ = {'extend_existing': True}
+    __table_args__ = (db.UniqueConstraint('path', 'frame', name='uq_datafiles_path_frame'),
+                      db.Index('ix_datafiles_untagged', tagged,
+                               postgresql_where=tagged < 2, sqlite_where=tagged < 2))
 
     def __init__(self, hash, path, username, **kwargs):
         db.Model.__init__(self, hash=hash, path=path, username=username, **kwargs)
 
+    @property
+    def item(self):
+        """The ``(hash, path, frame)`` the render functions take."""
+        return self.hash, self.path, self.frame or 0
+
     def __repr__(self):
         """Represent instance as a unique string."""
+        if self.frame:
+            return '<DataFile({path!r}, {frame})>'.format(path=self.path, frame=self.frame)
         return '<DataFile({path!r})>'.format(path=self.path)
 
 class TomoDataFile(Model):
@@ -152,6 +201,9 @@ class TomoDataFile(Model):
     parameter = Column(db.String(100), nullable=False)
     value = Column(db.Float, nullable=False)
     # __table_args__ = {'extend_existing': True}
+    __table_args__ = (db.Index('ix_tomodatafiles_groupid', groupid),
+                      db.Index('ix_tomodatafiles_untagged', tagged, groupid,
+                               postgresql_where=tagged < 2, sqlite_where=tagged < 2))
 
     def __init__(self, hash, path, username, groupid, operation, operationtype, parameter, value, **kwargs):
         db.Model.__init__(self, hash=hash, path=path, username=username, groupid=groupid, operation=operation, operationtype=operationtype, parameter=parameter, value=value, **kwargs)
@@ -160,3 +212,131 @@ class TomoDataFile(Model):
         """Represent instance as a unique string."""
         return '<DataFile({path!r})>'.format(path=self.path)
 
+
+class ImportManifest(Model):
+    """Stat signature of an imported file, so unchanged files are not decoded again."""
+
+    __tablename__ = 'importmanifest'
+    kind = Column(db.String(10), primary_key=True)
+    path = Column(db.String(1000), primary_key=True)
+    size = Column(db.BigInteger, nullable=False)
+    mtime_ns = Column(db.BigInteger, nullable=False)
+    inode = Column(db.BigInteger, nullable=False)
+    hash = Column(db.String(40), nullable=False)
+
+    def __repr__(self):
+        """Represent instance as a unique string."""
+        return '<ImportManifest({path!r})>'.format(path=self.path)
+
+
+class ImportJob(SurrogatePK, Model):
+    """A background import of a data directory."""
+
+    __tablename__ = 'importjobs'
+    kind = Column(db.String(10), nullable=False)
+    path = Column(db.String(1000), nullable=False)
+    username = Column(db.Integer, nullable=False)
+    status = Column(db.String(20), nullable=False, default='queued')
+    cancel_requested = Column(db.Boolean, nullable=False, default=False)
+    error = Column(db.Text, nullable=True)
+    created_at = Column(db.DateTime, nullable=False, default=dt.datetime.utcnow)
+    updated_at = Column(db.DateTime, nullable=False, default=dt.datetime.utcnow)
+
+    counters = ('scanned', 'decoded', 'duplicates', 'unchanged', 'deleted', 'inserted')
+    for counter in counters:
+        locals()[counter] = Column(db.Integer, nullable=False, default=0)
+    files_per_second = Column(db.Float, nullable=False, default=0.)
+
+    def __init__(self, kind, path, username, **kwargs):
+        """Create instance."""
+        db.Model.__init__(self, kind=kind, path=path, username=username, **kwargs)
+
+    @property
+    def finished(self):
+        """Whether the job has stopped for good."""
+        return self.status in ('done', 'failed', 'cancelled')
+
+    def as_dict(self):
+        """Progress as a JSON-serializable dict."""
+        return dict(id=self.id, kind=self.kind, path=self.path, status=self.status, error=self.error,
+                    cancel_requested=self.cancel_requested, finished=self.finished,
+                    created_at=self.created_at.isoformat(), updated_at=self.updated_at.isoformat(),
+                    files_per_second=self.files_per_second,
+                    **{counter: getattr(self, counter) for counter in self.counters})
+
+    def __repr__(self):
+        """Represent instance as a unique string."""
+        return '<ImportJob({id!r}, {path!r})>'.format(id=self.id, path=self.path)
+
+
+class WorkItem(Model):
+    """A data file that still needs tags, in the tagging queue."""
+
+    __tablename__ = 'workqueue'
+    hash = Column(db.String(40), primary_key=True)
+    #: Random shuffle key, so taggers are spread over the data set
+    position = Column(db.Integer, nullable=False, index=True)
+    lease_user = Column(db.Integer, nullable=True, index=True)
+    lease_expires = Column(db.DateTime, nullable=True)
+
+    def __init__(self, hash, position, **kwargs):
+        """Create instance."""
+        db.Model.__init__(self, hash=hash, position=position, **kwargs)
+
+    def __repr__(self):
+        """Represent instance as a unique string."""
+        return '<WorkItem({hash!r})>'.format(hash=self.hash)
+
+
+class Counter(Model):
+    """A named running total, kept up to date by the tag and import writes."""
+
+    __tablename__ = 'counters'
+    name = Column(db.String(40), primary_key=True)
+    value = Column(db.BigInteger, nullable=False, default=0)
+
+
+class UserStat(Model):
+    """Running tag count of a user."""
+
+    __tablename__ = 'userstats'
+    username = Column(db.Integer, primary_key=True)
+    value = Column(db.BigInteger, nullable=False, default=0, index=True)
+
+
+class LabelStat(Model):
+    """Running count of tags with a label."""
+
+    __tablename__ = 'labelstats'
+    label = Column(db.String(40), primary_key=True)
+    value = Column(db.BigInteger, nullable=False, default=0)
+
+
+class DayStat(Model):
+    """Running count of tags recorded on a (UTC) day."""
+
+    __tablename__ = 'daystats'
+    day = Column(db.Date, primary_key=True)
+    value = Column(db.BigInteger, nullable=False, default=0)
+
+
+class Consensus(Model):
+    """The combined labels of all taggers of a data file.
+
+    Label sets are bitmasks like :attr:`Tag.labels`.
+    """
+
+    __tablename__ = 'consensus'
+    hash = Column(db.String(40), primary_key=True)
+    #: Number of tags the consensus was computed from
+    taggers = Column(db.Integer, nullable=False)
+    majority = Column(db.Integer, nullable=False)
+    union = Column(db.Integer, nullable=False)
+    unanimous = Column(db.Integer, nullable=False)
+    #: Fraction of labels every tagger agreed on
+    agreement = Column(db.Float, nullable=False)
+    updated_at = Column(db.DateTime, nullable=False, default=dt.datetime.utcnow)
+
+    def __repr__(self):
+        """Represent instance as a unique string."""
+        return '<Consensus({hash!r})>'.format(hash=self.hash)
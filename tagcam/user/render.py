@@ -0,0 +1,325 @@
+# -*- coding: utf-8 -*-
+"""Rendering of frames into the preview and training derivatives.
+
+Frames are normalized in a single float32 working copy: log scale, contrast
+limits from a histogram instead of full percentile sorts, and a 256-entry
+uint8 viridis lookup table instead of a float64 RGBA colormap. Frames are
+read with :func:`tagcam.user.frames.read_frame`, so uncompressed ones are
+memory-mapped rather than copied.
+
+Nothing outside the render and import paths imports this module, and the
+heavier imageio, skimage and matplotlib imports are deferred further to the
+functions that need them, so serving processes start quickly.
+"""
+import hashlib
+import json
+import os
+from functools import lru_cache, partial
+
+import numpy as np
+
+from tagcam.user.frames import frame_shape, read_frame
+
+training_sizes = (256, 128)
+montage_tile_size = 256
+pyramid_tile_size = 256
+histogram_bins = 4096
+clip_percentile = 99.9  # Of all pixels
+floor_percentile = 1  # Of pixels with a positive log intensity
+
+
+def masked_pixels(data):
+    """Return a boolean mask of detector gap and masked pixels, or None if there are none.
+
+    Only the sentinels detectors actually write are masked: -1 and -2 on
+    int32 Pilatus frames, 2**32 - 1 on uint32 Eiger frames, and non-finite
+    or negative values on float frames. Saturated pixels of other dtypes are
+    real signal and are kept.
+    """
+    if data.dtype.kind == 'f':
+        mask = ~np.isfinite(data) | (data < 0)
+    elif data.dtype == np.int32:
+        mask = (data == -1) | (data == -2)
+    elif data.dtype == np.uint32:
+        mask = data == np.iinfo(np.uint32).max
+    else:
+        return None
+    return mask if mask.any() else None
+
+
+def log_frame(data):
+    """Return a float32 log-intensity copy of a frame with gaps, zeros and non-finite values set to 0."""
+    data = np.asarray(data)
+    frame = np.array(data, dtype=np.float32)
+    mask = masked_pixels(data)
+    if mask is not None:
+        frame[mask] = 0
+    with np.errstate(divide='ignore', invalid='ignore'):
+        np.log(frame, out=frame)
+    np.nan_to_num(frame, copy=False)
+    np.maximum(frame, 0, out=frame)
+    return frame
+
+
+def contrast_limits(frame, bins=histogram_bins):
+    """Approximate the (floor, clip) limits of a log frame from a histogram.
+
+    The clip is the 99.9th percentile of all pixels and the floor the 1st
+    percentile of the positive pixels, each to within one of ``bins`` bins.
+    """
+    vmax = float(frame.max())
+    positive = np.count_nonzero(frame)
+    if not positive:
+        raise ValueError('Frame has no pixels above 1 count')
+
+    counts, edges = np.histogram(frame, bins=bins, range=(0, vmax))
+    zeros = frame.size - positive
+    counts[0] -= zeros
+    cumulative = np.cumsum(counts)
+    centers = (edges[:-1] + edges[1:]) / 2
+
+    clip_rank = clip_percentile / 100 * (frame.size - 1) - zeros
+    clip = 0. if clip_rank < 0 else centers[np.searchsorted(cumulative, clip_rank, side='right')]
+    floor_rank = floor_percentile / 100 * (positive - 1)
+    floor = centers[np.searchsorted(cumulative, floor_rank, side='right')]
+    return floor, max(clip, floor)
+
+
+def scale(frame, limits):
+    """Clip a float32 log frame to ``(floor, clip)`` and scale it into uint8, in place."""
+    floor, clip = limits
+    np.clip(frame, floor, clip, out=frame)
+    frame -= floor
+    if clip > floor:
+        frame *= 255 / (clip - floor)
+    return frame.astype(np.uint8)
+
+
+def normalize(data, limits=None):
+    """Log-scale and clip a frame into uint8.
+
+    :param limits: Optional ``(floor, clip)`` in log intensity, to share
+        contrast between frames; computed from the frame by default.
+    """
+    frame = log_frame(data)
+    return scale(frame, contrast_limits(frame) if limits is None else limits)
+
+
+@lru_cache(maxsize=None)
+def viridis_lut():
+    """The viridis colormap as a 256x3 uint8 lookup table."""
+    from matplotlib import cm
+
+    return np.round(cm.viridis(np.arange(256))[:, :3] * 255).astype(np.uint8)
+
+
+def colorize(data):
+    """Apply the viridis colormap to a uint8 frame, returning HxWx3 uint8."""
+    return viridis_lut()[data]
+
+
+def block_mean(data, shape):
+    """Block-average a frame by the largest integer factor that keeps it at least twice shape, as float32."""
+    factor = max(1, min(data.shape[0] // (2 * shape[0]), data.shape[1] // (2 * shape[1])))
+    if factor == 1:
+        return np.asarray(data, dtype=np.float32)
+    rows, cols = data.shape[0] // factor, data.shape[1] // factor
+    return (data[:rows * factor, :cols * factor]
+            .reshape(rows, factor, cols, factor)
+            .mean(axis=(1, 3), dtype=np.float32))
+
+
+def downsample(data, shape):
+    """Resize a uint8 frame to shape as floats in [0, 1].
+
+    The frame is first block-averaged with :func:`block_mean`, so only a small
+    image is interpolated.
+    """
+    from skimage.transform import resize
+
+    return resize(block_mean(data, shape) / 255, shape)
+
+
+def render_derivatives(data, datahash, store):
+    """Write whichever derivatives of a decoded frame are missing from the store.
+
+    :param store: A :class:`tagcam.user.derivatives.DerivativeStore`.
+    :return: The paths of the derivatives that were written, keyed by kind.
+    """
+    import imageio
+
+    missing = store.missing(datahash)
+    if not missing:
+        return {}
+
+    data = normalize(data)
+    if not store.exists(datahash, 'pyramid'):
+        store.write(datahash, 'pyramid', lambda path: _write_json(path, pyramid_info(data.shape)))
+    written = {}
+    if 'preview' in missing:
+        written['preview'] = store.write(datahash, 'preview',
+                                         lambda path: imageio.imwrite(path, colorize(data)))
+    for size in training_sizes:
+        if str(size) in missing:
+            written[str(size)] = store.write(datahash, str(size),
+                                             lambda path: imageio.imwrite(path, downsample(data, (size, size))))
+    return written
+
+
+def render_file(item, store):
+    """Decode a ``(hash, path, frame)`` item and write its missing derivatives.
+
+    :return: ``(hash, written)``; written is None if the frame could not be rendered.
+    """
+    datahash, path, frame = item
+    if not store.missing(datahash):
+        return datahash, {}
+    try:
+        return datahash, render_derivatives(read_frame(path, frame), datahash, store)
+    except (OSError, ValueError, IndexError):
+        return datahash, None
+
+
+def montage_key(hashes):
+    """The cache key of the montage of some frames: a hash of their sorted hashes."""
+    return hashlib.sha1(','.join(sorted(hashes)).encode()).hexdigest()
+
+
+def montage_tile(path, tile=montage_tile_size):
+    """Decode a frame and return its float32 log intensities shrunk to fit in a tile, keeping the aspect ratio."""
+    from skimage.transform import resize
+
+    frame = log_frame(read_frame(path))
+    factor = min(tile / frame.shape[0], tile / frame.shape[1], 1)
+    shape = (max(1, round(frame.shape[0] * factor)), max(1, round(frame.shape[1] * factor)))
+    if shape == frame.shape:
+        return frame
+    return resize(block_mean(frame, shape), shape, preserve_range=True).astype(np.float32)
+
+
+def render_montage(items, store, columns=None, tile=montage_tile_size, workers=0):
+    """Render frames side by side into one JPEG sprite sheet with shared contrast, plus a JSON tile map.
+
+    Frames are decoded, optionally in a process pool, and share one set of
+    contrast limits, so their intensities can be compared. Both files are cached in the store
+    under :func:`montage_key` of the frames' hashes.
+
+    :param items: ``(hash, path)`` of each frame, in display order.
+    :param columns: Tiles per row; a near-square grid by default.
+    :param workers: Size of the decode pool; 0 decodes serially.
+    :return: The tile map: the ``key`` of the montage, its ``tile`` size and
+        ``columns``, and per frame its ``hash`` and the ``x``, ``y``, ``width``
+        and ``height`` of its tile in the sprite sheet.
+    """
+    import imageio
+
+    from tagcam.user.importer import bounded_map
+
+    items = list(items)
+    key = montage_key(datahash for datahash, _ in items)
+    if store.exists(key, 'tilemap') and store.exists(key, 'montage'):
+        with open(store.path(key, 'tilemap')) as f:
+            return json.load(f)
+
+    frames = list(bounded_map(partial(montage_tile, tile=tile), (path for _, path in items), workers))
+    columns = columns or int(np.ceil(np.sqrt(len(frames))))
+    rows = -(-len(frames) // columns)
+    limits = contrast_limits(np.concatenate([frame.ravel() for frame in frames]))
+
+    sheet = np.zeros((rows * tile, columns * tile), dtype=np.uint8)
+    tiles = []
+    for i, ((datahash, _), frame) in enumerate(zip(items, frames)):
+        y, x = i // columns * tile, i % columns * tile
+        sheet[y:y + frame.shape[0], x:x + frame.shape[1]] = scale(frame, limits)
+        tiles.append(dict(hash=datahash, x=x, y=y, width=frame.shape[1], height=frame.shape[0]))
+    tilemap = dict(key=key, tile=tile, columns=columns, width=sheet.shape[1], height=sheet.shape[0], tiles=tiles)
+
+    store.write(key, 'montage', lambda path: imageio.imwrite(path, colorize(sheet)))
+    store.write(key, 'tilemap', lambda path: _write_json(path, tilemap))
+    return tilemap
+
+
+def pyramid_levels(shape, tile=pyramid_tile_size):
+    """Number of zoom levels of a frame: level 0 fits in one tile and the last is full resolution."""
+    return max(0, int(np.ceil(np.log2(max(shape) / tile)))) + 1
+
+
+def level_shape(shape, level, levels):
+    """Shape of a frame at a zoom level; each level halves the next, rounding up."""
+    factor = 2 ** (levels - 1 - level)
+    return -(-shape[0] // factor), -(-shape[1] // factor)
+
+
+def pyramid_info(shape, tile=pyramid_tile_size):
+    """The info of a frame's tile pyramid: frame ``width`` and ``height``, ``tile`` size and number of ``levels``."""
+    return dict(width=shape[1], height=shape[0], tile=tile, levels=pyramid_levels(shape, tile))
+
+
+def has_tile(info, level, col, row):
+    """Whether a pyramid with info has a tile at level, col and row."""
+    if not 0 <= level < info['levels']:
+        return False
+    rows, columns = level_shape((info['height'], info['width']), level, info['levels'])
+    return 0 <= col < -(-columns // info['tile']) and 0 <= row < -(-rows // info['tile'])
+
+
+def read_pyramid_info(item, store, tile=pyramid_tile_size):
+    """Return the stored pyramid info of a ``(hash, path, frame)`` item, or store it from the frame's header.
+
+    :return: None if the info is not stored and the header does not give the frame's shape.
+    """
+    datahash, path, frame = item
+    if store.exists(datahash, 'pyramid'):
+        with open(store.path(datahash, 'pyramid')) as f:
+            return json.load(f)
+    shape = frame_shape(path, frame)
+    if shape is None:
+        return None
+    info = pyramid_info(shape, tile)
+    store.write(datahash, 'pyramid', lambda path: _write_json(path, info))
+    return info
+
+
+def render_pyramid_level(item, level, store, tile=pyramid_tile_size):
+    """Decode a ``(hash, path, frame)`` item and write every tile of one level of its zoom pyramid.
+
+    The whole frame is normalized once, like the preview, so tiles of every
+    level share its contrast. The tiles of a level appear together, in one
+    directory rename. The pyramid's :func:`pyramid_info` is written alongside.
+
+    :return: The pyramid info.
+    :raises ValueError: If the frame has no such level; checked before
+        decoding when the info is stored or the header gives the frame's shape.
+    """
+    import imageio
+    from skimage.transform import resize
+
+    datahash, path, frame = item
+    info = read_pyramid_info(item, store, tile)
+    if info is not None and not has_tile(info, level, 0, 0):
+        raise ValueError(f'Frame {datahash} has no zoom level {level}')
+    data = normalize(read_frame(path, frame))
+    info = pyramid_info(data.shape, tile)
+    levels = info['levels']
+    if not 0 <= level < levels:
+        raise ValueError(f'Frame {datahash} has no zoom level {level}')
+
+    shape = level_shape(data.shape, level, levels)
+    if shape != data.shape:
+        data = np.round(resize(block_mean(data, shape), shape, preserve_range=True)).astype(np.uint8)
+    colored = colorize(data)
+
+    def write_tiles(directory):
+        for row, y in enumerate(range(0, shape[0], tile)):
+            for col, x in enumerate(range(0, shape[1], tile)):
+                imageio.imwrite(os.path.join(directory, f'{col}_{row}.jpg'), colored[y:y + tile, x:x + tile])
+
+    store.write_directory(os.path.dirname(store.tile_path(datahash, level, 0, 0)), write_tiles)
+    if not store.exists(datahash, 'pyramid'):
+        store.write(datahash, 'pyramid', lambda path: _write_json(path, info))
+    return info
+
+
+def _write_json(path, obj):
+    with open(path, 'w') as f:
+        json.dump(obj, f)
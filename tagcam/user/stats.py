@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+"""Tagging statistics.
+
+Totals, per-user, per-label and per-day tag counts are kept in small
+counter tables that are bumped in the same transaction as each tag or
+import write, so reading them costs the same however long the tag history
+is. :func:`reconcile` recounts them from the base tables and corrects any
+drift; the import job runner runs it every ``STATS_RECONCILE_SECONDS`` and
+``flask reconcile-stats`` runs it by hand. :func:`drift` only reports it.
+"""
+import datetime as dt
+
+from flask import current_app
+from sqlalchemy import case, func
+
+from tagcam.extensions import cache
+from tagcam.user.models import Counter, DataFile, DayStat, LabelStat, Tag, User, UserStat, db
+
+cache_key = 'tagcam.stats'
+
+
+def _bump(model, key, amount):
+    """Add to a counter row in the current transaction, creating it if needed.
+
+    A concurrent creation of the same row surfaces as an IntegrityError at
+    commit, which the tag write path retries.
+    """
+    column = model.__table__.primary_key.columns.values()[0]
+    updated = (db.session.query(model).filter(column == key)
+               .update({model.value: model.value + amount}, synchronize_session=False))
+    if not updated:
+        db.session.add(model(**{column.name: key, 'value': amount}))
+        db.session.flush()
+
+
+def record_tags(username, labels, completed):
+    """Count newly recorded tags in the current transaction.
+
+    :param username: Id of the tagging user.
+    :param labels: One collection of label names per new tag.
+    :param completed: How many data files got their last needed tag.
+    """
+    labels = list(labels)
+    if not labels:
+        return
+    _bump(Counter, 'tags', len(labels))
+    if completed:
+        _bump(Counter, 'remaining', -completed)
+    _bump(UserStat, username, len(labels))
+    _bump(DayStat, dt.datetime.utcnow().date(), len(labels))
+    for label in Tag.tags:
+        count = sum(label in tag for tag in labels)
+        if count:
+            _bump(LabelStat, label, count)
+
+
+def record_import(inserted):
+    """Count newly imported data files in the current transaction."""
+    if inserted:
+        _bump(Counter, 'datafiles', inserted)
+        _bump(Counter, 'remaining', inserted)
+
+
+def recount(tags_per_file=2):
+    """Count what every counter should hold from the tags and datafiles tables.
+
+    :return: A dict of dicts, keyed by counter table (``counters``, ``users``,
+        ``days`` and ``labels``) and then by counter key.
+    """
+    counters = {'tags': db.session.query(func.count(Tag.id)).scalar(),
+                'datafiles': db.session.query(func.count(DataFile.hash)).scalar(),
+                'remaining': db.session.query(func.count(DataFile.hash))
+                                       .filter(DataFile.tagged < tags_per_file).scalar()}
+    users = db.session.query(Tag.username, func.count(Tag.id)).group_by(Tag.username).all()
+    days = db.session.query(func.date(Tag.created_at), func.count(Tag.id)).group_by(func.date(Tag.created_at)).all()
+    label_sums = db.session.query(*[func.sum(case([(Tag.has_labels([label]), 1)], else_=0))
+                                    for label in Tag.label_bits]).one()
+    return dict(counters=counters, users=dict(users),
+                days={day if isinstance(day, dt.date) else dt.datetime.strptime(day, '%Y-%m-%d').date(): value
+                      for day, value in days},
+                labels={label: value or 0 for label, value in zip(Tag.label_bits, label_sums)})
+
+
+#: Counter tables by their key in :func:`recount`, with the prefix :func:`drift` names their counters with
+_tables = dict(counters=(Counter, ''), users=(UserStat, 'user:'), days=(DayStat, 'day:'), labels=(LabelStat, 'label:'))
+
+
+def _compare(tags_per_file):
+    """Yield ``(table, key, counted, actual)`` for every counter that is off."""
+    actual = recount(tags_per_file)
+    for table, (model, _) in _tables.items():
+        column = model.__table__.primary_key.columns.values()[0]
+        counted = dict(db.session.query(column, model.value))
+        for key in set(counted) | set(actual[table]):
+            values = counted.get(key, 0), actual[table].get(key, 0)
+            if values[0] != values[1]:
+                yield (table, key) + values
+
+
+def reconcile(tags_per_file=2):
+    """Correct every counter from the tags and datafiles tables in one transaction.
+
+    The ``counters`` rows are locked first. Tag and import writes bump one of
+    them before any other counter, so they wait until the correction is
+    committed instead of racing it, and the corrections are applied as
+    increments rather than by rewriting the rows. User and day counters left
+    at zero are removed.
+
+    :return: The number of counters that were corrected.
+    """
+    db.session.query(Counter).with_for_update().all()
+    corrected = 0
+    for table, key, counted, actual in list(_compare(tags_per_file)):
+        _bump(_tables[table][0], key, actual - counted)
+        corrected += 1
+    for model in (UserStat, DayStat):
+        db.session.query(model).filter(model.value == 0).delete(synchronize_session=False)
+    db.session.commit()
+    cache.delete(cache_key)
+    return corrected
+
+
+def drift(tags_per_file=2):
+    """Compare the counters with the tags and datafiles tables, without repairing them.
+
+    :return: ``{counter: (counted, actual)}`` for every counter that is off,
+        named like ``tags``, ``user:<id>``, ``day:<date>`` or ``label:<label>``.
+    """
+    drifted = {}
+    for table, key, counted, actual in _compare(tags_per_file):
+        name = key.isoformat() if isinstance(key, dt.date) else key
+        drifted[f'{_tables[table][1]}{name}'] = counted, actual
+    return drifted
+
+
+def snapshot(leaders=10, recent_days=30):
+    """Read the current statistics from the counter tables."""
+    counters = dict(db.session.query(Counter.name, Counter.value))
+    leaderboard = (db.session.query(User.username, UserStat.value)
+                   .join(UserStat, UserStat.username == User.id)
+                   .order_by(UserStat.value.desc()).limit(leaders))
+    labels = dict(db.session.query(LabelStat.label, LabelStat.value))
+    days = db.session.query(DayStat.day, DayStat.value).order_by(DayStat.day.desc()).limit(recent_days)
+    return dict(tags=counters.get('tags', 0),
+                datafiles=counters.get('datafiles', 0),
+                remaining=counters.get('remaining', 0),
+                leaderboard=[dict(username=username, tags=value) for username, value in leaderboard],
+                labels={label: labels.get(label, 0) for label in Tag.tags},
+                days=[dict(day=day.isoformat(), tags=value) for day, value in days])
+
+
+def cached_snapshot():
+    """The statistics, cached for ``STATS_CACHE_SECONDS``."""
+    stats = cache.get(cache_key)
+    if stats is None:
+        stats = snapshot()
+        cache.set(cache_key, stats, timeout=current_app.config['STATS_CACHE_SECONDS'])
+    return stats
@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+"""Recording of image tags.
+
+A batch of tags is written in one transaction: the new ``tags`` rows, a
+server-side ``tagged = tagged + 1`` on their data files and the work queue
+update commit together, so concurrent taggers cannot lose increments. The
+unique (username, hash) constraint on ``tags`` makes resubmitting a tag a
+no-op. The statistics counters are bumped in the same transaction.
+"""
+from sqlalchemy import func
+from sqlalchemy.exc import IntegrityError
+
+from tagcam.user import stats, workqueue
+from tagcam.user.models import DataFile, Tag, db
+
+
+class TagError(ValueError):
+    """A tag submission that cannot be recorded."""
+
+
+def _insert(username, submissions, paths):
+    hashes = list(submissions)
+    existing = {datahash for datahash, in
+                db.session.query(Tag.hash).filter(Tag.username == username, Tag.hash.in_(hashes))}
+    new = [datahash for datahash in hashes if datahash not in existing]
+    if not new:
+        return 0
+
+    db.session.bulk_insert_mappings(Tag, [
+        dict(username=username, path=paths[datahash], hash=datahash, labels=Tag.labels_mask(submissions[datahash]),
+             **{label: label in submissions[datahash] for label in Tag.tags})
+        for datahash in new])
+    (db.session.query(DataFile).filter(DataFile.hash.in_(new))
+     .update({DataFile.tagged: DataFile.tagged + 1}, synchronize_session=False))
+    workqueue.complete(new, username)
+    completed = (db.session.query(func.count(DataFile.hash))
+                 .filter(DataFile.hash.in_(new), DataFile.tagged == workqueue.tags_per_file).scalar())
+    stats.record_tags(username, [submissions[datahash] for datahash in new], completed)
+    db.session.commit()
+    return len(new)
+
+
+def record_tags(username, submissions, retries=2):
+    """Record a batch of tag submissions in a single transaction.
+
+    Either every submission is recorded or, if any is invalid, none is. Files
+    the user already tagged, including repeats within the batch, are skipped.
+
+    :param username: Id of the tagging user.
+    :param submissions: Iterable of ``(hash, labels)``, labels being the names
+        from :attr:`Tag.tags` that apply to the image.
+    :param retries: Attempts left after losing a race with a concurrent
+        submission of the same tag.
+    :return: The number of newly recorded tags.
+    """
+    batch = {}
+    for datahash, labels in submissions:
+        batch.setdefault(datahash, set(labels))
+
+    unknown = set().union(*batch.values()) - set(Tag.tags)
+    if unknown:
+        raise TagError('Unknown labels: {}'.format(', '.join(sorted(unknown))))
+
+    paths = dict(db.session.query(DataFile.hash, DataFile.path).filter(DataFile.hash.in_(list(batch))))
+    if set(batch) - set(paths):
+        raise TagError('Unknown data files: {}'.format(', '.join(sorted(set(batch) - set(paths)))))
+
+    while True:
+        try:
+            return _insert(username, batch, paths)
+        except IntegrityError:
+            db.session.rollback()
+            if not retries:
+                raise
+            retries -= 1
@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+"""Group-based tomography tagging.
+
+Tomography frames are rated a whole group at a time: every reconstruction of
+the same slice with a different parameter value shares a ``groupid``. The
+next group is picked with one query on the partial index of under-tagged
+frames, starting at a random point in the (hash-valued) group ids so
+concurrent taggers are spread over the data set, and all ratings of a group
+are recorded in one transaction with a bulk ``tagged = tagged + 1``.
+"""
+import random
+
+from sqlalchemy import and_
+from sqlalchemy.sql import exists
+
+from tagcam.user.models import TomoDataFile, TomoTag, db
+from tagcam.user.workqueue import tags_per_file
+
+ratings = (1, 2, 3, 4, 5)
+
+
+class RatingError(ValueError):
+    """A group rating that cannot be recorded."""
+
+
+def _group_after(username, start):
+    rated = exists().where(and_(TomoTag.hash == TomoDataFile.hash, TomoTag.username == username))
+    groupid = (db.session.query(TomoDataFile.groupid)
+               .filter(TomoDataFile.tagged < tags_per_file, TomoDataFile.groupid >= start, ~rated)
+               .order_by(TomoDataFile.groupid).limit(1).as_scalar())
+    return (db.session.query(TomoDataFile).filter(TomoDataFile.groupid == groupid)
+            .order_by(TomoDataFile.value, TomoDataFile.hash).all())
+
+
+def next_group(username):
+    """Return the frames of a group the user has not rated that still needs ratings, ordered by value.
+
+    :return: A list of :class:`TomoDataFile`; empty when there is nothing left to rate.
+    """
+    return _group_after(username, '{:040x}'.format(random.getrandbits(160))) or _group_after(username, '')
+
+
+def record_ratings(username, groupid, group_ratings):
+    """Record a user's ratings of every frame of a group in one transaction.
+
+    Frames the user already rated are skipped.
+
+    :param group_ratings: Dict of frame hash to rating.
+    :return: The number of newly recorded ratings.
+    """
+    members = dict(db.session.query(TomoDataFile.hash, TomoDataFile.path).filter(TomoDataFile.groupid == groupid))
+    if not members or set(group_ratings) != set(members):
+        raise RatingError('Every frame of the group must be rated')
+    if not set(group_ratings.values()) <= set(ratings):
+        raise RatingError('Ratings must be one of {}'.format(', '.join(map(str, ratings))))
+
+    rated = {datahash for datahash, in
+             db.session.query(TomoTag.hash).filter(TomoTag.username == username, TomoTag.hash.in_(list(members)))}
+    new = [datahash for datahash in members if datahash not in rated]
+    if not new:
+        return 0
+
+    db.session.bulk_insert_mappings(TomoTag, [
+        dict(username=username, path=members[datahash], hash=datahash, rating=group_ratings[datahash])
+        for datahash in new])
+    (db.session.query(TomoDataFile).filter(TomoDataFile.hash.in_(new))
+     .update({TomoDataFile.tagged: TomoDataFile.tagged + 1}, synchronize_session=False))
+    db.session.commit()
+    return len(new)
@@ -1,15 +1,18 @@
 # -*- coding: utf-8 -*-
 """User views."""
-from flask import Blueprint, render_template, make_response, flash, session, redirect, url_for
+from flask import Blueprint, render_template, make_response, flash, session, redirect, url_for, jsonify, request, \
+    current_app, abort, send_file
 from tagcam.utils import flash_errors
-from flask_login import login_required
-from .forms import TagForm, ImportDataForm, TomoTagForm, ImportTomoDataForm
-from tagcam.user.models import Tag, DataFile, TomoTag, TomoDataFile, db
-from sqlalchemy.sql import exists
+from flask_login import login_required, current_user
+from .forms import TagForm, ImportDataForm, TomoTagForm, ImportTomoDataForm, ensure_derivatives, ensure_montage, \
+    preview_url
+from . import stats, workqueue
+from .derivatives import DerivativeStore, hash_pattern
+from .jobs import import_jobs
+from .tagging import TagError, record_tags
+from .tomotagging import RatingError, next_group, record_ratings
+from tagcam.user.models import Tag, DataFile, TomoDataFile, ImportJob, db
 import os
-import glob
-import fabio
-import hashlib
 from uuid import uuid4
 
 blueprint = Blueprint('user', __name__, url_prefix='/users', static_folder='../static')
@@ -29,19 +32,15 @@ def tag():
     form = TagForm()
     if form.validate_on_submit():
 
-        newtag = Tag(hash=form.hash.data,
-                     path=form.path.data,
-                     username=session["user_id"],
-                     **{taglabel: getattr(form, taglabel).data for taglabel in form.tags},
-                     )
-        newtag.save()
+        labels = [taglabel for taglabel in form.tags if getattr(form, taglabel).data]
+        try:
+            record_tags(current_user.id, [(form.hash.data, labels)])
+        except TagError as e:
+            db.session.rollback()
+            flash(str(e), 'warning')
+            return redirect(url_for('user.tag'))
 
-        datafile = db.session.query(DataFile).filter_by(hash=form.hash.data).first()
-        datafile.tagged += 1
-
-        db.session.commit()
-
-        tags = ', '.join([taglabel for taglabel in form.tags if getattr(form, taglabel).data])
+        tags = ', '.join(labels)
         if tags:
             flash(f'Image tagged with {tags}!', 'success')
 
@@ -52,136 +51,260 @@ def tag():
         flash_errors(form)
     return render_template('users/tag.html', form=form)
 
-@blueprint.route('/tomotag/', methods=['GET', 'POST'])
+@blueprint.route('/api/work/')
 @login_required
-def tomotag():
-    """Tag an image."""
-    form = TomoTagForm()
-    print('dir:', dir(form))
-    if form.validate_on_submit():
+def api_work():
+    """ Lease the next images to tag, as JSON
+
+    Nothing is rendered here; a preview the import did not pre-render is
+    rendered by the preview route when the client fetches it.
+    """
+    count = max(1, min(request.args.get('n', 1, type=int), current_app.config['TAG_API_MAX_BATCH']))
+    hashes = workqueue.lease(current_user.id, count=count, seconds=current_app.config['TAG_LEASE_SECONDS'])
+    datafiles = {datafile.hash: datafile for datafile in DataFile.query.filter(DataFile.hash.in_(hashes))}
+
+    items = []
+    for datahash in hashes:
+        datafile = datafiles.get(datahash)
+        if datafile is None:
+            continue  # Deleted since it was leased
+        items.append(dict(hash=datahash, path=datafile.path, frame=datafile.frame, preview=preview_url(datahash)))
+    return jsonify(items=items, labels=list(Tag.tags))
+
+
+@blueprint.route('/api/tags/', methods=['POST'])
+@login_required
+def api_tags():
+    """ Record a batch of tags in one transaction
+
+    Expects ``{"tags": [{"hash": ..., "labels": [...]}, ...]}``.
+    """
+    payload = request.get_json(silent=True) or {}
+    try:
+        submissions = [(submission['hash'], submission.get('labels', [])) for submission in payload['tags']]
+        recorded = record_tags(current_user.id, submissions)
+    except (KeyError, TypeError):
+        return jsonify(error='Expected {"tags": [{"hash": ..., "labels": [...]}, ...]}'), 400
+    except TagError as e:
+        db.session.rollback()
+        return jsonify(error=str(e)), 400
+    return jsonify(recorded=recorded)
+
+
+@blueprint.route('/stats/')
+@login_required
+def tagstats():
+    """ Show tagging progress and the leaderboard """
+    return render_template('users/stats.html', stats=stats.cached_snapshot())
 
-        newtag = TomoTag(hash=form.hash.data,
-                     path=form.path.data,
-                     username=session["user_id"],
-                     **{taglabel: getattr(form, taglabel).data for taglabel in form.tags},
-                     )
-        newtag.save()
 
-        datafile = db.session.query(DataFile).filter_by(hash=form.hash.data).first()
-        datafile.tagged += 1
+@blueprint.route('/api/stats/')
+@login_required
+def api_stats():
+    """ Tagging progress and the leaderboard, as JSON """
+    return jsonify(stats.cached_snapshot())
+
+
+def send_immutable(store, path, etag, mimetype='image/jpeg'):
+    """ Serve a content-addressed file from the preview directory with immutable caching
+
+    The file name is a content hash, so it makes a strong ETag and the
+    response may be cached forever. With ``PREVIEW_OFFLOAD`` set, the front
+    proxy sends the file instead of the worker.
+    """
+    if request.if_none_match.contains(etag):
+        response = current_app.response_class(status=304)
+    elif not os.path.isfile(path):
+        abort(404)
+    else:
+        offload = current_app.config['PREVIEW_OFFLOAD']
+        if offload == 'x-accel-redirect':
+            response = current_app.response_class(mimetype=mimetype)
+            relpath = os.path.relpath(path, store.preview_dir).replace(os.sep, '/')
+            response.headers['X-Accel-Redirect'] = current_app.config['PREVIEW_ACCEL_PREFIX'] + relpath
+        elif offload == 'x-sendfile':
+            response = current_app.response_class(mimetype=mimetype)
+            response.headers['X-Sendfile'] = path
+        else:
+            response = send_file(path, mimetype=mimetype, add_etags=False,
+                                 cache_timeout=current_app.config['PREVIEW_CACHE_SECONDS'])
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = f'public, max-age={current_app.config["PREVIEW_CACHE_SECONDS"]}, immutable'
+    return response
+
+
+@blueprint.route('/previews/<any(preview, montage):kind>/<key>.jpg')
+def preview(kind, key):
+    """ Serve a rendered preview or montage, rendering a missing preview for a signed-in user """
+    if not hash_pattern.match(key):
+        abort(404)
+    store = DerivativeStore.from_config(current_app.config)
+    path = store.path(key, kind)
+    etag = f'{kind}-{key}'
+    if (kind == 'preview' and current_user.is_authenticated and not request.if_none_match.contains(etag)
+            and not os.path.isfile(path)):
+        datafile = DataFile.query.get(key)
+        if datafile is not None:
+            try:
+                ensure_derivatives(datafile)
+            except (OSError, ValueError, IndexError):
+                abort(404)
+    return send_immutable(store, path, etag)
 
-        db.session.commit()
 
-        # tags = ', '.join([taglabel for taglabel in form.tags if getattr(form, taglabel).data])
-        # if tags:
-        #     flash(f'Image tagged with {tags}!', 'success')
+def _tiled_item(datahash):
+    datafile = DataFile.query.get(datahash)
+    if datafile is None:
+        abort(404)
+    return datafile.item
 
-        # reset state
-        return redirect(url_for('user.tomotag'))
 
-    else:
-        flash_errors(form)
-    return render_template('users/tomotag.html', form=form)
+def _render_pyramid_level(store, item, level):
+    from .render import render_pyramid_level  # Keeps numpy/fabio/skimage out of worker start-up
 
+    try:
+        render_pyramid_level(item, level, store)
+    except (OSError, ValueError, IndexError):
+        abort(404)
 
-import_blacklist = ['autoexpose_test', 'beamstop_test', '_lo_', '_low_']
 
-def checkblacklist(path):
-    for s in import_blacklist:
-        if s in path:
-            try:
-                os.remove(path)
-            except OSError:
-                pass
-            return True
+# The URL the tile viewer appends ``info.json`` and tile paths to; it serves nothing itself
+blueprint.add_url_rule('/tiles/<datahash>/', 'tiles', build_only=True)
 
 
-@blueprint.route('/importdata/', methods=['GET', 'POST'])
+@blueprint.route('/tiles/<datahash>/info.json')
 @login_required
-def importdata():
-    """ Add data files to database """
-    form = ImportDataForm()
-    if form.validate_on_submit():
-        duplicates = 0
-        deleted = 0
-        candidates = glob.glob(f'{form.path.data}/**/*', recursive=True)
-        for path in candidates:
-            if os.path.isfile(path):
+def tile_info(datahash):
+    """ Serve the size and zoom levels of a frame's tile pyramid
+
+    The import writes it; otherwise it is read from the frame's header, or
+    level 0 is rendered for formats without one.
+    """
+    if not hash_pattern.match(datahash):
+        abort(404)
+    store = DerivativeStore.from_config(current_app.config)
+    path = store.path(datahash, 'pyramid')
+    if not os.path.isfile(path):
+        from .render import read_pyramid_info
+
+        item = _tiled_item(datahash)
+        if read_pyramid_info(item, store) is None:
+            _render_pyramid_level(store, item, 0)
+    return send_immutable(store, path, f'pyramid-{datahash}', mimetype='application/json')
+
+
+@blueprint.route('/tiles/<datahash>/<int:level>/<int:col>_<int:row>.jpg')
+@login_required
+def tile(datahash, level, col, row):
+    """ Serve a zoom tile of a frame, rendering its whole level on first request
+
+    Tiles outside the pyramid are not found without decoding the frame.
+    Levels are written with one directory rename, so an existing level
+    directory holds every tile of the level.
+    """
+    if not hash_pattern.match(datahash):
+        abort(404)
+    store = DerivativeStore.from_config(current_app.config)
+    path = store.tile_path(datahash, level, col, row)
+    etag = f'tile-{datahash}-{level}-{col}-{row}'
+    if not request.if_none_match.contains(etag) and not os.path.isdir(os.path.dirname(path)):
+        from .render import has_tile, read_pyramid_info
+
+        item = _tiled_item(datahash)
+        info = read_pyramid_info(item, store)
+        if info is not None and not has_tile(info, level, col, row):
+            abort(404)
+        _render_pyramid_level(store, item, level)
+    return send_immutable(store, path, etag)
+
+
+def _group_members(groupid):
+    return (TomoDataFile.query.filter_by(groupid=groupid)
+            .order_by(TomoDataFile.value, TomoDataFile.hash).all())
 
-                if checkblacklist(path):
-                    continue
 
-                path = os.path.abspath(path)
+@blueprint.route('/tomotag/', methods=['GET', 'POST'])
+@login_required
+def tomotag():
+    """Rate every frame of a tomography group."""
+    if request.method == 'POST':
+        form = TomoTagForm.for_submission()
+        if form.validate_on_submit():
+            try:
+                record_ratings(current_user.id, form.groupid.data, form.submitted_ratings())
+            except RatingError as e:
+                db.session.rollback()
+                flash(str(e), 'warning')
+            else:
+                flash('Group rated!', 'success')
+            return redirect(url_for('user.tomotag'))
+        flash_errors(form)
 
-                try:
-                    data = fabio.open(path).data
-                except OSError:
-                    continue
+        members = _group_members(form.groupid.data)
+        if members:
+            # Show the same group again with the user's ratings and the errors
+            form.hashes.data = ','.join(member.hash for member in members)
+            return render_template('users/tomotag.html', form=form, members=members, montage=ensure_montage(members))
 
-                datahash = hashlib.sha1(data).hexdigest()
+    members = next_group(current_user.id)
+    if not members:
+        flash('There are no tomography groups left to rate.', 'info')
+        return render_template('users/tomotag.html', form=None, members=[])
+    return render_template('users/tomotag.html', form=TomoTagForm.for_group(members), members=members,
+                           montage=ensure_montage(members))
 
-                stmt = exists().where(DataFile.hash == datahash)
-                duplicate = bool(list(db.session.query(DataFile).filter(stmt)))
-                duplicates += duplicate
 
-                if duplicate:
-                    continue
+@blueprint.route('/api/montage/<groupid>/')
+@login_required
+def api_montage(groupid):
+    """ The montage of a tomography group and its tile map, as JSON """
+    members = _group_members(groupid)
+    if not members:
+        return jsonify(error='Unknown group'), 404
+    montage = ensure_montage(members)
+    if montage is None:
+        return jsonify(error='The group could not be rendered'), 500
+    return jsonify(montage)
 
-                DataFile(datahash, path, session['user_id']).save()
 
-        flash(f'Imported {len(candidates)} files into database for tagging! '
-              f'Found {duplicates} duplicates. Deleted {deleted} blacklisted files.', 'success')
+@blueprint.route('/importdata/', methods=['GET', 'POST'])
+@login_required
+def importdata():
+    """ Add data files to database """
+    form = ImportDataForm()
+    job = None
+    if form.validate_on_submit():
+        job = import_jobs.submit('data', form.path.data, session['user_id'])
+        flash(f'Import job #{job.id} started for {job.path}.', 'success')
     else:
         flash_errors(form)
-    return render_template('users/importdata.html', form=form)
+    return render_template('users/importdata.html', form=form, job=job)
 
-# /home/rp/Downloads/20180531_123413_bp-c-40-sprayRingPRwidth0050______00963.tiff
-# /home/rp/Downloads/20180531_123413_bp-c-40-spray_00963_Ring Removal_width_0050.tiff
 
 @blueprint.route('/importtomodata/', methods=['GET', 'POST'])
 @login_required
 def importtomodata():
     """ Add data files to database """
     form = ImportTomoDataForm()
+    job = None
     if form.validate_on_submit():
-        duplicates = 0
-        deleted = 0
-        candidates = glob.glob(f'{form.path.data}/**/*.tif*', recursive=True)
-        for path in candidates:
-            if os.path.isfile(path):
-
-                # if checkblacklist(path):
-                #     continue
-
-                path = os.path.abspath(path)
-
-                try:
-                    data = fabio.open(path).data
-                except OSError:
-                    continue
-
-                datahash = hashlib.sha1(data).hexdigest()
-
-                stmt = exists().where(DataFile.hash == datahash)
-                duplicate = bool(list(db.session.query(DataFile).filter(stmt)))
-                duplicates += duplicate
-
-                if duplicate:
-                    continue
+        job = import_jobs.submit('tomo', form.path.data, session['user_id'])
+        flash(f'Import job #{job.id} started for {job.path}.', 'success')
+    else:
+        flash_errors(form)
+    return render_template('users/importdata.html', form=form, job=job)
 
-                basename = os.path.splitext(os.path.basename(path))[0]
-                frame = basename.split('_')[-1]
-                value = basename.split('_')[-2]
-                parameter = basename.split('_')[-3]
-                operation = basename.split('_')[-4]
-                operationtype = basename.split('_')[-5]
 
-                groupid = hashlib.sha1(basename[:-2].encode()).hexdigest()
+@blueprint.route('/importjobs/<int:job_id>/')
+@login_required
+def importjob(job_id):
+    """ Progress of an import job """
+    return jsonify(ImportJob.query.get_or_404(job_id).as_dict())
 
-                TomoDataFile(datahash, path, session['user_id'], groupid=groupid, value=value, parameter=parameter, operation=operation, operationtype=operationtype).save()
 
-        flash(f'Imported {len(candidates)} files into database for tagging! '
-              f'Found {duplicates} duplicates. Deleted {deleted} blacklisted files.', 'success')
-    else:
-        flash_errors(form)
-    return render_template('users/importdata.html', form=form)
\ No newline at end of file
+@blueprint.route('/importjobs/<int:job_id>/cancel/', methods=['POST'])
+@login_required
+def cancelimportjob(job_id):
+    """ Ask an import job to stop """
+    job = import_jobs.cancel(ImportJob.query.get_or_404(job_id))
+    return jsonify(job.as_dict())
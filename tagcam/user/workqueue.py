@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+"""Tagging work queue.
+
+Data files that still need tags sit in the ``workqueue`` table under a
+random, indexed position. Taggers lease items from the front of that index
+for a short time; a lease is taken with a compare-and-set update so two
+taggers never get the same item, and an expired lease simply makes the item
+available again. Items leave the queue once they have enough tags, so
+dequeuing costs the same however many files have been tagged.
+"""
+import datetime as dt
+import random
+
+from sqlalchemy import and_, or_
+from sqlalchemy.sql import exists
+
+from tagcam.user.models import DataFile, Tag, WorkItem, db
+
+#: Tags wanted per data file
+tags_per_file = 2
+
+
+def _position():
+    return random.randrange(2 ** 31)
+
+
+def enqueue(hashes):
+    """Add data files to the queue in the current transaction."""
+    db.session.bulk_insert_mappings(WorkItem, [dict(hash=datahash, position=_position()) for datahash in hashes])
+
+
+def _available(now):
+    return or_(WorkItem.lease_expires.is_(None), WorkItem.lease_expires < now)
+
+
+def _claim(datahash, username, now, expires):
+    claimed = (db.session.query(WorkItem)
+               .filter(WorkItem.hash == datahash)
+               .filter(or_(_available(now), WorkItem.lease_user == username))
+               .update({'lease_user': username, 'lease_expires': expires}, synchronize_session=False))
+    db.session.commit()
+    return claimed == 1
+
+
+def lease(username, count=1, seconds=600, candidates=10):
+    """Lease up to count data files to a tagger.
+
+    Leases the tagger already holds are returned (and extended) first, so
+    reloading the tag page does not leak work. Files the tagger has already
+    tagged, and items left behind by deleted data files, are never handed
+    out.
+
+    :return: The leased hashes.
+    """
+    now = dt.datetime.utcnow()
+    expires = now + dt.timedelta(seconds=seconds)
+    has_datafile = exists().where(DataFile.hash == WorkItem.hash)
+
+    hashes = [datahash for datahash, in
+              db.session.query(WorkItem.hash)
+              .filter(WorkItem.lease_user == username, WorkItem.lease_expires >= now, has_datafile)
+              .order_by(WorkItem.lease_expires)
+              .limit(count)]
+    if hashes:
+        (db.session.query(WorkItem).filter(WorkItem.hash.in_(hashes))
+         .update({'lease_expires': expires}, synchronize_session=False))
+        db.session.commit()
+
+    tagged_by_user = exists().where(and_(Tag.hash == WorkItem.hash, Tag.username == username))
+    while len(hashes) < count:
+        free = [datahash for datahash, in
+                db.session.query(WorkItem.hash)
+                .filter(_available(now), has_datafile, ~tagged_by_user)
+                .order_by(WorkItem.position)
+                .limit(max(candidates, count - len(hashes)))]
+        if not free:
+            break
+        for datahash in free:
+            if _claim(datahash, username, now, expires):
+                hashes.append(datahash)
+                if len(hashes) == count:
+                    break
+    return hashes
+
+
+def complete(hashes, username):
+    """Release a tagger's leases after they tagged files, in the current transaction.
+
+    Call after the files' tag counters were updated; files that now have
+    enough tags leave the queue.
+    """
+    hashes = list(hashes)
+    if not hashes:
+        return
+    done = [datahash for datahash, in
+            db.session.query(DataFile.hash).filter(DataFile.hash.in_(hashes), DataFile.tagged >= tags_per_file)]
+    if done:
+        db.session.query(WorkItem).filter(WorkItem.hash.in_(done)).delete(synchronize_session=False)
+    (db.session.query(WorkItem)
+     .filter(WorkItem.hash.in_(hashes), WorkItem.lease_user == username)
+     .update({'lease_user': None, 'lease_expires': None}, synchronize_session=False))
+
+
+def rebuild(chunk_size=500):
+    """Refill the queue with every data file that needs more tags.
+
+    :return: The number of queued files.
+    """
+    db.session.query(WorkItem).delete(synchronize_session=False)
+    hashes = [datahash for datahash, in
+              db.session.query(DataFile.hash).filter(DataFile.tagged < tags_per_file)]
+    for start in range(0, len(hashes), chunk_size):
+        enqueue(hashes[start:start + chunk_size])
+    db.session.commit()
+    return len(hashes)
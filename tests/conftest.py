@@ -1,6 +1,8 @@
 # -*- coding: utf-8 -*-
 """Defines fixtures available to all tests."""
 
+import fabio
+import numpy as np
 import pytest
 from webtest import TestApp
 
@@ -8,6 +10,9 @@ from tagcam.app import create_app
 from tagcam.database import db as _db
 from tagcam.settings import TestConfig
 
+from tagcam.user import workqueue
+from tagcam.user.models import DataFile
+
 from .factories import UserFactory
 
 
@@ -49,3 +54,33 @@ def user(db):
     user = UserFactory(password='myprecious')
     db.session.commit()
     return user
+
+
+@pytest.fixture
+def framedir(tmpdir):
+    """A directory tree of small EDF frames, including a duplicate and a blacklisted file."""
+    rng = np.random.RandomState(0)
+    frames = [rng.randint(0, 1000, (16, 16)).astype(np.int32) for _ in range(4)]
+    tmpdir.mkdir('a').mkdir('b')
+    for i, frame in enumerate(frames):
+        fabio.edfimage.EdfImage(data=frame).write(str(tmpdir.join('a', f'frame_{i}.edf')))
+    fabio.edfimage.EdfImage(data=frames[0]).write(str(tmpdir.join('a', 'b', 'copy.edf')))
+    fabio.edfimage.EdfImage(data=frames[1] + 1).write(str(tmpdir.join('a', 'b', 'beamstop_test.edf')))
+    tmpdir.join('notes.txt').write('not a frame')
+    return tmpdir
+
+
+@pytest.fixture
+def datafiles(app, db, user, tmpdir):
+    """Queued data files backed by small frames, rendering into a temporary directory."""
+    app.config['PREVIEW_DIR'] = str(tmpdir.join('static'))
+    app.config['TRAINING_DIR'] = str(tmpdir.join('training'))
+    rng = np.random.RandomState(0)
+    datafiles = []
+    for i in range(4):
+        path = str(tmpdir.join(f'frame_{i}.edf'))
+        fabio.edfimage.EdfImage(data=rng.poisson(10, (64, 64)).astype(np.int32)).write(path)
+        datafiles.append(DataFile(f'{i:040d}', path, user.id).save())
+    workqueue.enqueue(datafile.hash for datafile in datafiles)
+    db.session.commit()
+    return datafiles
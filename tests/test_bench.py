@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+"""Benchmark suite tests."""
+import json
+
+import numpy as np
+import pytest
+
+from tagcam import bench
+from tagcam.commands import bench as bench_command
+
+
+@pytest.fixture
+def tiny_cases(monkeypatch):
+    """Detectors small enough for the benchmarks to run in a test."""
+    monkeypatch.setattr(bench, 'cases', {'tiny': ((250, 500), 'int32'), 'tiny-uint16': ((250, 500), 'uint16')})
+
+
+def test_synthetic_frame_has_module_gaps():
+    """Gaps are -1 on signed detectors and saturate unsigned ones."""
+    signed = bench.synthetic_frame((250, 500), 'int32')
+    assert (signed[195:212] == -1).all() and (signed[:, 487:494] == -1).all()
+    assert (signed[:195, :487] >= 0).all()
+    unsigned = bench.synthetic_frame((250, 500), 'uint16')
+    assert (unsigned[195:212] == np.iinfo(np.uint16).max).all()
+
+
+def test_summarize():
+    """Percentiles of timings."""
+    summary = bench.summarize(np.arange(1, 101) / 100)
+    assert summary['n'] == 100
+    assert summary['p50'] == pytest.approx(.505)
+    assert summary['max'] == 1
+    assert bench.summarize([]) == dict(n=0)
+
+
+@pytest.mark.usefixtures('tiny_cases')
+def test_bench_command_writes_json(app, tmpdir):
+    """Every case is benchmarked and the results written as JSON."""
+    output = str(tmpdir.join('bench.json'))
+    result = app.test_cli_runner().invoke(bench_command, ['-o', output, '-n', '3', '-r', '2', '--requests', '2'])
+    assert result.exit_code == 0, result.output
+
+    with open(output) as f:
+        results = json.load(f)
+    assert set(results['cases']) == {'tiny', 'tiny-uint16'}
+    case = results['cases']['tiny']
+    assert case['import']['frames'] == 3
+    assert case['render']['seconds']['n'] == 2
+    assert case['render']['peak_megabytes'] > 0
+    assert case['tag_page']['cold']['get']['n'] == 2
+    assert case['tag_page']['warm']['post']['n'] == 2
+
+
+@pytest.mark.usefixtures('tiny_cases')
+def test_bench_command_rejects_unknown_case(app, tmpdir):
+    """Unknown cases are a usage error."""
+    result = app.test_cli_runner().invoke(bench_command, ['-o', str(tmpdir.join('bench.json')), '-c', 'pilatus9m'])
+    assert result.exit_code == 2
+    assert 'pilatus9m' in result.output
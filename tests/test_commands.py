@@ -0,0 +1,16 @@
+# -*- coding: utf-8 -*-
+"""Click command tests."""
+import pytest
+
+from tagcam.commands import explain_hot_queries
+
+
+@pytest.mark.usefixtures('db')
+def test_explain_hot_queries_uses_indexes(app):
+    """The hot queries are answered from indexes, not table scans."""
+    result = app.test_cli_runner().invoke(explain_hot_queries)
+    assert result.exit_code == 0
+
+    plans = {section.split(' ==')[0]: section for section in result.output.split('== ')[1:]}
+    for name in ('tags of a file', 'tags by user', 'tomo group members', 'held leases'):
+        assert 'INDEX' in plans[name], plans[name]
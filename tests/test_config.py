@@ -1,5 +1,8 @@
 # -*- coding: utf-8 -*-
 """Test configs."""
+import subprocess
+import sys
+
 from tagcam.app import create_app
 from tagcam.settings import DevConfig, ProdConfig
 
@@ -17,3 +20,12 @@ def test_dev_config():
     app = create_app(DevConfig)
     assert app.config['ENV'] == 'dev'
     assert app.config['DEBUG'] is True
+
+
+def test_create_app_defers_scientific_imports():
+    """Creating the app does not import the render/import stack."""
+    script = ('import sys; from tagcam.app import create_app; from tagcam.settings import ProdConfig; '
+              'create_app(ProdConfig); '
+              'print(" ".join(m for m in ("numpy", "fabio", "imageio", "matplotlib", "skimage") if m in sys.modules))')
+    loaded = subprocess.check_output([sys.executable, '-c', script], universal_newlines=True)
+    assert loaded.strip() == ''
@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+"""Consensus label tests."""
+import numpy as np
+import pytest
+
+from tagcam.user import consensus
+from tagcam.user.models import Consensus
+from tagcam.user.tagging import record_tags
+
+from .factories import UserFactory
+
+
+def test_combine():
+    """Votes are grouped per file into majority, union and unanimity labels."""
+    hashes = np.array(['a', 'a', 'b', 'c', 'c', 'c'])
+    matrix = np.zeros((6, len(consensus.labels)), dtype=bool)
+    matrix[[0, 1], 0] = True
+    matrix[1, 1] = True
+    matrix[[3, 4], 2] = True
+
+    result = consensus.combine(hashes, matrix)
+
+    assert list(result['hash']) == ['a', 'b', 'c']
+    assert list(result['taggers']) == [2, 1, 3]
+    assert list(consensus.encode(result['majority'])) == [0b1, 0, 0b100]
+    assert list(consensus.encode(result['union'])) == [0b11, 0, 0b100]
+    assert list(consensus.encode(result['unanimous'])) == [0b1, 0, 0]
+    assert result['agreement'][1] == 1
+    assert result['agreement'][0] == pytest.approx(11 / 12)
+
+
+@pytest.mark.usefixtures('db')
+def test_update_is_incremental(user, datafiles):
+    """Only files with new tags are recomputed."""
+    other = UserFactory(password='myprecious').save()
+    record_tags(user.id, [(datafiles[0].hash, ['Ring', 'Arc']), (datafiles[1].hash, ['SAXS'])])
+    record_tags(other.id, [(datafiles[0].hash, ['Ring'])])
+
+    assert consensus.update() == 2
+    assert consensus.update() == 0
+    first = Consensus.query.get(datafiles[0].hash)
+    assert consensus.decode(first.unanimous) == ['Ring']
+    assert set(consensus.decode(first.union)) == {'Ring', 'Arc'}
+    assert first.taggers == 2
+
+    record_tags(other.id, [(datafiles[1].hash, ['SAXS'])])
+    assert consensus.update() == 1
+    assert consensus.decode(Consensus.query.get(datafiles[1].hash).majority) == ['SAXS']
+
+    agreement = consensus.label_agreement()
+    assert agreement['SAXS'] == 1
+    assert agreement['Arc'] == 0.5
@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+"""Dataset export tests."""
+import json
+import os
+
+import numpy as np
+import pytest
+
+from tagcam.user.derivatives import DerivativeStore
+from tagcam.user.export import complete_shards, export_dataset
+from tagcam.user.models import Tag
+from tagcam.user.render import render_file
+from tagcam.user.tagging import record_tags
+
+from .factories import UserFactory
+
+
+@pytest.fixture
+def tagged(app, user, datafiles):
+    """Rendered data files; all but the last tagged by two users."""
+    store = DerivativeStore.from_config(app.config)
+    for datafile in datafiles:
+        render_file(datafile.item, store)
+    other = UserFactory(password='myprecious').save()
+    record_tags(user.id, [(datafile.hash, ['Ring']) for datafile in datafiles])
+    record_tags(other.id, [(datafile.hash, ['Ring', 'SAXS']) for datafile in datafiles[:-1]])
+    return store
+
+
+@pytest.mark.usefixtures('db')
+class TestExportDataset:
+    """Sharded dataset export."""
+
+    def test_exports_fully_tagged_images(self, tagged, datafiles, tmpdir):
+        """Fully tagged images are written with their label votes."""
+        output = str(tmpdir.join('dataset'))
+        stats = export_dataset(output, tagged, size=128, shard_size=2)
+
+        assert stats.exported == 3
+        assert stats.shards == 2
+        with np.load(complete_shards(output)[0]) as shard:
+            assert shard['images'].shape == (2, 128, 128)
+            assert shard['images'].dtype == np.uint8
+            assert list(shard['hashes']) == [datafile.hash for datafile in datafiles[:2]]
+            assert list(shard['taggers']) == [2, 2]
+            labels = list(Tag.tags)
+            assert shard['votes'][0, labels.index('Ring')] == 2
+            assert shard['votes'][0, labels.index('SAXS')] == 1
+        with open(os.path.join(output, 'dataset.json')) as f:
+            assert json.load(f)['shards'] == ['shard-00000.npz', 'shard-00001.npz']
+
+    def test_resumes_after_complete_shards(self, tagged, tmpdir):
+        """A rerun keeps the complete shards and writes only the rest."""
+        output = str(tmpdir.join('dataset'))
+        export_dataset(output, tagged, size=128, shard_size=1)
+        with np.load(os.path.join(output, 'shard-00001.npz')) as shard:
+            second = shard['hashes'][0]
+        os.remove(os.path.join(output, 'shard-00002.npz'))
+
+        stats = export_dataset(output, tagged, size=128, shard_size=1)
+        assert stats.resumed_shards == 2
+        assert stats.exported == 1
+        assert stats.shards == 3
+        with np.load(os.path.join(output, 'shard-00002.npz')) as shard:
+            assert shard['hashes'][0] > second
+
+    def test_missing_derivatives_are_skipped(self, tagged, datafiles, tmpdir):
+        """Images without a training derivative are counted and left out."""
+        os.remove(tagged.path(datafiles[0].hash, '128'))
+        stats = export_dataset(str(tmpdir.join('dataset')), tagged, size=128)
+        assert stats.exported == 2
+        assert stats.missing == 1
@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+"""Frame reader tests."""
+import hashlib
+
+import fabio
+import h5py
+import imageio
+import numpy as np
+import pytest
+
+from tagcam.user.frames import (count_frames, drop_cache, edf_layout, frame_hash, frame_layout, is_container,
+                                linked_master, read_frame, read_frames)
+
+
+@pytest.fixture
+def data():
+    """A frame with negative gap pixels."""
+    data = np.random.RandomState(0).poisson(50, (37, 53)).astype(np.int32)
+    data[5] = -1
+    return data
+
+
+def assert_same_as_fabio(path):
+    """The frame reads and hashes as it does with fabio."""
+    got, expected = read_frame(path), fabio.open(path).data
+    assert got.dtype == expected.dtype
+    np.testing.assert_array_equal(got, expected)
+    assert frame_hash(got) == hashlib.sha1(expected).hexdigest()
+    return got
+
+
+@pytest.mark.parametrize('dtype', [np.int8, np.uint16, np.int32, np.uint32, np.float32, np.float64])
+def test_edf_is_mapped(tmpdir, data, dtype):
+    """Uncompressed EDF frames are memory-mapped."""
+    path = str(tmpdir.join('frame.edf'))
+    fabio.edfimage.EdfImage(data=data.astype(dtype)).write(path)
+    assert isinstance(assert_same_as_fabio(path), np.memmap)
+
+
+@pytest.mark.parametrize('dtype', [np.uint8, np.int16, np.int32, np.float32])
+def test_tiff_is_mapped(tmpdir, data, dtype):
+    """Uncompressed single-channel TIFF frames are memory-mapped, whoever wrote them."""
+    path = str(tmpdir.join('imageio.tif'))
+    imageio.imwrite(path, data.astype(dtype))
+    assert isinstance(assert_same_as_fabio(path), np.memmap)
+
+    path = str(tmpdir.join('fabio.tif'))
+    fabio.tifimage.TifImage(data=data.astype(dtype)).write(path)
+    assert isinstance(assert_same_as_fabio(path), np.memmap)
+
+
+def test_big_endian_edf_is_swapped(tmpdir, data):
+    """Frames not in the machine's byte order are copied into it, as fabio does."""
+    path = str(tmpdir.join('frame.edf'))
+    fabio.edfimage.EdfImage(data=data).write(path)
+    with open(path, 'rb') as f:
+        offset = edf_layout(f).offset
+        f.seek(0)
+        header = f.read(offset)
+    header = header.replace(b'LowByteFirst', b'HighByteFirst').replace(b' }', b'}', 1)
+    assert len(header) == offset
+    with open(path, 'wb') as f:
+        f.write(header + data.astype('>i4').tobytes())
+
+    assert frame_layout(path).dtype == np.dtype('>i4')
+    got = assert_same_as_fabio(path)
+    assert got.dtype.isnative
+
+
+def test_truncated_frame_falls_back(tmpdir, data):
+    """A frame shorter than its header says is not mapped."""
+    path = str(tmpdir.join('frame.edf'))
+    fabio.edfimage.EdfImage(data=data).write(path)
+    with open(path, 'r+b') as f:
+        f.truncate(edf_layout(f).offset + 10)
+    assert frame_layout(path) is None
+
+
+def test_other_formats_fall_back(tmpdir, data):
+    """Compressed and unknown formats are read with fabio."""
+    path = str(tmpdir.join('frame.edf.gz'))
+    fabio.edfimage.EdfImage(data=data).write(path)
+    assert frame_layout(path) is None
+    got = assert_same_as_fabio(path)
+    assert not isinstance(got, np.memmap)
+
+
+def test_missing_frame_raises(tmpdir):
+    """A missing file raises what the importer catches."""
+    with pytest.raises(OSError):
+        read_frame(str(tmpdir.join('missing.edf')))
+
+
+def test_junk_header_is_not_mapped(tmpdir):
+    """A file whose header cannot be parsed is left to fabio."""
+    path = tmpdir.join('junk.tif')
+    path.write(b'II*\x00junk')
+    assert frame_layout(str(path)) is None
+
+
+def test_drop_cache_ignores_missing_files(tmpdir):
+    """Dropping the cache of a missing file is harmless."""
+    drop_cache(str(tmpdir.join('missing.edf')))
+
+
+@pytest.fixture
+def master(tmpdir, data):
+    """An Eiger-style master file linking two 3-frame data files, and a third not yet written."""
+    stack = np.stack([data + i for i in range(6)])
+    for i in (1, 2):
+        with h5py.File(str(tmpdir.join(f'scan_data_{i:06d}.h5')), 'w') as f:
+            f.create_dataset('entry/data/data', data=stack[3 * (i - 1):3 * i], chunks=(1,) + data.shape,
+                             compression='gzip')
+    path = str(tmpdir.join('scan_master.h5'))
+    with h5py.File(path, 'w') as f:
+        f.create_dataset('entry/instrument/detector/detectorSpecific/pixel_mask', data=np.zeros(data.shape, np.uint32))
+        for i in (1, 2, 3):
+            f[f'entry/data/data_{i:06d}'] = h5py.ExternalLink(f'scan_data_{i:06d}.h5', 'entry/data/data')
+    return path, stack
+
+
+def test_container_frames(master):
+    """Frames are numbered across the linked data files, up to the first missing one."""
+    path, stack = master
+    assert is_container(path)
+    assert count_frames(path) == 6
+    assert [frame for frame, _ in read_frames(path, 2, 5)] == [2, 3, 4]
+    np.testing.assert_array_equal(read_frame(path, 4), stack[4])
+    with pytest.raises(ValueError):
+        read_frame(path, 6)
+
+
+def test_linked_master(master, tmpdir, data):
+    """Data files are read through the master that links them; others are containers of their own."""
+    path, _ = master
+    assert linked_master(str(tmpdir.join('scan_data_000001.h5'))) == path
+    assert linked_master(path) is None
+    with h5py.File(str(tmpdir.join('other_data_000001.h5')), 'w') as f:
+        f.create_dataset('entry/data/data', data=data[None])
+    assert linked_master(str(tmpdir.join('other_data_000001.h5'))) is None
+
+
+def test_container_without_entry_uses_every_stack(tmpdir, data):
+    """Stacks anywhere in a plain HDF5 file are frames; 2D datasets are not."""
+    path = str(tmpdir.join('plain.hdf5'))
+    with h5py.File(path, 'w') as f:
+        f.create_dataset('mask', data=data)
+        f.create_dataset('images', data=np.stack([data, data * 2]).astype('>i4'))
+    assert count_frames(path) == 2
+    got = read_frame(path, 1)
+    assert got.dtype.isnative
+    np.testing.assert_array_equal(got, data * 2)
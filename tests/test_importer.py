@@ -0,0 +1,279 @@
+# -*- coding: utf-8 -*-
+"""Import engine tests."""
+import datetime as dt
+import os
+import re
+
+import fabio
+import h5py
+import numpy as np
+import pytest
+from flask import url_for
+
+from tagcam.user import importer
+from tagcam.user.derivatives import DerivativeStore
+from tagcam.user.importer import (ImportStats, import_datafiles, import_tomodatafiles, ingest_batch, parse_tomo_name,
+                                  preload_hashes, scan_tree, tomo_name_pattern)
+from tagcam.user.jobs import claim_job, import_jobs
+from tagcam.user.models import DataFile, ImportJob, ImportManifest, TomoDataFile
+from tagcam.user.render import montage_key
+
+
+def test_scan_tree_matches_glob(framedir):
+    """Every file is found, directories are not."""
+    paths = sorted(scan_tree(str(framedir)))
+    assert len(paths) == 7
+    assert all(os.path.isfile(path) for path in paths)
+
+
+@pytest.mark.usefixtures('db')
+@pytest.mark.parametrize('workers', [0, 2])
+def test_import_datafiles(framedir, user, workers):
+    """Frames are imported once, duplicates and blacklisted files are skipped."""
+    stats = import_datafiles(str(framedir), user.id, workers=workers, batch_size=2)
+
+    assert stats.inserted == 4
+    assert stats.duplicates == 1
+    assert stats.deleted == 1
+    assert not framedir.join('a', 'b', 'beamstop_test.edf').check()
+    assert DataFile.query.count() == 4
+    assert all(os.path.isabs(datafile.path) for datafile in DataFile.query)
+    assert stats.files_per_second > 0
+
+
+@pytest.mark.usefixtures('db')
+@pytest.mark.parametrize('preload_limit', [0, 1000])
+def test_ingest_batch_catches_duplicates(user, preload_limit):
+    """Duplicates are caught against the table and within the same batch."""
+    stats = ImportStats()
+    preloaded = preload_hashes(DataFile, preload_limit)
+    ingest_batch(DataFile, [dict(hash='a' * 40, path='/a', username=user.id)], stats, preloaded)
+
+    rows = [dict(hash='a' * 40, path='/a2', username=user.id),
+            dict(hash='b' * 40, path='/b', username=user.id),
+            dict(hash='b' * 40, path='/b2', username=user.id),
+            dict(hash='c' * 40, path='/c', username=user.id)]
+    inserted = ingest_batch(DataFile, rows, stats, preloaded)
+
+    assert [row['path'] for row in inserted] == ['/b', '/c']
+    assert stats.inserted == 3
+    assert stats.duplicates == 2
+    assert DataFile.query.count() == 3
+
+
+@pytest.mark.usefixtures('db')
+def test_reimport_skips_unchanged_files(framedir, user):
+    """A second import only decodes files whose stat signature changed."""
+    import_datafiles(str(framedir), user.id, workers=0)
+    assert ImportManifest.query.count() == 5
+
+    fabio.edfimage.EdfImage(data=np.ones((16, 16), np.int32)).write(str(framedir.join('a', 'new.edf')))
+    os.utime(str(framedir.join('a', 'frame_0.edf')), ns=(0, 0))
+    stats = import_datafiles(str(framedir), user.id, workers=0)
+
+    assert stats.unchanged == 4
+    assert stats.decoded == 2
+    assert stats.duplicates == 1
+    assert stats.inserted == 1
+    assert DataFile.query.count() == 5
+
+
+@pytest.fixture
+def container(tmpdir):
+    """A directory with a 7-frame HDF5 container, one frame repeated, next to a loose frame."""
+    root = tmpdir.mkdir('containers')
+    stack = np.random.RandomState(0).poisson(10, (7, 16, 16)).astype(np.int32)
+    stack[6] = stack[0]
+    with h5py.File(str(root.join('scan.h5')), 'w') as f:
+        f.create_dataset('entry/data/data', data=stack, chunks=(1, 16, 16), compression='gzip')
+    fabio.edfimage.EdfImage(data=np.ones((16, 16), np.int32)).write(str(root.join('loose.edf')))
+    return root
+
+
+@pytest.mark.usefixtures('db')
+@pytest.mark.parametrize('workers', [0, 2])
+def test_import_container_frames(container, user, workers):
+    """Every frame of a container is a DataFile addressed by its path and index."""
+    stats = import_datafiles(str(container), user.id, workers=workers, batch_size=4, frames_per_task=3)
+
+    assert stats.scanned == 2
+    assert stats.decoded == 8
+    assert stats.inserted == 7
+    assert stats.duplicates == 1
+    path = str(container.join('scan.h5'))
+    assert sorted(datafile.frame for datafile in DataFile.query.filter_by(path=path)) == [0, 1, 2, 3, 4, 5]
+    assert ImportManifest.query.count() == 2
+
+    stats = import_datafiles(str(container), user.id, workers=workers)
+    assert stats.unchanged == 2
+    assert stats.decoded == 0
+
+
+@pytest.mark.usefixtures('db')
+def test_eiger_data_files_are_imported_through_master(tmpdir, user):
+    """Data files linked from a master are not imported a second time on their own."""
+    root = tmpdir.mkdir('eiger')
+    stack = np.random.RandomState(0).poisson(10, (4, 16, 16)).astype(np.int32)
+    for i in (1, 2):
+        with h5py.File(str(root.join(f'scan_data_{i:06d}.h5')), 'w') as f:
+            f.create_dataset('entry/data/data', data=stack[2 * (i - 1):2 * i])
+    master = str(root.join('scan_master.h5'))
+    with h5py.File(master, 'w') as f:
+        for i in (1, 2):
+            f[f'entry/data/data_{i:06d}'] = h5py.ExternalLink(f'scan_data_{i:06d}.h5', 'entry/data/data')
+
+    stats = import_datafiles(str(root), user.id, workers=0)
+    assert stats.scanned == 3
+    assert stats.decoded == stats.inserted == 4
+    assert {datafile.path for datafile in DataFile.query} == {master}
+
+
+@pytest.mark.usefixtures('db')
+def test_unreadable_container_frame_is_retried(container, user, monkeypatch):
+    """A container with an unreadable frame keeps its readable frames but gets no manifest entry."""
+    from tagcam.user import frames
+
+    read_frames = frames.read_frames
+
+    def failing(path, start=0, stop=None):
+        for frame, data in read_frames(path, start, stop):
+            if frame == 4:
+                raise OSError('Bad chunk')
+            yield frame, data
+
+    monkeypatch.setattr(frames, 'read_frames', failing)
+    stats = import_datafiles(str(container), user.id, workers=0, frames_per_task=3)
+    assert stats.inserted == 5
+    assert ImportManifest.query.filter(ImportManifest.path.endswith('scan.h5')).count() == 0
+
+    monkeypatch.setattr(frames, 'read_frames', read_frames)
+    stats = import_datafiles(str(container), user.id, workers=0)
+    assert stats.inserted == 2
+    assert ImportManifest.query.count() == 2
+
+
+@pytest.mark.usefixtures('db')
+class TestImportJobs:
+    """Background import jobs."""
+
+    def test_submit_runs_job(self, framedir, user):
+        """With no job workers the job runs inline and records its counters."""
+        job = import_jobs.submit('data', str(framedir), user.id)
+        assert job.status == 'done'
+        assert job.inserted == 4
+        assert job.duplicates == 1
+        assert job.files_per_second > 0
+
+    def test_job_is_claimed_once(self, framedir, user):
+        """A running job with a fresh heartbeat cannot be claimed again."""
+        job = ImportJob('data', str(framedir), user.id).save()
+        stale_before = dt.datetime.utcnow() - dt.timedelta(minutes=5)
+        assert claim_job(job.id, stale_before) is True
+        assert claim_job(job.id, stale_before) is False
+        assert claim_job(job.id, dt.datetime.utcnow() + dt.timedelta(minutes=5)) is True
+
+    def test_cancel_queued_job(self, framedir, user):
+        """A queued job is cancelled without running."""
+        job = import_jobs.cancel(ImportJob('data', str(framedir), user.id).save())
+        assert job.status == 'cancelled'
+        assert claim_job(job.id, dt.datetime.utcnow()) is False
+
+    def test_progress_endpoint(self, framedir, user, testapp):
+        """Progress is reported as JSON."""
+        job = import_jobs.submit('data', str(framedir), user.id)
+        res = testapp.get('/')
+        form = res.forms['loginForm']
+        form['username'] = user.username
+        form['password'] = 'myprecious'
+        form.submit().follow()
+
+        res = testapp.get(url_for('user.importjob', job_id=job.id))
+        assert res.json['status'] == 'done'
+        assert res.json['inserted'] == 4
+        assert res.json['files_per_second'] > 0
+
+    def test_stale_job_is_resumed(self, framedir, user):
+        """The sweep resumes a running job whose heartbeat stopped."""
+        job = ImportJob('data', str(framedir), user.id, status='running',
+                        updated_at=dt.datetime.utcnow() - dt.timedelta(hours=1)).save()
+        assert import_jobs.resume_stale() == [job.id]
+        assert job.status == 'done'
+        assert job.inserted == 4
+
+
+@pytest.fixture
+def tomodir(tmpdir):
+    """Two groups of tomography frames, one with an unreadable frame."""
+    rng = np.random.RandomState(0)
+    root = tmpdir.mkdir('tomo')
+    for group in ('0.5', '1.5'):
+        for frame in range(3):
+            data = rng.randint(0, 1000, (16, 16)).astype(np.uint16)
+            fabio.tifimage.TifImage(data=data).write(str(root.join(f'scan_recon_filter_sigma_{group}_00{frame}.tif')))
+    root.join('scan_recon_filter_sigma_2.5_000.tif').write('not a frame')
+    fabio.tifimage.TifImage(data=np.ones((16, 16), np.uint16)).write(
+        str(root.join('scan_recon_filter_sigma_2.5_001.tif')))
+    root.join('unmatched.tif').write('not a frame')
+    return root
+
+
+@pytest.mark.usefixtures('db')
+class TestImportTomo:
+    """Tomography import."""
+
+    def test_parse_tomo_name(self):
+        """The last five fields of the name are parsed and the group is named by its shared prefix."""
+        columns = parse_tomo_name('/a/scan_recon_filter_sigma_0.5_001.tif', re.compile(tomo_name_pattern))
+        assert columns['operationtype'] == 'recon'
+        assert columns['parameter'] == 'sigma'
+        assert columns['value'] == 0.5
+        assert parse_tomo_name('/a/scan_recon_filter_sigma_0.5_000.tif',
+                               re.compile(tomo_name_pattern))['groupid'] == columns['groupid']
+        assert parse_tomo_name('/a/unmatched.tif', re.compile(tomo_name_pattern)) is None
+
+    @pytest.mark.parametrize('workers', [0, 2])
+    def test_groups_are_imported_whole(self, tomodir, user, workers):
+        """Complete groups are inserted; a group with an unreadable frame is left out."""
+        stats = import_tomodatafiles(str(tomodir), user.id, workers=workers, batch_size=2)
+
+        assert stats.inserted == 6
+        assert TomoDataFile.query.count() == 6
+        assert TomoDataFile.query.with_entities(TomoDataFile.groupid).distinct().count() == 2
+        assert TomoDataFile.query.filter_by(value=2.5).count() == 0
+
+    def test_import_prerenders_montages(self, tomodir, user, tmpdir):
+        """The import renders the montage of every inserted group, so the rating page does not."""
+        store = DerivativeStore(str(tmpdir.join('static')), str(tmpdir.join('training')))
+        import_tomodatafiles(str(tomodir), user.id, workers=0, store=store)
+
+        groups = {}
+        for tomodatafile in TomoDataFile.query:
+            groups.setdefault(tomodatafile.groupid, []).append(tomodatafile.hash)
+        assert len(groups) == 2
+        assert all(store.exists(montage_key(hashes), 'montage') for hashes in groups.values())
+
+    def test_progress_and_batched_manifest(self, tomodir, user, tmpdir, monkeypatch):
+        """Every phase reports progress, and the manifest is looked up across groups in batches."""
+        lookups = []
+        monkeypatch.setattr(importer, 'unchanged_paths',
+                            lambda model, signatures: lookups.append(len(signatures)) or set())
+        store = DerivativeStore(str(tmpdir.join('static')), str(tmpdir.join('training')))
+        calls = []
+        import_tomodatafiles(str(tomodir), user.id, workers=0, batch_size=4, store=store,
+                             progress=lambda stats: calls.append((stats.scanned, stats.decoded, stats.inserted)))
+
+        assert lookups == [4, 4]
+        assert calls[0] == (4, 0, 0)  # While scanning
+        assert (9, 0, 0) in calls  # Between manifest lookups
+        assert sum(inserted == 6 for _, _, inserted in calls) == 1 + 2  # The last transaction, then each montage
+
+    def test_reimport_retries_incomplete_groups(self, tomodir, user):
+        """Complete groups are skipped by the manifest; a repaired group is imported."""
+        import_tomodatafiles(str(tomodir), user.id, workers=0)
+        fabio.tifimage.TifImage(data=np.zeros((16, 16), np.uint16)).write(
+            str(tomodir.join('scan_recon_filter_sigma_2.5_000.tif')))
+        stats = import_tomodatafiles(str(tomodir), user.id, workers=0)
+
+        assert stats.unchanged == 6
+        assert stats.inserted == 2
+        assert TomoDataFile.query.filter_by(value=2.5).count() == 2
@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+"""Load simulation harness tests."""
+import pytest
+from flask import url_for
+
+from tagcam.loadtest import Recorder, check_consistency, hidden_fields, image_pattern, log_tail, parse_config
+from tagcam.user.forms import preview_url
+from tagcam.user.models import Counter, DataFile
+from tagcam.user.tagging import record_tags
+
+from .test_tagging import login
+
+
+def test_parse_config():
+    """Gunicorn configurations are WORKERSxTHREADS."""
+    assert parse_config('4x2') == (4, 2)
+    for config in ('4', '0x2', 'fourxtwo'):
+        with pytest.raises(ValueError):
+            parse_config(config)
+
+
+def test_log_tail(tmpdir):
+    """A failed start reports the end of the server log, which is deleted with the work directory."""
+    log = tmpdir.join('gunicorn.log')
+    log.write(''.join(f'line {i}\n' for i in range(30)))
+    assert log_tail(str(log)) == ''.join(f'line {i}\n' for i in range(10, 30))
+
+
+def test_forms_are_parsed_from_the_pages(user, testapp, datafiles):
+    """The simulated taggers find the login and tag form fields and the preview in the real pages."""
+    assert set(hidden_fields(testapp.get('/').text, 'loginForm')) == {'csrf_token'}
+
+    login(testapp, user)
+    page = testapp.get(url_for('user.tag')).text
+    fields = hidden_fields(page, 'tagForm')
+    assert fields['hash'] in {datafile.hash for datafile in datafiles}
+    assert fields['path'] == DataFile.query.get(fields['hash']).path
+    assert image_pattern.search(page).group(1) == preview_url(fields['hash'])
+
+
+def test_recorder_summary():
+    """Error rates and throughput cover every kind of request."""
+    recorder = Recorder()
+    for seconds in (.1, .2, .3):
+        recorder.record('tag_get', seconds, True)
+    recorder.record('tag_post', .5, False)
+    recorder.tags_posted = 2
+
+    summary = recorder.as_dict(elapsed=2.)
+    assert summary['requests'] == 4
+    assert summary['error_rate'] == .25
+    assert summary['tags_per_second'] == 1
+    assert summary['latency']['tag_get']['p50'] == pytest.approx(.2)
+    assert summary['latency']['tag_post']['errors'] == 1
+
+
+@pytest.mark.usefixtures('db')
+def test_consistency_check(user, datafiles):
+    """Tag counters, the work queue and the statistics are checked against the tags."""
+    from tagcam.user import stats
+
+    stats.reconcile()
+    record_tags(user.id, [(datafiles[0].hash, ['Ring'])])
+    assert check_consistency(tags_posted=1)['consistent']
+
+    datafiles[1].update(tagged=2)
+    Counter.query.get('tags').update(value=5)
+    consistency = check_consistency(tags_posted=1)
+    assert not consistency['consistent']
+    assert consistency['tagged_mismatches'] == 1
+    assert consistency['queue_stale'] == 1
+    assert consistency['counter_drift']['tags'] == [5, 1]
@@ -4,7 +4,7 @@ import datetime as dt
 
 import pytest
 
-from tagcam.user.models import Role, User
+from tagcam.user.models import Role, Tag, User
 
 from .factories import UserFactory
 
@@ -65,3 +65,30 @@ class TestUser:
         user.roles.append(role)
         user.save()
         assert role in user.roles
+
+
+class TestTag:
+    """Tag label bitmask tests."""
+
+    def test_label_bits_are_stable(self):
+        """Bits follow the order of the labels, starting at the first."""
+        assert list(Tag.label_bits) == list(Tag.tags)
+        assert Tag.label_bits['GISAXS'] == 1
+        assert Tag.label_bits['Featureless'] == 1 << 11
+
+    def test_mask_round_trip(self):
+        """Label names survive packing into a bitmask."""
+        mask = Tag.labels_mask(['Ring', 'Arc'])
+        assert Tag.label_names(mask) == ['Arc', 'Ring']
+        assert Tag.labels_mask([]) == 0
+
+    @pytest.mark.usefixtures('db')
+    def test_has_labels(self, user):
+        """Tags are filtered bitwise by included and excluded labels."""
+        for i, labels in enumerate([['Ring'], ['Ring', 'Featureless'], ['Arc']]):
+            Tag(user.id, f'/{i}', f'{i:040d}', labels=Tag.labels_mask(labels)).save()
+
+        query = Tag.query.filter(Tag.has_labels(['Ring'], exclude=['Featureless']))
+        assert [tag.path for tag in query] == ['/0']
+        assert Tag.query.filter(Tag.has_labels(['Ring'])).count() == 2
+        assert Tag.query.filter(Tag.has_labels(exclude=['Ring'])).count() == 1
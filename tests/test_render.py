@@ -0,0 +1,299 @@
+# -*- coding: utf-8 -*-
+"""Render and derivative store tests."""
+import os
+
+import imageio
+import numpy as np
+import pytest
+from flask import url_for
+
+from tagcam.user.derivatives import DerivativeStore
+from tagcam.user.forms import preview_url
+from tagcam.user.importer import import_datafiles
+from tagcam.user.models import DataFile
+from tagcam.user.render import (colorize, level_shape, normalize, pyramid_levels, render_derivatives, render_file,
+                                render_pyramid_level)
+
+from .test_tagging import login
+
+
+@pytest.fixture
+def frame():
+    """A synthetic detector frame with a ring."""
+    y, x = np.mgrid[-100:100, -120:120]
+    r = np.hypot(x, y)
+    return (1000 * np.exp(-(r - 60) ** 2 / 50) + np.random.RandomState(0).poisson(5, r.shape)).astype(np.int32)
+
+
+def reference_normalize(data):
+    """The original float64 normalization with exact percentiles."""
+    with np.errstate(divide='ignore', invalid='ignore'):
+        data = np.nan_to_num(np.log(data.astype(np.float64)))
+    clip = np.percentile(data, 99.9)
+    data[data > clip] = clip
+    floor = np.percentile(data[data > 0], 1)
+    data[data < 0] = 0
+    data = ((data - floor) / (data.max() - floor) * 255)
+    data[data < 0] = 0
+    return data.astype(np.uint8)
+
+
+@pytest.fixture
+def store(tmpdir):
+    """A derivative store in a temporary directory."""
+    return DerivativeStore(str(tmpdir.join('static')), str(tmpdir.join('training')))
+
+
+class TestNormalize:
+    """Frame normalization and colormap."""
+
+    def test_matches_reference(self, frame):
+        """The approximate limits give the same image to within one level."""
+        frame[10:12] = -1  # Pilatus module gap
+        diff = np.abs(normalize(frame).astype(int) - reference_normalize(frame))
+        assert diff.max() <= 1
+        assert diff.mean() < 0.05
+
+    def test_unsigned_masked_pixels_are_ignored(self, frame):
+        """Saturated unsigned pixels are treated as gaps, not as the brightest signal."""
+        masked = frame.clip(0).astype(np.uint32)
+        masked[10:40] = np.iinfo(np.uint32).max
+        expected = normalize(frame.clip(0))
+        assert normalize(masked)[10:40].max() == 0
+        assert np.abs(normalize(masked)[40:].astype(int) - expected[40:]).max() <= 1
+
+    def test_saturated_pixels_are_kept(self, frame):
+        """Saturation is only a gap sentinel on uint32 frames; elsewhere it is the brightest signal."""
+        saturated = frame.clip(0).astype(np.uint16)
+        saturated[10:40] = np.iinfo(np.uint16).max
+        assert normalize(saturated)[10:40].min() >= 254  # To within a histogram bin of the clip
+
+    def test_non_finite_pixels_are_ignored(self, frame):
+        """Infinite and NaN pixels of float frames are treated as gaps."""
+        masked = frame.clip(0).astype(np.float32)
+        masked[10:20], masked[20:30], masked[30:40] = np.inf, -np.inf, np.nan
+        expected = normalize(frame.clip(0))
+        assert normalize(masked)[10:40].max() == 0
+        assert np.abs(normalize(masked)[40:].astype(int) - expected[40:]).max() <= 1
+
+    def test_colorize_is_viridis(self):
+        """The lookup table reproduces the matplotlib colormap."""
+        from matplotlib import cm
+
+        data = np.arange(256, dtype=np.uint8).reshape(16, 16)
+        colored = colorize(data)
+        assert colored.dtype == np.uint8
+        assert colored.shape == (16, 16, 3)
+        assert np.abs(colored / 255 - cm.viridis(data)[:, :, :3]).max() <= 1 / 255
+
+
+def test_render_derivatives(frame, store):
+    """All derivatives are written once."""
+    written = render_derivatives(frame, 'a' * 40, store)
+
+    assert set(written) == {'preview', '256', '128'}
+    assert all(os.path.isfile(path) for path in written.values())
+    assert written['256'] == os.path.join(store.training_dir, '256', 'a' * 40 + '.tif')
+    assert store.missing('a' * 40) == []
+    assert render_derivatives(frame, 'a' * 40, store) == {}
+
+
+@pytest.mark.usefixtures('db')
+def test_import_prerenders_derivatives(frame, tmpdir, store, user):
+    """Imported frames are rendered by the decode pool."""
+    import fabio
+
+    fabio.edfimage.EdfImage(data=frame).write(str(tmpdir.mkdir('data').join('frame.edf')))
+    import_datafiles(str(tmpdir.join('data')), user.id, workers=0, store=store)
+
+    assert len(list(store.previews())) == 1
+    assert len(os.listdir(os.path.join(store.training_dir, '128'))) == 1
+    assert all(store.exists(datahash, 'pyramid') for datahash, _ in store.previews())
+
+
+def test_render_container_frame(frame, tmpdir, store):
+    """Only the requested frame of a container is rendered."""
+    import h5py
+
+    path = str(tmpdir.join('scan.h5'))
+    with h5py.File(path, 'w') as f:
+        f.create_dataset('entry/data/data', data=np.stack([np.zeros_like(frame), frame]), chunks=(1,) + frame.shape)
+
+    assert render_file(('a' * 40, path, 0), store)[1] is None  # An empty frame has no contrast
+    datahash, written = render_file(('b' * 40, path, 1), store)
+    assert set(written) == {'preview', '256', '128'}
+    assert imageio.imread(written['preview']).shape == frame.shape + (3,)
+
+
+class TestDerivativeStore:
+    """Derivative store."""
+
+    def test_failed_write_leaves_nothing(self, store):
+        """A writer that fails leaves neither the derivative nor a temporary file."""
+        def writer(path):
+            open(path, 'w').write('partial')
+            raise ValueError()
+
+        with pytest.raises(ValueError):
+            store.write('a' * 40, 'preview', writer)
+        assert os.listdir(store.preview_dir) == []
+
+    def test_written_files_follow_umask(self, store):
+        """Derivatives are readable by other users, like files created with open."""
+        from tagcam.user.derivatives import file_mode
+
+        path = store.write('a' * 40, 'preview', lambda path: open(path, 'wb').write(b'x'))
+        assert os.stat(path).st_mode & 0o777 == file_mode
+
+    @pytest.mark.usefixtures('db')
+    def test_evict_only_fully_tagged(self, store, user):
+        """Least recently used previews of fully tagged files are evicted first."""
+        for i, (datahash, tagged) in enumerate([('a' * 40, 2), ('b' * 40, 2), ('c' * 40, 0)]):
+            DataFile(datahash, f'/{datahash}', user.id, tagged=tagged).save()
+            path = store.write(datahash, 'preview', lambda path: open(path, 'wb').write(b'x' * 100))
+            os.utime(path, (i, i))
+
+        assert store.evict(150) == (2, 200)
+        assert store.missing('a' * 40) == store.missing('b' * 40) == ['preview', '256', '128']
+        assert store.exists('c' * 40, 'preview')
+
+    @pytest.mark.usefixtures('db')
+    def test_evict_counts_tiles(self, store, user):
+        """Tiles count toward the budget; those of fully tagged files go first, with their previews."""
+        for i, (datahash, tagged) in enumerate([('a' * 40, 2), ('c' * 40, 0)]):
+            DataFile(datahash, f'/{datahash}', user.id, tagged=tagged).save()
+            paths = [store.write(datahash, 'preview', lambda path: open(path, 'wb').write(b'x' * 100))]
+            for col in range(3):
+                paths.append(store.write_file(store.tile_path(datahash, 0, col, 0),
+                                              lambda path: open(path, 'wb').write(b'x' * 100)))
+            for path in paths:
+                os.utime(path, (i, i))
+
+        assert store.evict(450) == (1, 400)
+        assert not store.exists('a' * 40, 'preview')
+        assert not os.path.exists(os.path.dirname(store.path('a' * 40, 'pyramid')))
+        assert store.evict(150) == (1, 300)
+        assert store.exists('c' * 40, 'preview')
+        assert not os.path.exists(os.path.dirname(store.path('c' * 40, 'pyramid')))
+
+
+class TestPreviewRoute:
+    """Serving previews with immutable caching."""
+
+    @pytest.fixture
+    def preview(self, app, frame, tmpdir):
+        """A rendered preview in a temporary preview directory."""
+        app.config['PREVIEW_DIR'] = str(tmpdir.join('static'))
+        app.config['TRAINING_DIR'] = str(tmpdir.join('training'))
+        render_derivatives(frame, 'a' * 40, DerivativeStore.from_config(app.config))
+        return 'a' * 40
+
+    def test_immutable_headers(self, testapp, preview):
+        """Previews are cached forever and revalidate against a strong ETag."""
+        url = preview_url(preview)
+        res = testapp.get(url)
+        assert res.content_type == 'image/jpeg'
+        assert 'immutable' in res.headers['Cache-Control']
+        assert res.headers['ETag'] == f'"preview-{preview}"'
+        assert res.body
+
+        res = testapp.get(url, headers={'If-None-Match': res.headers['ETag']}, status=304)
+        assert not res.body
+
+    def test_missing_preview(self, testapp, preview):
+        """Unknown and malformed hashes are not found."""
+        testapp.get(preview_url('b' * 40), status=404)
+        testapp.get(preview_url('../../secret'), status=404)
+
+    @pytest.mark.parametrize('offload, header, value', [
+        ('x-accel-redirect', 'X-Accel-Redirect', '/_previews/' + 'a' * 40 + '.jpg'),
+        ('x-sendfile', 'X-Sendfile', None),
+    ])
+    def test_offload(self, app, testapp, preview, offload, header, value):
+        """The proxy is told which file to send and the body is left empty."""
+        app.config['PREVIEW_OFFLOAD'] = offload
+        res = testapp.get(preview_url(preview))
+        assert not res.body
+        assert res.headers[header] == (value or DerivativeStore.from_config(app.config).path(preview, 'preview'))
+        assert 'immutable' in res.headers['Cache-Control']
+
+
+class TestTilePyramid:
+    """Zoom tile pyramids."""
+
+    def test_levels(self):
+        """Level 0 fits in one tile and each level doubles the previous one."""
+        assert pyramid_levels((200, 240)) == 1
+        assert pyramid_levels((2048, 1475)) == 4
+        assert level_shape((2048, 1475), 0, 4) == (256, 185)
+        assert level_shape((2048, 1475), 3, 4) == (2048, 1475)
+
+    @pytest.fixture
+    def tiled(self, app, db, frame, tmpdir, user):
+        """A stored frame with three zoom levels, tiling into a temporary directory."""
+        import fabio
+
+        app.config['PREVIEW_DIR'] = str(tmpdir.join('static'))
+        path = str(tmpdir.join('frame.edf'))
+        fabio.edfimage.EdfImage(data=np.tile(frame, (3, 3))).write(path)
+        DataFile('a' * 40, path, user.id).save()
+        return ('a' * 40, path, 0)
+
+    @pytest.mark.usefixtures('db')
+    def test_tiles_render_on_demand(self, app, testapp, tiled, user):
+        """The info is read from the frame's header; levels render on their first tile request."""
+        store = DerivativeStore.from_config(app.config)
+        testapp.get(url_for('user.tile_info', datahash='a' * 40), status=401)
+        testapp.get(url_for('user.tile', datahash='a' * 40, level=0, col=0, row=0), status=401)
+        login(testapp, user)
+
+        assert url_for('user.tiles', datahash='a' * 40) + 'info.json' == url_for('user.tile_info', datahash='a' * 40)
+        info = testapp.get(url_for('user.tile_info', datahash='a' * 40)).json
+        assert info == dict(width=720, height=600, tile=256, levels=3)
+        pyramid = os.path.dirname(store.path('a' * 40, 'pyramid'))
+        assert os.listdir(pyramid) == ['info.json']
+
+        res = testapp.get(url_for('user.tile', datahash='a' * 40, level=2, col=2, row=2))
+        assert 'immutable' in res.headers['Cache-Control']
+        assert imageio.imread(res.body).shape == (600 - 512, 720 - 512, 3)
+        assert len(os.listdir(os.path.join(pyramid, '2'))) == 9
+        assert not os.path.isdir(os.path.join(pyramid, '1'))
+
+        testapp.get(url_for('user.tile', datahash='a' * 40, level=2, col=3, row=0), status=404)
+        testapp.get(url_for('user.tile', datahash='a' * 40, level=5, col=0, row=0), status=404)
+        testapp.get(url_for('user.tile_info', datahash='b' * 40), status=404)
+
+    @pytest.mark.usefixtures('db')
+    def test_missing_tiles_are_not_decoded(self, testapp, tiled, user, monkeypatch):
+        """Tiles outside the pyramid are not found without decoding the frame."""
+        from tagcam.user import render
+
+        def read_frame(path, frame=0):
+            raise AssertionError('Decoded')
+
+        monkeypatch.setattr(render, 'read_frame', read_frame)
+        login(testapp, user)
+        testapp.get(url_for('user.tile', datahash='a' * 40, level=40, col=0, row=0), status=404)
+        testapp.get(url_for('user.tile', datahash='a' * 40, level=0, col=1, row=0), status=404)
+
+    @pytest.mark.usefixtures('db')
+    def test_failed_level_leaves_nothing(self, app, tiled, monkeypatch):
+        """A level whose rendering fails partway is not left with missing tiles."""
+        store = DerivativeStore.from_config(app.config)
+        written = []
+
+        def fail_after_first(path, image):
+            if written:
+                raise OSError('Disk full')
+            written.append(path)
+            open(path, 'wb').close()
+
+        monkeypatch.setattr(imageio, 'imwrite', fail_after_first)
+        with pytest.raises(OSError):
+            render_pyramid_level(tiled, 2, store)
+        assert not os.path.exists(os.path.dirname(store.tile_path('a' * 40, 2, 0, 0)))
+        assert os.listdir(os.path.dirname(store.path('a' * 40, 'pyramid'))) == ['info.json']
+
+        monkeypatch.undo()
+        render_pyramid_level(tiled, 2, store)
+        assert len(os.listdir(os.path.dirname(store.tile_path('a' * 40, 2, 0, 0)))) == 9
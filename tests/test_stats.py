@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+"""Tagging statistics tests."""
+import pytest
+from flask import url_for
+
+from tagcam.user import stats
+from tagcam.user.importer import import_datafiles
+from tagcam.user.models import Counter, UserStat
+from tagcam.user.tagging import record_tags
+
+from .factories import UserFactory
+from .test_tagging import login
+
+
+@pytest.mark.usefixtures('db')
+class TestStats:
+    """Counter tables."""
+
+    def test_import_counts_datafiles(self, framedir, user):
+        """Imports bump the data file and remaining counters."""
+        import_datafiles(str(framedir), user.id, workers=0, batch_size=2)
+        snapshot = stats.snapshot()
+        assert snapshot['datafiles'] == 4
+        assert snapshot['remaining'] == 4
+
+    def test_tags_are_counted(self, user, datafiles):
+        """Each new tag bumps the totals, the user, the labels and the day."""
+        stats.reconcile()
+        other = UserFactory(password='myprecious').save()
+        record_tags(user.id, [(datafiles[0].hash, ['Ring']), (datafiles[1].hash, ['Ring', 'SAXS'])])
+        record_tags(other.id, [(datafiles[0].hash, ['Ring'])])
+        record_tags(other.id, [(datafiles[0].hash, ['Peaks'])])
+
+        snapshot = stats.snapshot()
+        assert snapshot['tags'] == 3
+        assert snapshot['remaining'] == 3
+        assert snapshot['labels']['Ring'] == 3
+        assert snapshot['labels']['SAXS'] == 1
+        assert snapshot['labels']['Peaks'] == 0
+        assert [leader['tags'] for leader in snapshot['leaderboard']] == [2, 1]
+        assert snapshot['days'][0]['tags'] == 3
+
+    def test_reconcile_repairs_drift(self, user, datafiles):
+        """Reconciling recomputes the counters from the base tables."""
+        record_tags(user.id, [(datafiles[0].hash, ['Ring'])])
+        before = stats.snapshot()
+        Counter.query.get('tags').update(value=100)
+        UserStat.query.get(user.id).update(value=100)
+
+        stats.reconcile()
+        after = stats.snapshot()
+        assert after['tags'] == 1
+        assert after['datafiles'] == 4
+        assert after['leaderboard'] == before['leaderboard']
+        assert after['labels'] == before['labels']
+
+    def test_reconcile_applies_corrections(self, user, datafiles):
+        """Only drifted counters are corrected, and users left without tags leave the leaderboard."""
+        stats.reconcile()
+        record_tags(user.id, [(datafiles[0].hash, ['Ring'])])
+        assert stats.reconcile() == 0
+
+        other = UserFactory(password='myprecious').save()
+        UserStat(username=other.id, value=3).save()
+        Counter.query.get('tags').update(value=0)
+        assert stats.reconcile() == 2
+        assert stats.drift() == {}
+        assert UserStat.query.get(other.id) is None
+        assert stats.snapshot()['tags'] == 1
+
+    def test_drift_reports_without_repairing(self, user, datafiles):
+        """Drift lists the counters that disagree with the base tables and leaves them alone."""
+        stats.reconcile()
+        record_tags(user.id, [(datafiles[0].hash, ['Ring'])])
+        assert stats.drift() == {}
+
+        UserStat.query.get(user.id).update(value=100)
+        Counter.query.get('tags').update(value=0)
+        assert stats.drift() == {'tags': (0, 1), f'user:{user.id}': (100, 1)}
+        assert Counter.query.get('tags').value == 0
+
+    def test_stats_endpoint(self, user, testapp, datafiles):
+        """The page and the JSON endpoint show the counters."""
+        record_tags(user.id, [(datafiles[0].hash, ['Ring'])])
+        login(testapp, user)
+        res = testapp.get(url_for('user.api_stats'))
+        assert res.json['tags'] == 1
+        assert res.json['leaderboard'] == [dict(username=user.username, tags=1)]
+        assert 'Leaderboard' in testapp.get(url_for('user.tagstats'))
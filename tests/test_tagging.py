@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+"""Tagging tests."""
+import random
+import threading
+
+from flask import url_for
+from sqlalchemy import func
+
+from tagcam.app import create_app
+from tagcam.database import db as _db
+from tagcam.settings import TestConfig
+from tagcam.user.derivatives import DerivativeStore
+from tagcam.user.models import Counter, DataFile, Tag, User
+from tagcam.user.tagging import record_tags
+
+
+def login(testapp, user):
+    """Log a user in through the navbar form."""
+    form = testapp.get('/').forms['loginForm']
+    form['username'] = user.username
+    form['password'] = 'myprecious'
+    form.submit().follow()
+
+
+class TestTagPage:
+    """Tag form."""
+
+    def test_tags_the_image_shown(self, user, testapp, datafiles):
+        """The submitted tag is recorded against the image that was shown."""
+        login(testapp, user)
+        res = testapp.get(url_for('user.tag'))
+        shown = res.forms['tagForm']['hash'].value
+        res.forms['tagForm']['Ring'] = True
+        res = res.forms['tagForm'].submit().follow()
+
+        assert 'Image tagged with Ring!' in res
+        tag = Tag.query.one()
+        assert tag.hash == shown
+        assert tag.Ring is True
+        assert DataFile.query.get(shown).tagged == 1
+
+    def test_empty_queue(self, user, testapp):
+        """With nothing left to tag, the page says so instead of failing."""
+        login(testapp, user)
+        res = testapp.get(url_for('user.tag'))
+        assert res.status_code == 200
+        assert 'There are no images left to tag' in res
+        assert not res.forms['tagForm']['hash'].value
+
+
+class TestTagAPI:
+    """Batch JSON API."""
+
+    def test_work_batch(self, user, testapp, datafiles):
+        """Several distinct images are leased in one call."""
+        login(testapp, user)
+        res = testapp.get(url_for('user.api_work', n=3))
+        items = res.json['items']
+        assert len({item['hash'] for item in items}) == 3
+        assert all(item['preview'].endswith(f"{item['hash']}.jpg") for item in items)
+        assert res.json['labels'] == list(Tag.tags)
+
+    def test_work_batch_renders_nothing(self, app, user, testapp, datafiles):
+        """Leasing renders no previews; fetching one renders it."""
+        login(testapp, user)
+        items = testapp.get(url_for('user.api_work', n=2)).json['items']
+        store = DerivativeStore.from_config(app.config)
+        assert all(store.missing(item['hash']) for item in items)
+
+        res = testapp.get(items[0]['preview'])
+        assert res.content_type == 'image/jpeg'
+        assert not store.missing(items[0]['hash'])
+
+    def test_submit_batch(self, user, testapp, datafiles):
+        """A batch of tags is recorded in one request."""
+        login(testapp, user)
+        items = testapp.get(url_for('user.api_work', n=2)).json['items']
+        res = testapp.post_json(url_for('user.api_tags'),
+                                {'tags': [{'hash': item['hash'], 'labels': ['Ring']} for item in items]})
+
+        assert res.json['recorded'] == 2
+        assert Tag.query.filter_by(Ring=True).count() == 2
+        assert sum(datafile.tagged for datafile in DataFile.query) == 2
+
+    def test_invalid_batch_records_nothing(self, user, testapp, datafiles):
+        """One bad submission rejects the whole batch."""
+        login(testapp, user)
+        res = testapp.post_json(url_for('user.api_tags'),
+                                {'tags': [{'hash': datafiles[0].hash, 'labels': ['Ring']},
+                                          {'hash': datafiles[1].hash, 'labels': ['Unicorn']}]},
+                                status=400)
+        assert 'Unicorn' in res.json['error']
+        assert Tag.query.count() == 0
+
+
+class TestRecordTags:
+    """Tag write path."""
+
+    def test_resubmission_is_idempotent(self, user, datafiles):
+        """Tagging the same file twice, even in one batch, records one tag."""
+        datahash = datafiles[0].hash
+        assert record_tags(user.id, [(datahash, ['Ring']), (datahash, ['Arc'])]) == 1
+        assert record_tags(user.id, [(datahash, ['Ring'])]) == 0
+        assert Tag.query.count() == 1
+        assert DataFile.query.get(datahash).tagged == 1
+
+    def test_concurrent_taggers_keep_counters_exact(self, tmpdir):
+        """Counters match COUNT(*) of the tags table under concurrent, overlapping submissions."""
+        class StressConfig(TestConfig):
+            SQLALCHEMY_DATABASE_URI = 'sqlite:///{}'.format(tmpdir.join('stress.db'))
+
+        app = create_app(StressConfig)
+        hashes = [f'{i:040d}' for i in range(20)]
+        with app.app_context():
+            _db.create_all()
+            user_ids = [User(f'tagger{i}', f'tagger{i}@example.com').save().id for i in range(4)]
+            for datahash in hashes:
+                _db.session.add(DataFile(datahash, f'/{datahash}', user_ids[0]))
+            _db.session.commit()
+
+        errors = []
+
+        def tagger(user_id, seed):
+            rng = random.Random(seed)
+            with app.app_context():
+                try:
+                    for _ in range(40):
+                        record_tags(user_id, [(rng.choice(hashes), ['Ring']) for _ in range(rng.randint(1, 3))])
+                except Exception as e:  # noqa: B902
+                    errors.append(e)
+
+        # Two threads per user, so the same (user, hash) pairs race each other
+        threads = [threading.Thread(target=tagger, args=(user_id, seed))
+                   for seed, user_id in enumerate(user_ids * 2)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        assert not errors
+        with app.app_context():
+            counts = dict(_db.session.query(Tag.hash, func.count(Tag.id)).group_by(Tag.hash))
+            assert sum(counts.values()) == Tag.query.count() > 0
+            for datafile in DataFile.query:
+                assert datafile.tagged == counts.get(datafile.hash, 0)
+            assert _db.session.query(Tag.username, Tag.hash).distinct().count() == Tag.query.count()
+            assert Counter.query.get('tags').value == Tag.query.count()
+            _db.session.remove()
+            _db.drop_all()
@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+"""Tomography group tagging tests."""
+import os
+
+import fabio
+import imageio
+import numpy as np
+import pytest
+from flask import url_for
+
+from tagcam.user.derivatives import DerivativeStore
+from tagcam.user.forms import TomoTagForm
+from tagcam.user.models import TomoDataFile, TomoTag
+from tagcam.user.render import montage_key, render_montage
+from tagcam.user.tomotagging import RatingError, next_group, record_ratings
+
+from .factories import UserFactory
+from .test_tagging import login
+
+
+@pytest.fixture
+def groups(app, db, user, tmpdir):
+    """Two groups of three frames, rendering into a temporary directory."""
+    app.config['PREVIEW_DIR'] = str(tmpdir.join('static'))
+    app.config['TRAINING_DIR'] = str(tmpdir.join('training'))
+    rng = np.random.RandomState(0)
+    for group in range(2):
+        for i in range(3):
+            path = str(tmpdir.join(f'{group}_{i}.tif'))
+            fabio.tifimage.TifImage(data=rng.poisson(10 * (i + 1), (64, 48)).astype(np.uint16)).write(path)
+            TomoDataFile(f'{group}{i:039d}', path, user.id, groupid=f'{group:040d}',
+                         operation='filter', operationtype='recon', parameter='sigma', value=3 - i).save()
+    return [f'{group:040d}' for group in range(2)]
+
+
+@pytest.mark.usefixtures('db')
+class TestTomoTagging:
+    """Group selection and rating."""
+
+    def test_next_group_is_whole_group(self, user, groups):
+        """A whole group is returned, ordered by parameter value."""
+        members = next_group(user.id)
+        assert len(members) == 3
+        assert len({member.groupid for member in members}) == 1
+        assert [member.value for member in members] == [1, 2, 3]
+
+    def test_rated_groups_are_skipped(self, user, groups):
+        """Once a user rated a group it is not offered to them again."""
+        members = next_group(user.id)
+        assert record_ratings(user.id, members[0].groupid, {member.hash: 3 for member in members}) == 3
+        assert record_ratings(user.id, members[0].groupid, {member.hash: 3 for member in members}) == 0
+        assert next_group(user.id)[0].groupid != members[0].groupid
+        assert all(member.tagged == 1 for member in TomoDataFile.query.filter_by(groupid=members[0].groupid))
+
+    def test_fully_rated_groups_are_done(self, user, groups):
+        """Groups with enough ratings are no longer offered."""
+        other = UserFactory(password='myprecious').save()
+        for rater in (user, other):
+            for groupid in groups:
+                hashes = [datahash for datahash, in TomoDataFile.query.with_entities(TomoDataFile.hash)
+                          .filter_by(groupid=groupid)]
+                record_ratings(rater.id, groupid, {datahash: 1 for datahash in hashes})
+        assert next_group(UserFactory(password='myprecious').save().id) == []
+
+    def test_partial_group_is_rejected(self, user, groups):
+        """A rating must cover the whole group."""
+        members = next_group(user.id)
+        with pytest.raises(RatingError):
+            record_ratings(user.id, members[0].groupid, {members[0].hash: 3})
+        assert TomoTag.query.count() == 0
+
+    def test_form_classes_are_cached(self):
+        """One form class is built per group size."""
+        assert TomoTagForm.for_size(3) is TomoTagForm.for_size(3)
+        assert TomoTagForm.for_size(3) is not TomoTagForm.for_size(4)
+
+    def test_rate_group_page(self, user, testapp, groups):
+        """A group is rated through the form, with its frames shown from one montage."""
+        login(testapp, user)
+        res = testapp.get(url_for('user.tomotag'))
+        assert 'montage-tile' in res
+        form = res.forms['tomoTagForm']
+        for i in range(3):
+            form[f'rating_{i}'] = '4'
+        form.submit().follow()
+
+        assert TomoTag.query.count() == 3
+        assert {tag.rating for tag in TomoTag.query} == {4}
+
+    def test_forged_group_is_rejected(self, user, testapp, groups):
+        """The form is sized by the group in the database, and the frames must be the group's."""
+        login(testapp, user)
+        form = testapp.get(url_for('user.tomotag')).forms['tomoTagForm']
+        for i in range(3):
+            form[f'rating_{i}'] = '4'
+        hashes = form['hashes'].value
+        for forged in (',' * 10 ** 5, hashes.rsplit(',', 1)[0] + ',' + '9' * 40):
+            form['hashes'] = forged
+            res = form.submit()
+            assert 'The frames do not match the group' in res
+        assert TomoTag.query.count() == 0
+        assert TomoTagForm.for_size.cache_info().currsize <= 64
+
+    def test_invalid_submission_keeps_group(self, user, testapp, groups):
+        """An incomplete rating shows the same group again with the ratings already given."""
+        login(testapp, user)
+        form = testapp.get(url_for('user.tomotag')).forms['tomoTagForm']
+        groupid = form['groupid'].value
+        form['rating_0'] = '4'
+        res = form.submit()
+        assert res.status_code == 200
+        form = res.forms['tomoTagForm']
+        assert form['groupid'].value == groupid
+        assert form['rating_0'].value == '4'
+        assert TomoTag.query.count() == 0
+
+
+@pytest.mark.usefixtures('db')
+class TestMontage:
+    """Group montages."""
+
+    def test_montage_tiles_and_cache(self, app, user, groups):
+        """Frames are tiled into one sprite sheet with shared contrast, cached by the frames' hashes."""
+        store = DerivativeStore.from_config(app.config)
+        members = next_group(user.id)
+        items = [(member.hash, member.path) for member in members]
+        tilemap = render_montage(items, store, tile=32)
+
+        assert tilemap['key'] == montage_key(member.hash for member in members)
+        assert tilemap['columns'] == 2
+        assert [tile['hash'] for tile in tilemap['tiles']] == [member.hash for member in members]
+        assert tilemap['tiles'][0]['height'] == 32
+        assert tilemap['tiles'][0]['width'] == 24
+        sheet = imageio.imread(store.path(tilemap['key'], 'montage'))
+        assert sheet.shape[:2] == (64, 64)
+
+        # Shared limits: the dimmest frame stays darker than the brightest
+        tiles = [sheet[tile['y']:tile['y'] + 32, tile['x']:tile['x'] + 24].mean() for tile in tilemap['tiles']]
+        assert tiles[-1] != tiles[0]
+
+        os.remove(members[0].path)
+        assert render_montage(items, store, tile=32) == tilemap
+
+    def test_montage_endpoint(self, user, testapp, groups):
+        """The tile map of a group is served as JSON."""
+        login(testapp, user)
+        res = testapp.get(url_for('user.api_montage', groupid=groups[0]))
+        assert len(res.json['tiles']) == 3
+        assert res.json['url'].endswith('.jpg')
+        testapp.get(url_for('user.api_montage', groupid='f' * 40), status=404)
@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+"""Tagging work queue tests."""
+import pytest
+
+from tagcam.user import workqueue
+from tagcam.user.models import DataFile, Tag, WorkItem
+
+from .factories import UserFactory
+
+
+@pytest.fixture
+def queued(db, user):
+    """Three queued data files."""
+    hashes = [c * 40 for c in 'abc']
+    for datahash in hashes:
+        DataFile(datahash, f'/{datahash}', user.id).save()
+    workqueue.enqueue(hashes)
+    db.session.commit()
+    return hashes
+
+
+@pytest.mark.usefixtures('db')
+class TestWorkQueue:
+    """Work queue."""
+
+    def test_leases_are_exclusive(self, queued):
+        """Two taggers never lease the same file."""
+        first, second = UserFactory(), UserFactory()
+        first.save()
+        second.save()
+
+        mine = workqueue.lease(first.id, count=2)
+        theirs = workqueue.lease(second.id, count=2)
+
+        assert len(mine) == 2
+        assert len(theirs) == 1
+        assert not set(mine) & set(theirs)
+
+    def test_held_lease_is_returned_again(self, queued, user):
+        """Reloading returns the lease the tagger already holds."""
+        assert workqueue.lease(user.id) == workqueue.lease(user.id)
+
+    def test_expired_lease_is_released(self, queued, user):
+        """A lease that expired can be taken by another tagger."""
+        other = UserFactory()
+        other.save()
+        workqueue.lease(user.id, count=3, seconds=-1)
+        assert len(workqueue.lease(other.id, count=3)) == 3
+
+    def test_excludes_files_tagged_by_user(self, queued, user, db):
+        """A tagger is never offered a file they already tagged."""
+        for datahash in queued[:2]:
+            Tag(username=user.id, path=f'/{datahash}', hash=datahash).save()
+        assert workqueue.lease(user.id, count=3) == [queued[2]]
+
+    def test_skips_items_without_datafile(self, queued, user, db):
+        """Items left behind by deleted data files are never leased."""
+        DataFile.query.get(queued[0]).delete()
+        assert set(workqueue.lease(user.id, count=3)) == set(queued[1:])
+
+    def test_complete(self, queued, user, db):
+        """A file leaves the queue once it has enough tags."""
+        datahash, = workqueue.lease(user.id)
+        DataFile.query.get(datahash).update(tagged=1)
+        workqueue.complete([datahash], user.id)
+        db.session.commit()
+        assert WorkItem.query.get(datahash).lease_user is None
+
+        DataFile.query.get(datahash).update(tagged=2)
+        workqueue.complete([datahash], user.id)
+        db.session.commit()
+        assert WorkItem.query.get(datahash) is None
+
+    def test_rebuild(self, queued, user, db):
+        """The queue is rebuilt from the data files that need tags."""
+        DataFile.query.get(queued[0]).update(tagged=2)
+        assert workqueue.rebuild() == 2
+        assert {item.hash for item in WorkItem.query} == set(queued[1:])